@@ -1,3 +1,5 @@
+import re
+
 from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms import layout
@@ -19,5 +21,13 @@ class CreateCounterPartyPatternForm(forms.Form):
         super().__init__(*args, **kwargs)
         self.fields['auto_categorise'].choices = get_category_choices()
 
+    def clean_pattern(self):
+        try:
+            re.compile(self.cleaned_data['pattern'], re.IGNORECASE)
+        except re.error as exc:
+            raise forms.ValidationError('Invalid pattern: {}'.format(exc))
+
+        return self.cleaned_data['pattern']
+
 
 
@@ -15,6 +15,27 @@ class CounterParty(models.Model):
     def get_absolute_url(self):
         return reverse('counterparty:detail', args=[self.pk])
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # counterparties created in bulk on import get their stats when their transactions are written
+        CounterPartyStats.objects.get_or_create(counterparty=self)
+
+
+class CounterPartyStats(models.Model):
+    """
+    Totals of each counterparty's transactions, kept up to date by `counterparty.stats` so that the counterparty
+    list does not aggregate the transactions table on every view.
+    """
+    counterparty = models.OneToOneField(CounterParty, primary_key=True, related_name='stats')
+    net_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    total_transactions = models.IntegerField(default=0)
+    most_recent_transaction = models.DateField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'counterparty stats'
+        index_together = ('most_recent_transaction', 'counterparty')
+
 
 class Pattern(models.Model):
     regex = models.CharField(max_length=200, primary_key=True)
@@ -30,3 +51,36 @@ class Alias(models.Model):
 
     def __str__(self):
         return self.pk
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # aliases created in bulk are indexed by calling `AliasTrigram.index` directly
+        self.trigrams.all().delete()
+        AliasTrigram.index([self])
+
+
+class AliasTrigram(models.Model):
+    """
+    Every three character substring of each alias, lowercased. Narrows down the aliases a pattern could match to
+    those containing the literal text the pattern requires, before the pattern itself is tried.
+    """
+    trigram = models.CharField(max_length=3)
+    alias = models.ForeignKey(Alias, related_name='trigrams')
+
+    class Meta:
+        unique_together = ('trigram', 'alias')
+
+    @staticmethod
+    def trigrams(text):
+        text = text.lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def index(cls, aliases):
+        """
+        Creates the trigrams of `aliases`, which must not already be indexed.
+        """
+        cls.objects.bulk_create([
+            cls(trigram=trigram, alias=alias) for alias in aliases for trigram in cls.trigrams(alias.pk)
+        ])
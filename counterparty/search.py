@@ -0,0 +1,70 @@
+import re
+import sre_parse
+
+from .models import Alias, AliasTrigram
+
+
+# Each trigram costs a subquery, so only this many of a pattern's trigrams are used to narrow down aliases
+MAX_QUERY_TRIGRAMS = 8
+
+
+def _collect_literals(items, literals):
+    """
+    Appends to `literals` the runs of literal text that must appear in anything the parsed regex `items` matches.
+    Non-ASCII characters end a run, as their lowercase form may differ from how the regex folds their case.
+    """
+    run = ''
+
+    for op, av in items:
+        if op == sre_parse.LITERAL and av < 0x80:
+            run += chr(av)
+            continue
+
+        literals.append(run)
+        run = ''
+
+        if op == sre_parse.SUBPATTERN:
+            _collect_literals(av[-1], literals)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            # the repeated item must appear at least once, but is not necessarily adjacent to its neighbours
+            _collect_literals(av[2], literals)
+
+    literals.append(run)
+
+
+def required_trigrams(pattern):
+    """
+    Returns a list of the lowercased trigrams an alias must contain to be matched by `pattern`, at most
+    `MAX_QUERY_TRIGRAMS` long. Non-overlapping trigrams come first, as they narrow down aliases the most.
+    """
+    literals = []
+    _collect_literals(sre_parse.parse(pattern), literals)
+
+    literals = [literal.lower() for literal in literals]
+    trigrams = []
+
+    for step in (3, 1):
+        for literal in literals:
+            for start in range(0, len(literal) - 2, step):
+                if literal[start:start + 3] not in trigrams:
+                    trigrams.append(literal[start:start + 3])
+
+    return trigrams[:MAX_QUERY_TRIGRAMS]
+
+
+def matching_aliases(pattern):
+    """
+    Returns a queryset of the aliases `pattern` matches, case insensitively.
+
+    Aliases are first narrowed down to those containing every trigram the pattern requires, using the trigram
+    index, and only the remaining aliases are checked against the pattern in the database. Raises `re.error` if the
+    pattern is invalid.
+    """
+    re.compile(pattern, re.IGNORECASE)
+
+    aliases = Alias.objects.all()
+
+    for trigram in required_trigrams(pattern):
+        aliases = aliases.filter(pk__in=AliasTrigram.objects.filter(trigram=trigram).values('alias'))
+
+    return aliases.filter(pk__iregex=pattern)
@@ -0,0 +1,112 @@
+import decimal
+
+from django.db.models import Sum, Count, Max
+
+from transactions.models import Transaction
+from .models import CounterParty, CounterPartyStats
+
+
+# Keeps queries filtering on lists of counterparties under the bound parameter limit of SQLite
+CHUNK_SIZE = 500
+
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+class StatsDeltas:
+    """
+    Changes to be made to `CounterPartyStats` rows by newly written transactions, accumulated in memory and applied
+    with `apply`. Like the monthly rollups, totals are adjusted in Python to avoid float error in SQLite.
+    """
+
+    def __init__(self):
+        self.deltas = {}
+
+    def add_transactions(self, transactions):
+        for transaction in transactions:
+            if transaction.counterparty_alias is None:
+                continue
+
+            counterparty_id = transaction.counterparty_alias.counterparty_id
+            delta = self.deltas.setdefault(counterparty_id, [decimal.Decimal(0), 0, None])
+            delta[0] += transaction.amount
+            delta[1] += 1
+
+            if delta[2] is None or transaction.date > delta[2]:
+                delta[2] = transaction.date
+
+    def counterparties(self):
+        return set(self.deltas)
+
+    def apply(self):
+        deltas, self.deltas = self.deltas, {}
+        new_stats = []
+
+        for chunk in _chunks(deltas):
+            existing = CounterPartyStats.objects.in_bulk(chunk)
+
+            for counterparty_id in chunk:
+                net_amount, count, most_recent = deltas[counterparty_id]
+                stats = existing.get(counterparty_id)
+
+                if stats is None:
+                    new_stats.append(CounterPartyStats(counterparty_id=counterparty_id, net_amount=net_amount,
+                                                       total_transactions=count, most_recent_transaction=most_recent))
+                    continue
+
+                stats.net_amount += net_amount
+                stats.total_transactions += count
+                if stats.most_recent_transaction is None or most_recent > stats.most_recent_transaction:
+                    stats.most_recent_transaction = most_recent
+                stats.save()
+
+        CounterPartyStats.objects.bulk_create(new_stats)
+
+
+def _aggregate(transactions):
+    """
+    Returns a dict mapping counterparty primary keys to a (net amount, count, most recent date) tuple of their
+    transactions in `transactions`.
+    """
+    rows = transactions.order_by().values('counterparty_alias__counterparty').annotate(
+        net_amount=Sum('amount'), total_transactions=Count('pk'), most_recent_transaction=Max('date'))
+
+    return {
+        row['counterparty_alias__counterparty']: (
+            row['net_amount'], row['total_transactions'], row['most_recent_transaction'])
+        for row in rows
+    }
+
+
+def refresh_stats(counterparty_pks):
+    """
+    Recalculates the stats of the given counterparties from their transactions, e.g. after their aliases have been
+    moved. Counterparties that no longer exist are ignored.
+    """
+    for chunk in _chunks(set(counterparty_pks)):
+        totals = _aggregate(Transaction.objects.filter(counterparty_alias__counterparty__in=chunk))
+
+        for stats in CounterPartyStats.objects.filter(counterparty__in=chunk):
+            stats.net_amount, stats.total_transactions, stats.most_recent_transaction = totals.get(
+                stats.counterparty_id, (0, 0, None))
+            stats.save()
+
+
+def rebuild_stats():
+    """
+    Recalculates the stats of every counterparty from the transactions table.
+    """
+    CounterPartyStats.objects.all().delete()
+
+    totals = _aggregate(Transaction.objects.filter(counterparty_alias__isnull=False))
+    new_stats = []
+
+    for counterparty_id in CounterParty.objects.values_list('pk', flat=True):
+        net_amount, count, most_recent = totals.get(counterparty_id, (0, 0, None))
+        new_stats.append(CounterPartyStats(counterparty_id=counterparty_id, net_amount=net_amount,
+                                           total_transactions=count, most_recent_transaction=most_recent))
+
+    CounterPartyStats.objects.bulk_create(new_stats)
@@ -1,3 +1,179 @@
+import datetime
+import decimal
+from unittest import mock
+
+from django.core.urlresolvers import reverse
 from django.test import TestCase
 
-# Create your tests here.
+from statementimport.writer import TransactionWriter
+from transactions.categorisation import delete_transactions
+from transactions.models import Category, CategoryRule, Transaction, TransferTransaction
+from .models import Alias, CounterParty, CounterPartyStats
+from .search import required_trigrams, matching_aliases
+from .stats import refresh_stats, rebuild_stats
+
+
+class MatchingAliasesTest(TestCase):
+    aliases = ('TESCO STORES 1234', 'TESCO EXPRESS', 'Tesco Metro', 'SAINSBURYS S/MKTS', 'M&S SIMPLY FOOD', 'AC',
+               'ABC', 'ABBC', 'TFL.GOV.UK/CP', 'TFLXGOV', 'XESCO')
+
+    def setUp(self):
+        counterparty = CounterParty.objects.create(name='Shops')
+
+        for alias in self.aliases:
+            Alias.objects.create(alias=alias, counterparty=counterparty)
+
+    def assertMatchesScan(self, pattern):
+        with self.subTest(pattern=pattern):
+            expected = set(Alias.objects.filter(pk__iregex=pattern).values_list('pk', flat=True))
+
+            self.assertTrue(expected)
+            self.assertEqual(set(matching_aliases(pattern).values_list('pk', flat=True)), expected)
+
+    def test_literals(self):
+        self.assertEqual(required_trigrams('TESCO STORES'), ['tes', 'co ', 'sto', 'res', 'esc', 'sco', 'o s', ' st'])
+        self.assertMatchesScan('TESCO STORES')
+
+    def test_alternation(self):
+        self.assertMatchesScan('TESCO|SAINSBURY')
+        self.assertMatchesScan('^(TESCO|TFL) ')
+
+    def test_optional(self):
+        self.assertMatchesScan('AB{0,1}C')
+        self.assertMatchesScan('A(B)?C')
+        self.assertMatchesScan('AB*C')
+        self.assertMatchesScan('TESCO( EXPRESS)?$')
+
+    def test_character_classes(self):
+        self.assertMatchesScan('[TX]ESCO')
+        self.assertMatchesScan('TFL.GOV')
+        self.assertMatchesScan(r'\d{4}')
+
+    def test_escapes(self):
+        self.assertMatchesScan(r'M\&S SIMPLY')
+        self.assertMatchesScan(r'TFL\.GOV\.UK')
+        self.assertMatchesScan(r'S/MKTS$')
+
+    def test_ignorecase(self):
+        self.assertMatchesScan('tesco stores')
+        self.assertMatchesScan('(?i)Tesco')
+        self.assertMatchesScan('TESCO METRO')
+
+
+class StatsMaintenanceTest(TestCase):
+    date = datetime.date(2014, 6, 2)
+
+    def setUp(self):
+        self.aliases = [
+            Alias.objects.create(alias=name.upper(), counterparty=CounterParty.objects.create(name=name))
+            for name in ('Tesco', 'Sky', 'Landlord')
+        ]
+
+    def write(self, count):
+        transactions = [
+            TransferTransaction(amount=decimal.Decimal(i % 7 - 4).scaleb(-1), counterparty_alias=alias,
+                                date=self.date + datetime.timedelta(days=i), cleared_date=self.date, week=1)
+            for i in range(count) for alias in self.aliases[:i % 3 + 1]
+        ]
+        TransactionWriter(batch_size=4).write(transactions)
+
+    def stats(self):
+        return set(CounterPartyStats.objects.values_list(
+            'counterparty', 'net_amount', 'total_transactions', 'most_recent_transaction'))
+
+    def assertMatchesRebuild(self):
+        incremental = self.stats()
+        rebuild_stats()
+        self.assertEqual(incremental, self.stats())
+
+    def test_deltas(self):
+        self.write(5)
+        self.write(4)
+        self.assertEqual(CounterPartyStats.objects.get(counterparty='Tesco').total_transactions, 9)
+        self.assertMatchesRebuild()
+
+    def test_refresh(self):
+        self.write(6)
+
+        # move an alias, and delete some transactions
+        Alias.objects.filter(pk='SKY').update(counterparty='Landlord')
+        refresh_stats(['Sky', 'Landlord'])
+        delete_transactions(Transaction.objects.filter(date=self.date + datetime.timedelta(days=5)))
+
+        self.assertEqual(CounterPartyStats.objects.get(counterparty='Sky').total_transactions, 0)
+        self.assertMatchesRebuild()
+
+
+class CounterPartyListViewTest(TestCase):
+    def test_without_stats(self):
+        alias = Alias.objects.create(alias='TESCO', counterparty=CounterParty.objects.create(name='Tesco'))
+        TransferTransaction.objects.create(amount=-1, counterparty_alias=alias, date=datetime.date(2014, 6, 2),
+                                           cleared_date=datetime.date(2014, 6, 2), week=1)
+        rebuild_stats()
+
+        # as created in bulk on import, before its transactions are written
+        CounterParty.objects.bulk_create([CounterParty(name='New')])
+
+        response = self.client.get(reverse('counterparty:list'))
+        self.assertEqual([(stats.counterparty.pk, stats.total_transactions)
+                          for stats in response.context['counterparty_stats']], [('Tesco', 1), ('New', 0)])
+        self.assertContains(response, 'New')
+
+
+class CreatePatternedCounterPartyViewTest(TestCase):
+    date = datetime.date(2014, 6, 2)
+
+    def setUp(self):
+        self.shopping = Category.objects.create(name='Shopping')
+        self.groceries = Category.objects.create(name='Groceries')
+
+        for name, alias in (('Shop One', 'SHOP ONE'), ('Shop Two', 'SHOP TWO'), ('Other', 'OTHER')):
+            counterparty = CounterParty.objects.create(name=name, auto_categorise=self.shopping)
+            Alias.objects.create(alias=alias, counterparty=counterparty)
+
+        Category.objects.filter(pk=self.shopping.pk).update(counterparty_count=3)
+
+        self.transactions = {
+            alias: TransferTransaction.objects.create(amount=amount, counterparty_alias_id=alias, category=category,
+                                                      date=self.date, cleared_date=self.date, week=1)
+            for alias, amount, category in (('SHOP ONE', -1, None), ('SHOP TWO', -2, self.shopping),
+                                            ('OTHER', -4, None))
+        }
+        rebuild_stats()
+
+        self.rules = {
+            name: CategoryRule.objects.create(category=self.shopping, counterparty_id=name)
+            for name in ('Shop One', 'Other')
+        }
+
+    def test_merge(self):
+        with mock.patch('counterparty.views.refresh_stats', wraps=refresh_stats) as refresh:
+            response = self.client.post(reverse('counterparty:create'), {
+                'counterparty': 'Shops', 'auto_categorise': self.groceries.pk, 'pattern': '^SHOP '})
+
+        self.assertRedirects(response, reverse('counterparty:detail', args=['Shops']), fetch_redirect_response=False)
+
+        # the counterparties left without aliases are deleted
+        self.assertEqual(set(CounterParty.objects.values_list('pk', flat=True)), {'Shops', 'Other'})
+        self.assertEqual(set(Alias.objects.filter(counterparty='Shops').values_list('pk', flat=True)),
+                         {'SHOP ONE', 'SHOP TWO'})
+
+        self.assertEqual(Category.objects.get(pk=self.shopping.pk).counterparty_count, 1)
+        self.assertEqual(Category.objects.get(pk=self.groceries.pk).counterparty_count, 1)
+
+        # only the uncategorised transactions of the new counterparty are categorised
+        categories = {alias: Transaction.objects.get(pk=transaction.pk).category_id
+                      for alias, transaction in self.transactions.items()}
+        self.assertEqual(categories, {'SHOP ONE': self.groceries.pk, 'SHOP TWO': self.shopping.pk, 'OTHER': None})
+
+        # the rules of the merged counterparties are kept, for the new counterparty
+        self.assertEqual({name: CategoryRule.objects.get(pk=rule.pk).counterparty_id
+                          for name, rule in self.rules.items()}, {'Shop One': 'Shops', 'Other': 'Other'})
+
+        refreshed = set().union(*[set(args[0]) for args, kwargs in refresh.call_args_list])
+        self.assertEqual(refreshed, {'Shop One', 'Shop Two', 'Shops'})
+
+        stats = CounterPartyStats.objects.get(counterparty='Shops')
+        self.assertEqual((stats.net_amount, stats.total_transactions, stats.most_recent_transaction),
+                         (-3, 2, self.date))
+        self.assertEqual(CounterPartyStats.objects.get(counterparty='Other').total_transactions, 1)
@@ -1,31 +1,49 @@
 import re
 
 from django.views.generic import TemplateView, DetailView, ListView, FormView
-from django.db.models import Sum, Count, Max, Avg
+from django.db.models import Sum, Count, Avg
 from django.db import transaction
 from django.contrib import messages
 from django import http
 from django.shortcuts import redirect
 
-from transactions.models import Transaction, Category
+from transactions.models import Transaction, Category, CategoryRule, DataVersion
 from transactions.forms import CategoryForm
-from .models import Alias, CounterParty, Pattern
+from transactions.categorisation import set_category, adjust_usage
+from transactions.loading import load_page
+from transactions.hierarchy import subtree_totals
+from transactions.views import TRANSACTION_PAGE_SIZE, get_transaction_data_url
+from transactions.conditional import ConditionalMixin
+from .models import Alias, CounterParty, CounterPartyStats, Pattern
 from .forms import CreateCounterPartyPatternForm
+from .search import matching_aliases
+from .stats import refresh_stats
 
 
 class CounterPartyListView(ListView):
     model = CounterParty
     template_name = 'counterparty_list.html'
-    context_object_name = 'counterparties'
+    paginate_by = 50
 
     def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(net_amount=Sum('alias__transaction__amount'),
-                         total_transactions=Count('alias__transaction'),
-                         most_recent_transaction=Max('alias__transaction__date'))
-        qs = qs.order_by('-most_recent_transaction')
+        # left joined to the stats, so that counterparties without a stats row are still listed
+        qs = super().get_queryset().select_related('stats', 'auto_categorise')
+        qs = qs.order_by('-stats__most_recent_transaction', '-pk')
         return qs
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['counterparty_stats'] = [self.get_stats(counterparty) for counterparty in context['object_list']]
+        return context
+
+    @staticmethod
+    def get_stats(counterparty):
+        try:
+            return counterparty.stats
+        except CounterPartyStats.DoesNotExist:
+            # counterparties created in bulk have no stats row until their transactions are written
+            return CounterPartyStats(counterparty=counterparty)
+
 
 class InvalidFormDataError(Exception):
     pass
@@ -51,6 +69,7 @@ class CreatePatternedCounterPartyView(FormView):
                     pk=form.cleaned_data['counterparty'],
                     auto_categorise=category
                 )
+                adjust_usage('counterparty_count', {category.pk: 1})
 
                 # create a pattern for this counterparty
                 pattern = form.cleaned_data['pattern']
@@ -68,26 +87,42 @@ class CreatePatternedCounterPartyView(FormView):
                 if invalid_aliases.exists():
                     raise InvalidFormDataError('This pattern matches aliases that already belong to a counterparty')
 
+                # only the counterparties the aliases are taken from can be orphaned by the merge
+                previous_counterparties = list(aliases.values_list('counterparty', flat=True).distinct())
+
                 # update alias counterparties
-                aliases.update(counterparty=counterparty)
+                merged = aliases.update(counterparty=counterparty)
 
                 # update the category on all uncategorised transactions
-                uncategorised_transactions = Transaction.objects.filter(
-                    counterparty_alias__counterparty=counterparty, category=None
-                ).update(
-                    category=category
-                )
+                set_category(Transaction.objects.filter(counterparty_alias__counterparty=counterparty, category=None),
+                             category)
 
-                # delete orphaned counterparties
-                CounterParty.objects.annotate(
-                    num_aliases=Count('alias')
-                ).filter(
-                    num_aliases=0
-                ).delete()
+                # delete orphaned counterparties (in chunks, to keep under the bound parameter limit of SQLite)
+                for i in range(0, len(previous_counterparties), 500):
+                    orphans = CounterParty.objects.filter(
+                        pk__in=previous_counterparties[i:i + 500], alias__isnull=True
+                    ).exclude(
+                        pk=counterparty.pk
+                    )
+
+                    adjust_usage('counterparty_count', {
+                        category_id: -count for category_id, count in orphans.values('auto_categorise').annotate(
+                            count=Count('pk')).values_list('auto_categorise', 'count')
+                    })
+
+                    # the category rules of the merged counterparties apply to the new one instead (rather than being
+                    # deleted with them, or matching every counterparty once theirs was cleared)
+                    CategoryRule.objects.filter(counterparty__in=orphans).update(counterparty=counterparty)
+                    orphans.delete()
+
+                refresh_stats(previous_counterparties + [counterparty.pk])
+
+                # the moved aliases are shown with the transactions of every month
+                DataVersion.bump(shared=True)
 
                 messages.success(
                     self.request,
-                    'Successfully created new counterparty (merged {} existing aliases)'.format(aliases.count())
+                    'Successfully created new counterparty (merged {} existing aliases)'.format(merged)
                 )
                 return http.HttpResponseRedirect(counterparty.get_absolute_url())
         except InvalidFormDataError as exc:
@@ -98,29 +133,43 @@ class CreatePatternedCounterPartyView(FormView):
 class AliasPatternMatchesView(TemplateView):
     template_name = 'alias_pattern_matches.html'
 
+    # Number of matching aliases shown in the preview
+    preview_limit = 50
+
     @staticmethod
     def get_matches(pattern):
-        pks = filter(lambda alias: re.search(pattern, alias, re.IGNORECASE), Alias.objects.values_list('pk', flat=True))
-        return Alias.objects.filter(pk__in=pks)
+        return matching_aliases(pattern)
 
     def get_context_data(self):
+        try:
+            matches = AliasPatternMatchesView.get_matches(self.request.GET['pattern'])
+        except re.error as exc:
+            return {'error': exc}
+
         return {
-            'matches': AliasPatternMatchesView.get_matches(self.request.GET['pattern']).annotate(
-                num_counterparty_aliases=Count('counterparty__alias'))
+            'matches': matches.annotate(
+                num_counterparty_aliases=Count('counterparty__alias')
+            ).select_related('counterparty').order_by('pk')[:self.preview_limit],
+            'total_matches': matches.count(),
         }
 
 
-class CounterPartyDetailView(DetailView):
+class CounterPartyDetailView(ConditionalMixin, DetailView):
     model = CounterParty
     template_name = 'counterparty_detail.html'
     context_object_name = 'counterparty'
 
+    def get_version_keys(self):
+        return [DataVersion.SHARED, DataVersion.counterparty_key(self.kwargs['pk'])]
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         transactions = Transaction.objects.filter(
             counterparty_alias__in=self.object.alias_set.values_list('pk', flat=True))
-        context['transactions'] = transactions.order_by('-date')
+        context['transactions'], cursor = load_page(transactions, TRANSACTION_PAGE_SIZE)
+        context['transactions_next_url'] = get_transaction_data_url(cursor, counterparty=self.object.pk)
         context['metrics'] = transactions.aggregate(sum=Sum('amount'), avg=Avg('amount'), count=Count('amount'))
+        context['category_totals'] = subtree_totals(transactions)
         return context
 
 
@@ -147,10 +196,14 @@ class CategoriseModalView(FormView):
             category = Category.objects.create(name=category)
 
         transactions = Transaction.objects.filter(counterparty_alias__counterparty=self.counterparty, category__isnull=True)
-        transactions.update(category=category)
+        set_category(transactions, category)
+
+        if self.counterparty.auto_categorise_id != category.pk:
+            adjust_usage('counterparty_count', {self.counterparty.auto_categorise_id: -1, category.pk: 1})
 
         self.counterparty.auto_categorise = category
         self.counterparty.save()
+        DataVersion.bump(counterparties=[self.counterparty.pk])
 
         messages.success(self.request, 'Transactions updated successfully')
 
@@ -0,0 +1,62 @@
+import time
+from optparse import make_option
+
+from colorama import Fore, Style
+
+from django import db
+from django.core.management.base import BaseCommand
+
+from transactions.models import Transaction, Category
+from transactions.rules import load_rules, apply_rules
+from cli import console
+
+
+class Command(BaseCommand):
+    help = 'Categorises the transactions already imported by the category rules'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--dry-run', action='store_true',
+                    help='Only report the changes the rules would make, without committing them'),
+        make_option('-a', '--all', action='store_true',
+                    help='Also recategorise transactions that are already categorised'),
+    )
+
+    def handle(self, *args, **options):
+        rules = load_rules()
+        if not rules:
+            print(Fore.YELLOW + 'No category rules defined')
+            return
+
+        transactions = Transaction.objects.all()
+        if not options['all']:
+            transactions = transactions.filter(category=None)
+
+        count = transactions.count()
+        console.stage_print('Applying', str(len(rules)), 'rule(s) to', str(count), 'transaction(s)...')
+
+        with db.transaction.atomic():
+            sid = db.transaction.savepoint()
+
+            start = time.perf_counter()
+            results = apply_rules(transactions, rules)
+            elapsed = time.perf_counter() - start
+
+            names = dict(Category.objects.values_list('pk', 'name'))
+            changed = 0
+
+            for rule, changes in results:
+                print(' -', rule, Style.DIM + '({} transactions)'.format(sum(changes.values())))
+
+                for category_id, moved in sorted(changes.items(), key=lambda item: -item[1]):
+                    print('     ', names.get(category_id, 'uncategorised'), '->', rule.category,
+                          Style.DIM + '({})'.format(moved))
+
+                changed += sum(changes.values())
+
+            print('Categorised', changed, 'transaction(s) in {:.3f}s'.format(elapsed),
+                  Style.DIM + '({:,.0f} rows/s)'.format(count / elapsed if elapsed else 0))
+
+            if options['dry_run']:
+                print(Fore.YELLOW + 'Not committing to database', '(--dry-run specified)')
+                db.transaction.savepoint_rollback(sid)
+            else:
+                db.transaction.savepoint_commit(sid)
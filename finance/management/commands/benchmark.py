@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+from collections import OrderedDict
+from optparse import make_option
+
+from colorama import Style, Fore
+
+from django import db
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from statementimport.santander import SantanderImporter
+from statementimport.synthetic import generate_descriptions, write_statement
+from statementimport.writer import TransactionWriter
+from transactions.models import Category, MonthlyCategoryRollup
+from transactions.hierarchy import month_subtree_totals
+from cli import console
+
+
+# A stage more than this much slower than in the previous run is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+# Fields the Santander processors resolve aliases from
+ALIAS_FIELDS = ('sender', 'recipient', 'counterparty')
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+class Command(BaseCommand):
+    args = '[<suite> ...]'
+    help = 'Runs import benchmarks against synthetic statements'
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--lines', type='int', default=100000, help='Number of lines for the dispatch suite'),
+        make_option('-s', '--sizes', default='1000,10000,100000',
+                    help='Comma separated statement sizes for the import suite'),
+        make_option('-c', '--categories', default='100,500',
+                    help='Comma separated category tree sizes for the closure suite'),
+        make_option('-r', '--results', default=os.path.join(settings.BASE_DIR, 'benchmark_results.jsonl'),
+                    help='File results are appended to and compared against'),
+    )
+
+    suites = ('dispatch', 'import', 'closure')
+
+    def handle(self, *suites, **options):
+        for suite in suites or self.suites:
+            if suite not in self.suites:
+                print(Fore.RED + 'Unknown benchmark suite `{}`'.format(suite))
+                sys.exit(1)
+
+        for suite in suites or self.suites:
+            console.stage_print('Running', suite, 'benchmark...')
+            results = getattr(self, 'bench_' + suite)(**options)
+
+            previous = self.load_previous(options['results'], suite)
+            self.print_results(results, previous)
+            self.save_results(options['results'], suite, results)
+
+    def load_previous(self, path, suite):
+        if not os.path.exists(path):
+            return {}
+
+        previous = {}
+
+        with open(path, 'r') as f:
+            for line in f:
+                run = json.loads(line)
+
+                if run['suite'] == suite:
+                    previous = run['results']
+
+        return previous
+
+    def save_results(self, path, suite, results):
+        with open(path, 'a') as f:
+            f.write(json.dumps({'suite': suite, 'time': datetime.datetime.now().isoformat(), 'results': results}))
+            f.write('\n')
+
+    def print_results(self, results, previous):
+        """
+        Prints the rows per second of each stage at each size, along with the change since the previous run.
+        """
+        for size, stages in sorted(results.items(), key=lambda item: int(item[0])):
+            print(Style.BRIGHT + '{:,} rows'.format(int(size)))
+
+            for stage, elapsed in stages.items():
+                line = '   {:<12} {:>12,.0f} rows/s {}'.format(
+                    stage, int(size) / elapsed, Style.DIM + '({:.3f}s)'.format(elapsed))
+
+                before = previous.get(size, {}).get(stage)
+                if before:
+                    change = (elapsed - before) / before
+                    colour = Fore.RED if change > REGRESSION_THRESHOLD else Fore.GREEN
+                    line += ' ' + Style.RESET_ALL + colour + '{:+.0%} time vs previous run'.format(change)
+
+                print(line)
+
+        print()
+
+    def bench_dispatch(self, lines, **options):
+        """
+        Compares routing statement lines to their processor by scanning `processors` in order (the original
+        implementation) against the first-word dispatch table.
+        """
+        descriptions = [desc for desc, sign in generate_descriptions(lines, datetime.date.today())]
+        processors = SantanderImporter.processors
+
+        def linear_scan(descriptions):
+            results = []
+            for desc in descriptions:
+                for processor_cls in processors:
+                    match = processor_cls.pattern.match(desc)
+                    if match:
+                        results.append((processor_cls, match.groups()))
+                        break
+                else:
+                    results.append(None)
+            return results
+
+        def dispatch(descriptions):
+            results = []
+            for desc in descriptions:
+                processor_cls, match = SantanderImporter.match_processor(desc)
+                if processor_cls:
+                    results.append((processor_cls, match.groups()))
+                else:
+                    results.append(None)
+            return results
+
+        before, expected = timed(linear_scan, descriptions)
+        after, actual = timed(dispatch, descriptions)
+
+        if actual != expected:
+            print(Fore.RED + 'Dispatch results differ from a linear scan of the processors')
+            sys.exit(1)
+
+        return {str(lines): OrderedDict([('linear scan', before), ('dispatch', after)])}
+
+    def bench_import(self, sizes, **options):
+        """
+        Times each stage of importing synthetic statements of each size. Database writes are rolled back.
+        """
+        results = {}
+
+        for size in [int(size) for size in sizes.split(',')]:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'statement.txt')
+
+                with open(path, 'w', encoding='cp1252') as f:
+                    write_statement(f, size)
+
+                results[str(size)] = self.time_import(path)
+
+        return results
+
+    def time_import(self, path):
+        importer = SantanderImporter()
+        stages = OrderedDict()
+
+        stages['parse'], records = timed(lambda: list(importer.parse(path)))
+
+        with db.transaction.atomic():
+            sid = db.transaction.savepoint()
+
+            def resolve_aliases():
+                aliases = importer.aliases
+
+                for processor_name, fields, extra_fields in records:
+                    for field in ALIAS_FIELDS:
+                        if fields.get(field):
+                            aliases.get_or_create(fields[field])
+
+                aliases.flush()
+
+            def validate(transactions):
+                for transaction in transactions:
+                    importer.validate(transaction)
+
+            def write(transactions):
+                writer = TransactionWriter()
+
+                for transaction in transactions:
+                    writer.add(transaction)
+
+                writer.flush()
+
+            # aliases are resolved up front, so that building only measures the processors
+            stages['aliases'], _ = timed(resolve_aliases)
+            stages['build'], transactions = timed(lambda: [importer.create_transaction(record) for record in records])
+            stages['validate'], _ = timed(validate, transactions)
+            stages['write'], _ = timed(write, transactions)
+
+            db.transaction.savepoint_rollback(sid)
+
+        return stages
+
+    def bench_closure(self, categories, **options):
+        """
+        Times maintaining the category closure table and reading subtree totals through it, against walking the
+        tree one level per query, for a deep tree (a single chain) and a wide tree (one root with every other
+        category as its child) of each size. Database writes are rolled back.
+        """
+        results = {}
+
+        for size in [int(size) for size in categories.split(',')]:
+            stages = OrderedDict()
+
+            for shape in ('deep', 'wide'):
+                with db.transaction.atomic():
+                    sid = db.transaction.savepoint()
+
+                    def create():
+                        root = parent = Category.objects.create(name='benchmark {} 0'.format(shape))
+
+                        for i in range(1, size):
+                            category = Category.objects.create(name='benchmark {} {}'.format(shape, i), parent=parent)
+                            if shape == 'deep':
+                                parent = category
+
+                        return root
+
+                    stages[shape + ' create'], root = timed(create)
+
+                    # one transaction's worth of rollup in every category, so each subtree total is its size
+                    MonthlyCategoryRollup.objects.bulk_create([
+                        MonthlyCategoryRollup(year=2000, month=1, category=category, net=1, count=1)
+                        for category in Category.objects.filter(name__startswith='benchmark {} '.format(shape))
+                    ])
+
+                    stages[shape + ' join'], joined = timed(month_subtree_totals, 2000, 1)
+                    stages[shape + ' walk'], walked = timed(self.walk_subtree_total, root)
+
+                    if joined[root.pk] != walked:
+                        print(Fore.RED + 'Closure table totals differ from walking the {} tree'.format(shape))
+                        sys.exit(1)
+
+                    if shape == 'deep':
+                        # move the lower half of the chain to be a second root
+                        middle = Category.objects.get(name='benchmark deep {}'.format(size // 2))
+                        middle.parent = None
+                        stages['deep move'], _ = timed(middle.save)
+
+                    db.transaction.savepoint_rollback(sid)
+
+            results[str(size)] = stages
+
+        return results
+
+    def walk_subtree_total(self, root):
+        """
+        Totals the rollups of `root` and its subcategories the way the tree is walked without a closure table: one
+        query for the categories at each level below the root.
+        """
+        total = 0
+        level = [root.pk]
+
+        while level:
+            next_level = []
+
+            # keep well under the bound parameter limit of SQLite
+            for i in range(0, len(level), 500):
+                chunk = level[i:i + 500]
+                total += sum(MonthlyCategoryRollup.objects.filter(
+                    year=2000, month=1, category__in=chunk).values_list('net', flat=True))
+                next_level.extend(Category.objects.filter(parent__in=chunk).values_list('pk', flat=True))
+
+            level = next_level
+
+        return total
@@ -0,0 +1,27 @@
+import sys
+
+from colorama import Fore
+
+from django.core.management.base import BaseCommand
+
+from transactions.models import DailyBalance
+from transactions.balances import check_balances
+from cli import console
+
+
+class Command(BaseCommand):
+    help = 'Checks that the statement balances are consistent with the transactions imported'
+
+    def handle(self, *args, **options):
+        console.stage_print('Checking', str(DailyBalance.objects.count()), 'daily balance(s)...')
+        problems = 0
+
+        for date, problem in check_balances():
+            print(' -', date.strftime('%d/%m/%Y'), Fore.RED + problem)
+            problems += 1
+
+        if problems:
+            print(Fore.RED + 'Found {} problem(s)'.format(problems))
+            sys.exit(1)
+
+        print(Fore.GREEN + 'No problems found')
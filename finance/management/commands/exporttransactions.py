@@ -0,0 +1,33 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from transactions.models import Transaction
+from transactions.export import EXPORT_CHUNK_SIZE, FORMATS, iter_transactions
+
+
+class Command(BaseCommand):
+    help = 'Writes every transaction, with the fields of its type, its category and counterparty, as CSV or NDJSON'
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--format', choices=list(FORMATS), default='csv', help='Export format (csv or ndjson)'),
+        make_option('-o', '--output', metavar='PATH', help='Write to PATH rather than to standard output'),
+        make_option('-c', '--chunk-size', type='int', default=EXPORT_CHUNK_SIZE,
+                    help='Number of transactions loaded from the database at a time'),
+    )
+
+    def handle(self, *args, **options):
+        iter_lines, content_type, extension = FORMATS[options['format']]
+        transactions = iter_transactions(Transaction.objects.all(), chunk_size=options['chunk_size'])
+
+        if options['output']:
+            f = open(options['output'], 'w', encoding='utf-8', newline='')
+        else:
+            f = sys.stdout
+
+        try:
+            for line in iter_lines(transactions):
+                f.write(line)
+        finally:
+            if f is not sys.stdout:
+                f.close()
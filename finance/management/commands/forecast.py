@@ -0,0 +1,40 @@
+import datetime
+from optparse import make_option
+
+from colorama import Fore, Style
+
+from django.core.management.base import BaseCommand
+
+from transactions.recurring import active_series, forecast
+from cli import console
+
+
+class Command(BaseCommand):
+    help = 'Lists the recurring payments detected and forecasts the balance from them'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--days', type='int', default=90, help='Number of days to forecast'),
+    )
+
+    def handle(self, *args, **options):
+        series = active_series()
+        console.stage_print('Found', str(len(series)), 'active recurring series')
+
+        for s in sorted(series, key=lambda s: s.next_date):
+            print(' -', s, Style.DIM + '({} payments since {}, next {})'.format(
+                s.occurrences, s.first_date.strftime('%d/%m/%Y'), s.next_date.strftime('%d/%m/%Y')))
+
+        start = datetime.date.today()
+        result = forecast(start, start + datetime.timedelta(days=options['days'] - 1))
+
+        console.stage_print('Forecasting', str(options['days']), 'days...')
+
+        for payment in result['payments']:
+            print(' -', payment['date'], '{:>10.2f}'.format(payment['amount']), payment['name'])
+
+        if result['opening']['balance'] is None:
+            print(Fore.YELLOW + 'No balance known to forecast from')
+            return
+
+        closing = result['days'][-1][2]
+        print('Balance of {:.2f} on {} expected to be'.format(result['opening']['balance'], result['opening']['as_of']),
+              (Fore.RED if closing < 0 else Fore.GREEN) + '{:.2f}'.format(closing), 'on', result['end'])
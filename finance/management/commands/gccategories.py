@@ -0,0 +1,77 @@
+from optparse import make_option
+
+from colorama import Fore, Style
+
+from django import db
+from django.db.models import Count
+from django.core.management.base import BaseCommand
+
+from counterparty.models import CounterParty
+from transactions.models import Transaction, Category
+from transactions.categorisation import delete_if_unused
+from cli import console
+
+
+class Command(BaseCommand):
+    help = 'Recounts the usage of every category and deletes categories that are no longer used'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--dry-run', action='store_true', help='Do not commit to database, dry run only'),
+    )
+
+    def handle(self, *args, **options):
+        with db.transaction.atomic():
+            sid = db.transaction.savepoint()
+
+            console.stage_print('Recounting category usage...')
+            corrected = self.recount()
+            print(' -', corrected, 'usage count(s) corrected')
+
+            console.stage_print('Deleting unused categories...')
+            deleted = []
+
+            # deleting a subcategory may leave its parent unused in turn
+            while True:
+                unused = dict(Category.objects.filter(
+                    transaction_count=0, counterparty_count=0, children__isnull=True
+                ).values_list('pk', 'name'))
+
+                deleted_ids = delete_if_unused(list(unused))
+                if not deleted_ids:
+                    break
+
+                deleted.extend(unused[pk] for pk in deleted_ids)
+
+            for name in deleted:
+                print(' -', name)
+            print('Deleted', len(deleted), 'category(s)')
+
+            if options['dry_run']:
+                print(Fore.YELLOW + 'Not committing to database', '(--dry-run specified)')
+                db.transaction.savepoint_rollback(sid)
+            else:
+                db.transaction.savepoint_commit(sid)
+
+    def recount(self):
+        """
+        Sets the usage counts of every category from the transactions and counterparties tables. Returns the number
+        of counts that were wrong.
+        """
+        transaction_counts = dict(Transaction.objects.exclude(category=None).order_by().values('category').annotate(
+            count=Count('pk')).values_list('category', 'count'))
+        counterparty_counts = dict(CounterParty.objects.exclude(auto_categorise=None).values(
+            'auto_categorise').annotate(count=Count('pk')).values_list('auto_categorise', 'count'))
+
+        corrected = 0
+
+        for category in Category.objects.all():
+            counts = (transaction_counts.get(category.pk, 0), counterparty_counts.get(category.pk, 0))
+
+            if counts != (category.transaction_count, category.counterparty_count):
+                print(' -', category, Style.DIM + '({} -> {} transactions, {} -> {} counterparties)'.format(
+                    category.transaction_count, counts[0], category.counterparty_count, counts[1]))
+
+                Category.objects.filter(pk=category.pk).update(transaction_count=counts[0],
+                                                               counterparty_count=counts[1])
+                corrected += 1
+
+        return corrected
@@ -1,4 +1,6 @@
+import os
 import sys
+import json
 import inspect
 from optparse import make_option
 
@@ -6,18 +8,31 @@ from colorama import Style, Fore
 
 from django import db
 from django.core.management.base import BaseCommand
+from django.db.models import Max
 
 from statementimport.importer import BaseImporter
+from statementimport.parallel import expand_paths, parse_statements
+from statementimport.profiling import Profiler
+from statementimport.writer import TransactionWriter
+from transactions.models import Transaction
+from transactions.snapshot import Snapshot, refresh_snapshot
+from transactions.recurring import update_recurring
 from cli import console
 
 
 class Command(BaseCommand):
-    args = '<importer> <input_path>'
+    args = '<importer> <input_path> [<input_path> ...]'
     option_list = BaseCommand.option_list + (
         make_option('-d', '--dry-run', action='store_true', help='Do not commit to database, dry run only'),
+        make_option('-b', '--batch-size', type='int', default=500, help='Number of transactions written per batch'),
+        make_option('-j', '--jobs', type='int', default=os.cpu_count() or 1,
+                    help='Number of processes parsing statements when importing several files'),
+        make_option('-p', '--profile', action='store_true',
+                    help='Report the time, calls and SQL queries of each import stage and processor'),
+        make_option('--profile-json', metavar='PATH', help='Also write the --profile report to PATH as JSON'),
     )
 
-    def handle(self, importer, input_path, **options):
+    def handle(self, importer, *input_paths, **options):
         # Attempt to import the module
         module_name, importer_name = importer.split('.', 1)
         module = getattr(__import__('statementimport', fromlist=[module_name]), module_name)
@@ -44,16 +59,118 @@ class Command(BaseCommand):
 
         console.stage_print('Using importer', importer_name, '...')
 
-        # Begin import
-        sid = db.transaction.savepoint()
+        paths = expand_paths(importer.__class__, input_paths)
+        if not paths:
+            print(Fore.RED + 'No statements found')
+            sys.exit(1)
+
+        profiler = None
+        if options['profile'] or options['profile_json']:
+            if options['jobs'] > 1:
+                # stages run in worker processes could not be recorded
+                print(Fore.YELLOW + 'Parsing in a single process', '(--profile specified)')
+                options['jobs'] = 1
+
+            profiler = importer.profiler = Profiler()
+
+        # the debug cursor enabled by the profiler is disabled again however the import ends
+        try:
+            console.stage_print('Importing', str(len(paths)), 'statement(s)...')
+            failures = []
+
+            # transactions written by this import are given greater ids
+            after_id = Transaction.base_objects.aggregate(max_id=Max('id'))['max_id'] or 0
+
+            # Begin import (savepoints only take effect inside a transaction)
+            with db.transaction.atomic():
+                sid = db.transaction.savepoint()
+
+                writer = TransactionWriter(batch_size=options['batch_size'], profiler=importer.profiler,
+                                           importer=importer)
+
+                for index, (path, records, error) in enumerate(parse_statements(importer, paths, options['jobs']), 1):
+                    progress = '[{}/{}]'.format(index, len(paths))
+
+                    if error is None:
+                        # each statement is written under its own savepoint, so a bad file does not abort the others
+                        file_sid = db.transaction.savepoint()
+                        written, skipped = writer.written, writer.skipped
+
+                        try:
+                            for record in records:
+                                writer.add(importer.build(record))
+
+                            writer.flush()
+                        except Exception as exc:
+                            db.transaction.savepoint_rollback(file_sid)
+                            writer.discard()
+                            writer.written, writer.skipped = written, skipped
+                            importer.reset_aliases()
+                            error = '{}: {}'.format(exc.__class__.__name__, exc)
+                        else:
+                            db.transaction.savepoint_commit(file_sid)
+
+                    if error is None:
+                        print(' -', progress, path, Style.DIM + '({} transactions, {} already imported)'.format(
+                            writer.written - written, writer.skipped - skipped))
+                    else:
+                        print(' -', progress, path, Fore.RED + 'failed: ' + error)
+                        failures.append(path)
+
+                print('Imported', writer.written, 'transactions from', len(paths) - len(failures), 'statement(s)',
+                      '(skipped {} already imported)'.format(writer.skipped))
+
+                if options['dry_run']:
+                    print(Fore.YELLOW + 'Not committing to database', '(--dry-run specified)')
+                    db.transaction.savepoint_rollback(sid)
+                else:
+                    print('Committing... ', end='')
+                    db.transaction.savepoint_commit(sid)
+
+            if not options['dry_run']:
+                print(Fore.GREEN + 'done')
+
+                console.stage_print('Updating analytics snapshot...')
+                rebuilt, rows = refresh_snapshot()
+                print(' -', 'rebuilt with' if rebuilt else 'appended', rows, 'rows')
+
+                if writer.written:
+                    console.stage_print('Detecting recurring payments...')
+
+                    with db.transaction.atomic():
+                        checked, detected = update_recurring(Snapshot.load(), after_id)
+
+                    print(' -', 'checked', checked, 'series,', detected, 'recurring')
+        finally:
+            if profiler is not None:
+                profiler.finish()
+
+        if profiler is not None:
+            self.print_profile(profiler)
+
+            if options['profile_json']:
+                with open(options['profile_json'], 'w') as f:
+                    json.dump(profiler.as_dict(), f, indent=2)
+
+        if failures:
+            print(Fore.RED + 'Failed to import {} statement(s):'.format(len(failures)))
+            for path in failures:
+                print(' -', path)
+            sys.exit(1)
+
+    def print_profile(self, profiler):
+        """
+        Prints the figures of each profiled stage. Nested stages are also included in their outer stage's time.
+        """
+        console.stage_print('Profile', '({:.3f}s total)'.format(profiler.elapsed))
+
+        for group, stages in profiler.groups().items():
+            print(Style.BRIGHT + '   {:<28} {:>9} {:>10} {:>10} {:>7} {:>9} {:>9}'.format(
+                group, 'calls', 'total', 'per call', 'share', 'queries', 'sql'))
 
-        for transaction in importer.process(input_path):
-            transaction.save()
+            for name, stats in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+                print('   {:<28} {:>9,} {:>9.3f}s {:>8.1f}us {:>7.1%} {:>9,} {:>8.3f}s'.format(
+                    name, stats['calls'], stats['seconds'], stats['seconds'] / stats['calls'] * 1e6,
+                    stats['seconds'] / profiler.elapsed, stats['queries'], stats['sql_seconds']))
 
-        if options['dry_run']:
-            print(Fore.YELLOW + 'Not committing to database', '(--dry-run specified)')
-            db.transaction.savepoint_rollback(sid)
-        else:
-            print('Committing... ', end='')
-            db.transaction.savepoint_commit(sid)
-            print(Fore.GREEN + 'done')
+        print()
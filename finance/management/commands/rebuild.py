@@ -0,0 +1,74 @@
+import sys
+import time
+
+from colorama import Fore
+
+from django import db
+from django.core.management.base import BaseCommand
+
+from counterparty.models import Alias, AliasTrigram, CounterPartyStats
+from counterparty.stats import rebuild_stats
+from transactions.models import CategoryClosure, MonthlyCategoryRollup, DailyBalance, RecurringSeries
+from transactions.balances import rebuild_daily_balances
+from transactions.hierarchy import rebuild_closure
+from transactions.rollups import rebuild_rollups
+from transactions.snapshot import Snapshot, rebuild_snapshot, refresh_snapshot
+from transactions.recurring import update_recurring
+from statementimport.util import backfill_fingerprints
+from cli import console
+
+
+class Command(BaseCommand):
+    args = '[<target> ...]'
+    help = 'Rebuilds derived tables from scratch'
+
+    targets = ('fingerprints', 'trigrams', 'rollups', 'stats', 'closure', 'balances', 'snapshot', 'recurring')
+
+    def handle(self, *targets, **options):
+        for target in targets or self.targets:
+            if target not in self.targets:
+                print(Fore.RED + 'Unknown rebuild target `{}`'.format(target))
+                sys.exit(1)
+
+        for target in targets or self.targets:
+            console.stage_print('Rebuilding', target, '...')
+            start = time.perf_counter()
+
+            with db.transaction.atomic():
+                count = getattr(self, 'rebuild_' + target)()
+
+            print(' -', count, 'rows in {:.3f}s'.format(time.perf_counter() - start))
+
+    def rebuild_fingerprints(self):
+        return backfill_fingerprints()
+
+    def rebuild_trigrams(self):
+        AliasTrigram.objects.all().delete()
+
+        aliases = list(Alias.objects.only('pk'))
+        AliasTrigram.index(aliases)
+        return AliasTrigram.objects.count()
+
+    def rebuild_rollups(self):
+        rebuild_rollups()
+        return MonthlyCategoryRollup.objects.count()
+
+    def rebuild_stats(self):
+        rebuild_stats()
+        return CounterPartyStats.objects.count()
+
+    def rebuild_closure(self):
+        rebuild_closure()
+        return CategoryClosure.objects.count()
+
+    def rebuild_balances(self):
+        rebuild_daily_balances()
+        return DailyBalance.objects.count()
+
+    def rebuild_snapshot(self):
+        return rebuild_snapshot()
+
+    def rebuild_recurring(self):
+        refresh_snapshot()
+        update_recurring(Snapshot.load())
+        return RecurringSeries.objects.count()
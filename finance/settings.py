@@ -80,6 +80,27 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/1.7/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+
+    # rendered transaction table rows, used by the `cache` template tag
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template_fragments',
+        'OPTIONS': {
+            # a quarter of the rows are evicted whenever the cache is full
+            'MAX_ENTRIES': 20000,
+            'CULL_FREQUENCY': 4,
+        },
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -108,6 +129,11 @@ TEMPLATE_DIRS = (
 )
 
 
+# Columnar snapshot of the transactions for analytics, see `transactions.snapshot`
+
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'snapshot')
+
+
 # Crispy forms
 
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
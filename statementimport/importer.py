@@ -1,63 +1,235 @@
+import re
+import sre_parse
 from datetime import datetime
 
-from .util import parse_currency
+from .profiling import NULL_PROFILER
+from .util import parse_currency, AliasResolver
 
 
 class StatementImportError(Exception):
     pass
 
 
+def _expand_prefixes(items, partials):
+    """
+    Extends each string in `partials` with the literals at the start of the parsed regex `items`. Returns a tuple of
+    (prefixes that reached a space, prefixes still open at the end of `items`), or None if some path through `items`
+    starts with something other than a literal before reaching a space.
+    """
+    done = set()
+
+    for op, av in items:
+        if not partials:
+            break
+
+        if op == sre_parse.LITERAL:
+            partials = {partial + chr(av) for partial in partials}
+        elif op == sre_parse.AT:
+            continue
+        elif op == sre_parse.SUBPATTERN:
+            expanded = _expand_prefixes(av[-1], partials)
+            if expanded is None:
+                return None
+            done |= expanded[0]
+            partials = expanded[1]
+        elif op == sre_parse.BRANCH:
+            branch_partials = set()
+            for branch in av[1]:
+                expanded = _expand_prefixes(branch, partials)
+                if expanded is None:
+                    return None
+                done |= expanded[0]
+                branch_partials |= expanded[1]
+            partials = branch_partials
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[:2] == (0, 1):
+            expanded = _expand_prefixes(av[2], partials)
+            if expanded is None:
+                return None
+            done |= expanded[0]
+            partials = partials | expanded[1]
+        else:
+            return None
+
+        done |= {partial for partial in partials if partial.endswith(' ')}
+        partials = {partial for partial in partials if not partial.endswith(' ')}
+
+    return done, partials
+
+
+def first_words(pattern):
+    """
+    Returns the set of words a line must start with (up to its first space) for `pattern` to match it, or None if
+    the pattern does not begin with a literal word.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+
+    expanded = _expand_prefixes(sre_parse.parse(pattern.pattern), {''})
+    if expanded is None or expanded[1]:
+        return None
+
+    return {prefix.split(' ', 1)[0] for prefix in expanded[0]}
+
+
 class BaseImporter:
     name = None
     processors = []
 
-    def process(self, path):
+    # File extensions picked up when a directory of statements is imported, or None for every file
+    file_extensions = None
+
+    # Built by `processor` as each processor class is registered. Maps the first word of a line to the processors
+    # that could possibly match it, in registration order, so each line is only tried against the one or two
+    # processors sharing its leading word rather than every registered processor. Processors whose pattern does not
+    # begin with a literal word are merged into every entry, and make up `dispatch_default` for unknown words.
+    dispatch_table = {}
+    dispatch_default = ()
+    processors_by_name = {}
+
+    # Replaced with a `Profiler` to record the time spent in each stage of an import
+    profiler = NULL_PROFILER
+
+    def __init__(self):
+        self._aliases = None
+
+    @property
+    def aliases(self):
+        # created on first use, so that importers used only to parse statements never touch the database
+        if self._aliases is None:
+            self._aliases = AliasResolver()
+
+        return self._aliases
+
+    def reset_aliases(self):
+        """
+        Discards any unflushed aliases, reloading them from the database when next needed.
+        """
+        self._aliases = None
+
+    def parse(self, path):
+        """
+        Yields a record for each transaction in the statement at `path`. Records are plain (processor name, fields,
+        extra fields) tuples built without touching the database, so statements can be parsed in worker processes.
+        """
         raise NotImplementedError()
 
+    def build(self, record):
+        """
+        Builds and validates the transaction described by a record from `parse`.
+        """
+        transaction = self.create_transaction(record)
+        self.validate(transaction)
+        return transaction
+
+    def create_transaction(self, record):
+        processor_name, fields, extra_fields = record
+
+        with self.profiler.stage(processor_name, group='processors'):
+            transaction = self.processors_by_name[processor_name](self, fields, extra_fields).transaction
+
+        if not transaction.date:
+            transaction.date = transaction.cleared_date
+
+        transaction.week = transaction.date.isocalendar()[1]
+        return transaction
+
+    def validate(self, transaction):
+        # aliases are created in bulk once the import has been processed, so relations are not validated here
+        with self.profiler.stage('full_clean'):
+            transaction.full_clean(exclude=('counterparty_alias', 'category'))
+
+    def process(self, path):
+        for record in self.parse(path):
+            yield self.build(record)
+
+        self.aliases.flush()
+
     def process_line(self, line, **extra_fields):
-        for processor_cls in self.processors:
+        processor_cls, match = self.match_processor(line)
+
+        if processor_cls is None:
+            return None
+
+        return processor_cls(self, processor_cls.parse(match, extra_fields, self.profiler), extra_fields)
+
+    @classmethod
+    def match_processor(cls, line):
+        """
+        Returns a tuple of the first registered processor class whose pattern matches `line` and its match object,
+        or (None, None) if no processor matches.
+        """
+        for processor_cls in cls.dispatch_table.get(line.split(' ', 1)[0], cls.dispatch_default):
             match = processor_cls.pattern.match(line)
 
-            if not match:
-                continue
+            if match:
+                return processor_cls, match
 
-            return processor_cls(match, line, extra_fields)
+        return None, None
 
     @classmethod
     def processor(cls, processor_cls):
+        # each importer gets its own list, rather than appending to the one inherited from `BaseImporter`
+        if 'processors' not in cls.__dict__:
+            cls.processors = list(cls.processors)
+
         cls.processors.append(processor_cls)
+        cls.processors_by_name = {processor_cls.__name__: processor_cls for processor_cls in cls.processors}
+        cls.build_dispatch_table()
         return processor_cls
 
+    @classmethod
+    def build_dispatch_table(cls):
+        words = [(processor_cls, first_words(processor_cls.pattern)) for processor_cls in cls.processors]
+        all_words = set().union(*[processor_words for _, processor_words in words if processor_words])
+
+        cls.dispatch_table = {
+            word: tuple(processor_cls for processor_cls, processor_words in words
+                        if processor_words is None or word in processor_words)
+            for word in all_words
+        }
+        cls.dispatch_default = tuple(processor_cls for processor_cls, processor_words in words
+                                     if processor_words is None)
+
 
 class BaseProcessor:
     transaction_class = None
     pattern = None
 
-    def __init__(self, match, line, extra_fields):
-        self.match = match
-        self.line = line
+    def __init__(self, importer, fields, extra_fields):
+        self.importer = importer
         self.transaction = None
-        self.process(extra_fields)
+        self.process(fields, extra_fields)
 
-    def process(self, extra_fields):
-        groups = self.match.groupdict()
+    @classmethod
+    def parse(cls, match, extra_fields, profiler=NULL_PROFILER):
+        """
+        Returns the fields matched by `pattern`, converted to Python values and merged with `extra_fields`.
+        """
         fields = extra_fields.copy()
 
-        for group, value in groups.items():
+        for group, value in match.groupdict().items():
             if value is not None:
                 if group.startswith('date'):
-                    try:
-                        value = datetime.strptime(value, '%d-%m-%Y')
-                    except ValueError:
-                        value = datetime.strptime(value, '%Y-%m-%d')
+                    with profiler.stage('strptime'):
+                        try:
+                            value = datetime.strptime(value, '%d-%m-%Y')
+                        except ValueError:
+                            value = datetime.strptime(value, '%Y-%m-%d')
                 elif group == 'amount':
                     value = parse_currency(value)
 
             fields[group] = value
 
-        transaction_fields = extra_fields
+        return fields
+
+    def process(self, fields, extra_fields):
+        transaction_fields = extra_fields.copy()
         transaction_fields.update(self.clean_fields(fields))
         self.transaction = self.transaction_class(**transaction_fields)
 
     def clean_fields(self, fields):
         return fields
+
+    def get_alias(self, alias_name):
+        with self.importer.profiler.stage('get_or_create_alias'):
+            return self.importer.aliases.get_or_create(alias_name)
@@ -0,0 +1,63 @@
+import os
+import glob
+import multiprocessing
+
+import django
+
+
+def expand_paths(importer_cls, input_paths):
+    """
+    Expands directories and glob patterns in `input_paths` into a sorted list of statement files. Directories are
+    searched recursively for files with one of the importer's `file_extensions`.
+    """
+    paths = []
+
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            found = []
+            for root, dirs, files in os.walk(input_path):
+                for name in files:
+                    if importer_cls.file_extensions is None or name.lower().endswith(importer_cls.file_extensions):
+                        found.append(os.path.join(root, name))
+            paths.extend(sorted(found))
+        elif glob.has_magic(input_path):
+            paths.extend(sorted(path for path in glob.glob(input_path) if os.path.isfile(path)))
+        else:
+            paths.append(input_path)
+
+    # drop duplicates, keeping the first occurrence so that the order of `input_paths` is preserved
+    seen = set()
+    return [path for path in paths if not (path in seen or seen.add(path))]
+
+
+def parse_statement(job):
+    """
+    Parses every record of one statement in a worker process. Returns a tuple of (path, records, error).
+    """
+    importer_cls, path = job
+
+    try:
+        return path, list(importer_cls().parse(path)), None
+    except Exception as exc:
+        return path, None, '{}: {}'.format(exc.__class__.__name__, exc)
+
+
+def parse_statements(importer, paths, jobs):
+    """
+    Yields a (path, records, error) tuple for each statement in `paths`, in order.
+
+    With more than one job, statements are parsed in a pool of worker processes and their records sent back to the
+    caller, which remains the only process writing to the database. Otherwise records are parsed lazily in this
+    process as they are consumed, and any error is raised from the records iterator.
+    """
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield path, importer.parse(path), None
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(paths)), initializer=django.setup)
+
+    try:
+        yield from pool.imap(parse_statement, [(importer.__class__, path) for path in paths])
+    finally:
+        pool.terminate()
@@ -0,0 +1,92 @@
+import time
+from collections import OrderedDict
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+class NullProfiler:
+    """
+    Profiler used when profiling is disabled. Stages cost a single method call and record nothing.
+    """
+
+    def stage(self, name, group='stages'):
+        return _NULL_STAGE
+
+
+class _NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+NULL_PROFILER = NullProfiler()
+
+
+class _Stage:
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+
+    def __enter__(self):
+        self.queries = len(self.profiler.connection.queries)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        queries = self.profiler.connection.queries[self.queries:]
+
+        stats = self.profiler.stats.get(self.key)
+        if stats is None:
+            stats = self.profiler.stats[self.key] = OrderedDict(
+                [('calls', 0), ('seconds', 0.0), ('queries', 0), ('sql_seconds', 0.0)])
+
+        stats['calls'] += 1
+        stats['seconds'] += elapsed
+        stats['queries'] += len(queries)
+        stats['sql_seconds'] += sum(float(query['time']) for query in queries)
+
+
+class Profiler:
+    """
+    Records the wall time, number of calls, SQL queries and SQL time of each stage of an import.
+
+    Stages are entered with `with profiler.stage(name):` and are grouped (e.g. into 'stages' and 'processors') in the
+    summary. Stages may be nested, in which case the outer stage's figures include the inner stage's. SQL queries
+    are counted through the connection's debug cursor, which is enabled until `finish` is called; Django only logs
+    query times to the millisecond, so SQL time is approximate for very fast queries.
+    """
+
+    def __init__(self, using=None):
+        self.connection = connections[using or DEFAULT_DB_ALIAS]
+        self.stats = OrderedDict()
+
+        self.use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+    def stage(self, name, group='stages'):
+        return _Stage(self, (group, name))
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+        self.connection.use_debug_cursor = self.use_debug_cursor
+
+    def groups(self):
+        """
+        Returns an OrderedDict mapping each group to an OrderedDict of its stages' figures, in the order they were
+        first entered.
+        """
+        groups = OrderedDict()
+
+        for (group, name), stats in self.stats.items():
+            groups.setdefault(group, OrderedDict())[name] = stats
+
+        return groups
+
+    def as_dict(self):
+        return OrderedDict([('seconds', self.elapsed), ('groups', self.groups())])
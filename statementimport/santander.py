@@ -5,21 +5,25 @@ from datetime import datetime
 
 from transactions.models import *
 from .importer import BaseImporter, BaseProcessor, StatementImportError
-from .util import parse_currency, get_or_create_alias
+from .util import parse_currency, fingerprint
 
 
 class SantanderImporter(BaseImporter):
     name = 'text'
     description = 'Imports Santander UK statements from .txt files'
 
-    def process(self, path):
-        with open(path, 'r', encoding='cp1252') as f:
-            yield from self.process_file(f.readlines())
-
+    file_extensions = ('.txt',)
 
-    def process_file(self, lines):
-        raw_transactions = []
+    def parse(self, path):
+        # the file is iterated lazily, so transactions are yielded while the rest of the statement is still unread
+        with open(path, 'r', encoding='cp1252') as f:
+            yield from self.parse_file(f)
 
+    def read_blocks(self, lines):
+        """
+        Yields a dict of the fields in each transaction block of `lines` as soon as the blank line ending the block
+        has been read.
+        """
         passed_header = False
         parsing = {}
 
@@ -36,40 +40,47 @@ class SantanderImporter(BaseImporter):
 
             if not line:
                 if parsing:
-                    raw_transactions.append(parsing)
+                    yield parsing
                     parsing = {}
                 continue
 
             key, value = line.split(': ')
 
             if key == 'Date':
-                value = datetime.strptime(value, '%d/%m/%Y')
+                with self.profiler.stage('strptime'):
+                    value = datetime.strptime(value, '%d/%m/%Y')
             elif key in ('Amount', 'Balance'):
                 value = parse_currency(value)
 
             parsing[key] = value
 
-        raw_transactions.append(parsing)
+        # the last block is not always followed by a blank line
+        if parsing:
+            yield parsing
 
-        for transaction_info in raw_transactions:
+    def parse_file(self, lines):
+        for transaction_info in self.read_blocks(lines):
             desc = transaction_info['Description']
 
             if desc.endswith('FEE'):
                 # TODO: fee handling
                 continue
 
-            processed = self.process_line(desc, amount=transaction_info['Amount'],
-                                          cleared_date=transaction_info['Date'])
-            if not processed:
-                raise StatementImportError('unmatched transaction {!r}'.format(desc))
-
-            if not processed.transaction.date:
-                processed.transaction.date = processed.transaction.cleared_date
+            with self.profiler.stage('regex'):
+                processor_cls, match = self.match_processor(desc)
 
-            processed.transaction.week = processed.transaction.date.isocalendar()[1]
+            if not processor_cls:
+                raise StatementImportError('unmatched transaction {!r}'.format(desc))
 
-            processed.transaction.full_clean()
-            yield processed.transaction
+            extra_fields = {
+                'amount': transaction_info['Amount'],
+                'cleared_date': transaction_info['Date'],
+                'description': desc,
+                'balance': transaction_info.get('Balance'),
+                'fingerprint': fingerprint(transaction_info['Date'], transaction_info['Amount'], desc,
+                                           transaction_info.get('Balance')),
+            }
+            yield processor_cls.__name__, processor_cls.parse(match, extra_fields, self.profiler), extra_fields
 
 
 @SantanderImporter.processor
@@ -89,7 +100,7 @@ class BillPaymentCreditProcessor(BaseProcessor):
     pattern = re.compile(r'BILL PAYMENT FROM (?P<sender>.+), REFERENCE (?P<ref>.+)')
 
     def clean_fields(self, fields):
-        alias = get_or_create_alias(fields['sender'])
+        alias = self.get_alias(fields['sender'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
@@ -105,7 +116,7 @@ class BillPaymentDebitProcessor(BaseProcessor):
         r'BILL PAYMENT (VIA FASTER PAYMENT )?TO (?P<recipient>.+?) (REFERENCE (?P<ref>.+?))? ?(, MANDATE NO (?P<mandate>\d+))?$')
 
     def clean_fields(self, fields):
-        alias = get_or_create_alias(fields['recipient'])
+        alias = self.get_alias(fields['recipient'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
@@ -122,7 +133,7 @@ class CardPaymentProcessor(BaseProcessor):
         r'CARD PAYMENT TO (?P<recipient>.+)(,(?P<requested_amount>\d+\.\d{2}) (?P<currency>.{3}), RATE (?P<rate>\d+.\d{2})/GBP ON (?P<date>\d{2}-\d{2}-\d{4})( NON-STERLING (.+))?| ON (?P<date2>\d{4}-\d{2}-\d{2}))')
 
     def clean_fields(self, fields):
-        recipient = get_or_create_alias(fields['recipient'])
+        recipient = self.get_alias(fields['recipient'])
         return {
             'counterparty_alias': recipient,
             'category': recipient.counterparty.auto_categorise,
@@ -139,7 +150,7 @@ class BankGiroCreditProcessor(BaseProcessor):
     pattern = re.compile(r'BANK GIRO CREDIT REF (?P<sender>.+), (?P<ref>.+)')
 
     def clean_fields(self, fields):
-        alias = get_or_create_alias(fields['sender'])
+        alias = self.get_alias(fields['sender'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
@@ -154,7 +165,7 @@ class FasterPaymentProcessor(BaseProcessor):
     pattern = re.compile(r'FASTER PAYMENTS RECEIPT REF.(?P<ref>.+) FROM (?P<sender>.+)')
 
     def clean_fields(self, fields):
-        alias = get_or_create_alias(fields['sender'])
+        alias = self.get_alias(fields['sender'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
@@ -169,7 +180,7 @@ class CreditProcessor(BaseProcessor):
     pattern = re.compile(r'CREDIT FROM (?P<sender>.+) ON (?P<date>\d{4}-\d{2}-\d{2})')
 
     def clean_fields(self, fields):
-        alias = get_or_create_alias(fields['sender'])
+        alias = self.get_alias(fields['sender'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
@@ -185,7 +196,7 @@ class DirectDebitProcessor(BaseProcessor):
 
     def clean_fields(self, fields):
         assert fields['amount'] < 0
-        alias = get_or_create_alias(fields['recipient'])
+        alias = self.get_alias(fields['recipient'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
@@ -201,7 +212,7 @@ class TransferProcessor(BaseProcessor):
     pattern = re.compile(r'TRANSFER (TO|FROM) (?P<counterparty>.+)')
 
     def clean_fields(self, fields):
-        alias = get_or_create_alias(fields['counterparty'])
+        alias = self.get_alias(fields['counterparty'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise
@@ -212,7 +223,7 @@ class TransferProcessor(BaseProcessor):
 class RegularTransferProcessor(BaseProcessor):
     transaction_class = RegularTransferTransaction
     pattern = re.compile(
-        r'REGULAR TRANSFER PAYMENT TO ACCOUNT (?P<sortcode>\d{6}) (?P<account>\d{8}), MANDATE NO (?P<mandate>\d+)')
+        r'REGULAR TRANSFER PAYMENT TO ACCOUNT (?P<sortcode>\d{6}) (?P<account_number>\d{8}), MANDATE NO (?P<mandate>\d+)')
 
 
 @SantanderImporter.processor
@@ -239,7 +250,7 @@ class StandingOrderProcessor(BaseProcessor):
 
     def clean_fields(self, fields):
         assert fields['amount'] < 0
-        alias = get_or_create_alias(fields['recipient'])
+        alias = self.get_alias(fields['recipient'])
         return {
             'counterparty_alias': alias,
             'category': alias.counterparty.auto_categorise,
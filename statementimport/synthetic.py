@@ -0,0 +1,126 @@
+import random
+import datetime
+import decimal
+
+
+# One template per processor in `santander`, weighted roughly by how often each turns up in a real statement.
+# Templates are formatted with a dict of random values (see `_template_values`); the second element is the sign of
+# the amount the statement would carry for that kind of line.
+SANTANDER_TEMPLATES = (
+    (30, 'CARD PAYMENT TO {merchant} ON {iso_date}', -1),
+    (3, 'CARD PAYMENT TO {merchant},{requested} USD, RATE 1.{rate}/GBP ON {date}', -1),
+    (4, 'CASH WITHDRAWAL AT {bank}, {area},{requested} GBP , ON {date}', -1),
+    (5, 'DIRECT DEBIT PAYMENT TO {company} REF {ref}, MANDATE NO {mandate}', -1),
+    (1, 'PAID TRANSACTION DIRECT DEBIT PAYMENT TO {company} REF {ref}, MANDATE NO {mandate}', -1),
+    (3, 'BILL PAYMENT VIA FASTER PAYMENT TO {person} REFERENCE {ref} , MANDATE NO {mandate}', -1),
+    (1, 'BILL PAYMENT TO {person} REFERENCE {ref}', -1),
+    (1, 'BILL PAYMENT FROM {person}, REFERENCE {ref}', 1),
+    (2, 'STANDING ORDER VIA FASTER PAYMENT TO {person} REFERENCE {ref} , MANDATE NO {mandate}', -1),
+    (2, 'FASTER PAYMENTS RECEIPT REF.{ref} FROM {person}', 1),
+    (1, 'BANK GIRO CREDIT REF {company}, {ref}', 1),
+    (1, 'CREDIT FROM {company} ON {iso_date}', 1),
+    (2, 'TRANSFER TO {person}', -1),
+    (1, 'TRANSFER FROM {person}', 1),
+    (1, 'REGULAR TRANSFER PAYMENT TO ACCOUNT {sortcode} {account}, MANDATE NO {mandate}', -1),
+    (1, 'CASH PAID IN AT {area}', 1),
+    (1, 'INTEREST PAID AFTER TAX {tax} DEDUCTED', 1),
+)
+
+MERCHANTS = ('TESCO STORES 2045', 'SAINSBURYS S/MKTS', 'AMAZON UK MARKETPLACE', 'TFL.GOV.UK/CP', 'PRET A MANGER',
+             'M&amp;S SIMPLY FOOD', 'CAFFE NERO', 'BOOTS 1132', 'WAITROSE 694', 'STEAM GAMES', 'JOHN LEWIS')
+COMPANIES = ('BRITISH GAS', 'THAMES WATER', 'SKY DIGITAL', 'VIRGIN MEDIA', 'COUNCIL TAX', 'ACME LTD',
+             'O2 UK LTD', 'PAYPAL', 'AVIVA INSURANCE')
+PEOPLE = ('J SMITH', 'MR A JONES', 'MISS K BROWN', 'SAVINGS ACCOUNT', 'D PATEL &amp; CO', 'R WILLIAMS')
+BANKS = ('LLOYDS BANK PLC', 'SANTANDER', 'BARCLAYS', 'HSBC', 'NATWEST')
+AREAS = ('HIGH STREET', 'OXFORD STREET', 'KINGS CROSS', 'CAMDEN TOWN', 'CLAPHAM JUNCTION')
+
+# Fee lines are skipped by the importer, but still make up part of a real statement
+FEE_DESCRIPTIONS = ('NON-STERLING TRANSACTION FEE', 'NON-STERLING CASH FEE')
+FEE_RATE = 0.01
+
+
+def _template_values(rng, date):
+    return {
+        'merchant': rng.choice(MERCHANTS),
+        'company': rng.choice(COMPANIES),
+        'person': rng.choice(PEOPLE),
+        'bank': rng.choice(BANKS),
+        'area': rng.choice(AREAS),
+        'ref': '{:06d}'.format(rng.randrange(1000000)),
+        'mandate': rng.randrange(1, 200),
+        'requested': '{}.00'.format(rng.choice((10, 20, 30, 50, 100))),
+        'rate': '{:02d}'.format(rng.randrange(100)),
+        'sortcode': '{:06d}'.format(rng.randrange(1000000)),
+        'account': '{:08d}'.format(rng.randrange(100000000)),
+        'tax': '{}.{:02d}'.format(rng.randrange(5), rng.randrange(100)),
+        'date': date.strftime('%d-%m-%Y'),
+        'iso_date': date.strftime('%Y-%m-%d'),
+    }
+
+
+def generate_descriptions(count, date, seed=0, rng=None):
+    """
+    Yields `count` (description, sign) pairs in the format of Santander statement descriptions, one for every
+    kind of line the Santander processors recognise. Output is deterministic for a given `seed`.
+    """
+    rng = rng or random.Random(seed)
+    weights = [weight for weight, template, sign in SANTANDER_TEMPLATES]
+    total = sum(weights)
+
+    for _ in range(count):
+        pick = rng.randrange(total)
+
+        for weight, template, sign in SANTANDER_TEMPLATES:
+            if pick < weight:
+                break
+
+            pick -= weight
+
+        yield template.format(**_template_values(rng, date)), sign
+
+
+def _format_amount(rng, amount):
+    # Santander pads values with non-breaking spaces, and some exports carry a currency suffix
+    if rng.random() < 0.5:
+        return '\xa0{:,.2f}\xa0'.format(amount)
+
+    return '\xa0{:,.2f} GBP\xa0'.format(amount)
+
+
+def write_statement(f, count, end_date=None, per_day=3, seed=0):
+    """
+    Writes a synthetic Santander text statement of `count` transactions to the file object `f`, which should be
+    opened with the cp1252 encoding used by real exports.
+
+    Transactions are written newest first, `per_day` to a day, ending at `end_date` (today by default), with a
+    consistent running balance. Descriptions cover every Santander processor and include HTML entities,
+    non-breaking spaces and fee lines. Output is deterministic for a given `seed` and is written as it is generated,
+    so statements of any size can be produced.
+    """
+    rng = random.Random(seed)
+    end_date = end_date or datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=(count - 1) // per_day)
+    balance = decimal.Decimal('2500.00')
+
+    f.write('From:\xa0{:%d/%m/%Y}\xa0to\xa0{:%d/%m/%Y}\xa0\n\n'.format(start_date, end_date))
+    f.write('Account:\xa0XXXX XXXX XXXX 1234\xa0\n\n')
+
+    for i in range(count):
+        cleared_date = end_date - datetime.timedelta(days=i // per_day)
+
+        if rng.random() < FEE_RATE:
+            desc, sign = rng.choice(FEE_DESCRIPTIONS), -1
+        else:
+            # card payments and withdrawals usually clear a day or two after they are made
+            date = cleared_date - datetime.timedelta(days=rng.randrange(3))
+            desc, sign = next(generate_descriptions(1, date, rng=rng))
+
+        amount = sign * decimal.Decimal('{:.2f}'.format(min(rng.lognormvariate(3, 1.2), 4000)))
+
+        f.write('Date:\xa0{:%d/%m/%Y}\n'.format(cleared_date))
+        f.write('Description:\xa0{}\n'.format(desc))
+        f.write('Amount:{}\n'.format(_format_amount(rng, amount)))
+        f.write('Balance:{}\n\n'.format(_format_amount(rng, balance)))
+
+        # written newest first, so the balance before this transaction is that of the next line
+        balance -= amount
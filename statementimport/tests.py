@@ -0,0 +1,357 @@
+import os
+import shutil
+import datetime
+import decimal
+import tempfile
+
+from django.db import connection
+from django.test import TestCase
+
+from counterparty.models import Alias, AliasTrigram, CounterParty, Pattern
+from transactions.models import *
+from .writer import TransactionWriter
+from .importer import StatementImportError
+from .parallel import expand_paths, parse_statements
+from .profiling import Profiler
+from .santander import SantanderImporter
+from .synthetic import write_statement
+from .util import fingerprint, backfill_fingerprints, PatternMatcher, AliasResolver
+
+
+class StatementFilesMixin:
+    date = datetime.date(2014, 6, 2)
+
+    def write_statement(self, count, name=None, newline=None, seed=0):
+        """
+        Writes a synthetic statement of the `count` newest lines of a history ending at `date` to a temporary
+        directory, and returns its path.
+        """
+        if not hasattr(self, 'tmp'):
+            self.tmp = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, self.tmp)
+
+        path = os.path.join(self.tmp, name or '{}.txt'.format(count))
+
+        with open(path, 'w', encoding='cp1252', newline=newline) as f:
+            write_statement(f, count, end_date=self.date, seed=seed)
+
+        return path
+
+
+class StatementParserTest(StatementFilesMixin, TestCase):
+    def read(self, path):
+        with open(path, encoding='cp1252') as f:
+            return f.read()
+
+    def test_final_block_without_blank_line(self):
+        content = self.read(self.write_statement(10))
+        blocks = list(SantanderImporter().read_blocks(content.splitlines(True)))
+        self.assertEqual(len(blocks), 10)
+
+        truncated = content.rstrip('\n')
+        self.assertFalse(truncated.endswith('\n'))
+        self.assertEqual(list(SantanderImporter().read_blocks(truncated.splitlines(True))), blocks)
+
+    def test_crlf(self):
+        path = self.write_statement(10)
+        crlf_path = self.write_statement(10, name='crlf.txt', newline='\r\n')
+
+        with open(crlf_path, 'rb') as f:
+            self.assertIn(b'\r\n', f.read())
+
+        content = self.read(path)
+        self.assertEqual(list(SantanderImporter().read_blocks(content.replace('\n', '\r\n').splitlines(True))),
+                         list(SantanderImporter().read_blocks(content.splitlines(True))))
+        self.assertEqual(list(SantanderImporter().parse(crlf_path)), list(SantanderImporter().parse(path)))
+
+
+class ParallelImportTest(StatementFilesMixin, TestCase):
+    def parse(self, paths, jobs):
+        return [(path, list(records) if error is None else records, error)
+                for path, records, error in parse_statements(SantanderImporter(), paths, jobs)]
+
+    def test_expand_paths(self):
+        paths = [self.write_statement(count) for count in (10, 20)]
+        self.write_statement(5, name='notes.csv')
+        os.mkdir(os.path.join(self.tmp, 'sub'))
+        nested = self.write_statement(30, name=os.path.join('sub', '30.txt'))
+
+        # each statement is listed once, where it is first found
+        self.assertEqual(expand_paths(SantanderImporter, [paths[1], os.path.join(self.tmp, '*.txt'), self.tmp,
+                                                          paths[1]]), [paths[1], paths[0], nested])
+
+    def test_jobs_keep_order(self):
+        paths = [self.write_statement(count, seed=count) for count in (30, 10, 20)]
+        serial = self.parse(paths, 1)
+
+        self.assertEqual([path for path, records, error in serial], paths)
+        self.assertEqual(self.parse(paths, 2), serial)
+
+    def test_worker_error(self):
+        paths = [self.write_statement(10), self.write_statement(20)]
+
+        with open(paths[1], 'a', encoding='cp1252') as f:
+            f.write('Date:\xa002/06/2014\nDescription:\xa0MYSTERY LINE\nAmount:\xa0-1.00\xa0\nBalance:\xa01.00\xa0\n')
+
+        serial = self.parse(paths[:1], 1)
+
+        # parsed in this process, the error is raised from the records
+        with self.assertRaisesRegex(StatementImportError, 'MYSTERY LINE'):
+            list(SantanderImporter().parse(paths[1]))
+
+        # parsed in a worker, it is returned to the caller in place of the records
+        parallel = self.parse(paths, 2)
+        self.assertEqual(parallel[0], serial[0])
+        self.assertEqual(parallel[1][:2], (paths[1], None))
+        self.assertRegex(parallel[1][2], "^StatementImportError: .*'MYSTERY LINE'")
+
+
+class TransactionWriterTest(TestCase):
+    date = datetime.date(2014, 6, 2)
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Groceries')
+        self.alias = Alias.objects.create(alias='TESCO STORES 1234',
+                                          counterparty=CounterParty.objects.create(name='Tesco'))
+
+    def build_transactions(self):
+        """
+        Returns an unsaved transaction of each subclass, with every field set.
+        """
+        def fields(amount, **extra):
+            common = {'amount': decimal.Decimal(amount), 'date': self.date - datetime.timedelta(days=1),
+                      'cleared_date': self.date, 'week': self.date.isocalendar()[1], 'description': 'LINE',
+                      'balance': decimal.Decimal('100.00')}
+            common.update(extra)
+            return common
+
+        alias = {'counterparty_alias': self.alias, 'category': self.category}
+
+        return [
+            PaymentTransaction(ref='REF', mandate=12, type=PaymentTransaction.PaymentType.DIRECT_DEBIT,
+                               **fields('-1.00', **alias)),
+            CardPaymentTransaction(requested_amount=decimal.Decimal('2.50'), currency='USD',
+                                   rate=decimal.Decimal('1.60'), **fields('-2.00', **alias)),
+            CreditTransaction(ref='PAY', type=CreditTransaction.CreditType.GIRO, **fields('3.00', **alias)),
+            TransferTransaction(**fields('-4.00', **alias)),
+            CashWithdrawalTransaction(atm='ATM', area='AREA', requested_amount=decimal.Decimal('5.00'),
+                                      currency='GBP', **fields('-5.00')),
+            RegularTransferTransaction(sortcode='123456', account_number='12345678', mandate=3, **fields('-6.00')),
+            CashPaidTransaction(branch='BRANCH', **fields('7.00')),
+            InterestTransaction(tax=decimal.Decimal('0.08'), **fields('0.32')),
+        ]
+
+    def test_write(self):
+        transactions = self.build_transactions()
+        writer = TransactionWriter()
+
+        writer.write(transactions[:4])
+        writer.write(transactions[4:])
+
+        # keys continue from one batch to the next
+        ids = [transaction.pk for transaction in transactions]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(writer.written, len(transactions))
+
+        loaded = {transaction.pk: transaction for transaction in Transaction.objects.all()}
+        self.assertEqual(len(loaded), len(transactions))
+
+        for transaction in transactions:
+            self.assertIs(type(loaded[transaction.pk]), type(transaction))
+
+            for field in transaction._meta.concrete_fields:
+                self.assertEqual(getattr(loaded[transaction.pk], field.attname), getattr(transaction, field.attname),
+                                 '{}.{}'.format(type(transaction).__name__, field.name))
+
+    def test_deleted_ids_not_reused(self):
+        transactions = self.build_transactions()
+        TransactionWriter().write(transactions[:2])
+        Transaction.objects.get(pk=transactions[1].pk).delete()
+
+        TransactionWriter().write(transactions[2:3])
+        self.assertGreater(transactions[2].pk, transactions[1].pk)
+
+        # nor are the reserved keys handed out to rows saved through the ORM
+        created = InterestTransaction.objects.create(tax=0, **{
+            field: getattr(transactions[7], field) for field in ('amount', 'date', 'cleared_date', 'week')})
+        self.assertGreater(created.pk, transactions[2].pk)
+
+
+class FingerprintTest(StatementFilesMixin, TestCase):
+    def build(self, description='INTEREST PAID AFTER TAX 0.00 DEDUCTED', amount='0.32', balance='100.32'):
+        amount, balance = decimal.Decimal(amount), decimal.Decimal(balance)
+        return InterestTransaction(amount=amount, balance=balance, tax=0, date=self.date, cleared_date=self.date,
+                                   week=self.date.isocalendar()[1], description=description,
+                                   fingerprint=fingerprint(self.date, amount, description, balance))
+
+    def import_statement(self, importer, writer, path):
+        for record in importer.parse(path):
+            writer.add(importer.build(record))
+
+        writer.flush()
+
+    def test_within_batch(self):
+        writer = TransactionWriter()
+        writer.write([self.build(), self.build(), self.build(balance='100.64')])
+
+        self.assertEqual((writer.written, writer.skipped), (2, 1))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_across_batches(self):
+        writer = TransactionWriter(batch_size=2)
+
+        for transaction in (self.build(), self.build(balance='100.64'), self.build(), self.build(balance='100.96')):
+            writer.add(transaction)
+        writer.flush()
+
+        self.assertEqual((writer.written, writer.skipped), (3, 1))
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_across_files(self):
+        importer = SantanderImporter()
+        writer = TransactionWriter(batch_size=4, importer=importer)
+        older, newer = self.write_statement(12), self.write_statement(30)
+
+        self.import_statement(importer, writer, older)
+        written = writer.written
+        self.import_statement(importer, writer, newer)
+
+        # every line of the older statement is also on the newer one
+        self.assertEqual(writer.skipped, written)
+        self.assertEqual(Transaction.objects.count(), len(list(importer.parse(newer))))
+
+    def test_backfill(self):
+        transaction = self.build()
+        fingerprinted = transaction.fingerprint
+        transaction.fingerprint = ''
+        transaction.save()
+
+        other = self.build(balance='100.64')
+        other_fingerprinted = other.fingerprint
+        other.fingerprint = ''
+        other.save()
+
+        # without a statement line, a transaction cannot be fingerprinted
+        InterestTransaction.objects.create(amount=1, tax=0, date=self.date, cleared_date=self.date, week=1)
+
+        # one query to read the transactions, one to update them, and one finding none left
+        with self.assertNumQueries(3):
+            self.assertEqual(backfill_fingerprints(), 2)
+
+        self.assertEqual(Transaction.objects.get(pk=transaction.pk).fingerprint, fingerprinted)
+        self.assertEqual(Transaction.objects.get(pk=other.pk).fingerprint, other_fingerprinted)
+        self.assertEqual(backfill_fingerprints(), 0)
+
+        writer = TransactionWriter()
+        writer.write([self.build()])
+        self.assertEqual((writer.written, writer.skipped), (0, 1))
+
+
+class ProfilerTest(TestCase):
+    def test_stage_queries(self):
+        use_debug_cursor = connection.use_debug_cursor
+        date = datetime.date(2014, 6, 2)
+        profiler = Profiler()
+
+        try:
+            with profiler.stage('outer'):
+                Category.objects.count()
+
+                with profiler.stage('inner', group='processors'):
+                    Category.objects.count()
+                    Category.objects.count()
+
+            with profiler.stage('outer'):
+                pass
+
+            # a batch already written only costs the lookup of its fingerprints
+            for i in range(2):
+                writer = TransactionWriter(profiler=profiler)
+                writer.add(InterestTransaction(amount=1, tax=0, date=date, cleared_date=date, week=1,
+                                               fingerprint='profiled'))
+
+                with profiler.stage('import {}'.format(i)):
+                    writer.flush()
+        finally:
+            profiler.finish()
+
+        self.assertEqual(connection.use_debug_cursor, use_debug_cursor)
+
+        # writing a new batch costs a query per table, among others, all of them within the save stage
+        queries = profiler.stats['stages', 'import 0']['queries']
+        self.assertGreater(queries, 2)
+
+        self.assertEqual({group: {name: (stats['calls'], stats['queries']) for name, stats in stages.items()}
+                          for group, stages in profiler.groups().items()}, {
+            'stages': {'outer': (2, 3), 'rules': (1, 0), 'save': (2, 1 + queries), 'import 0': (1, queries),
+                       'import 1': (1, 1)},
+            'processors': {'inner': (1, 2)},
+        })
+
+
+class PatternMatcherTest(TestCase):
+    def setUp(self):
+        self.tesco = CounterParty.objects.create(name='Tesco')
+        self.sky = CounterParty.objects.create(name='Sky')
+
+    def test_combined(self):
+        matcher = PatternMatcher([Pattern(regex='^TESCO ', counterparty=self.tesco),
+                                  Pattern(regex='SKY DIGITAL', counterparty=self.sky)])
+
+        self.assertIsNotNone(matcher.combined)
+        self.assertEqual(matcher.always_check, [])
+        self.assertEqual(matcher.match('tesco stores 1234'), self.tesco)
+        self.assertEqual(matcher.match('SKY DIGITAL 01'), self.sky)
+        self.assertIsNone(matcher.match('SAINSBURYS'))
+
+    def test_groups_and_flags_checked_separately(self):
+        matcher = PatternMatcher([Pattern(regex='^TESCO (STORES|EXPRESS)', counterparty=self.tesco),
+                                  Pattern(regex='(?s)SKY.DIGITAL', counterparty=self.sky)])
+
+        self.assertIsNone(matcher.combined)
+        self.assertEqual(len(matcher.always_check), 2)
+        self.assertEqual(matcher.match('TESCO EXPRESS'), self.tesco)
+        self.assertEqual(matcher.match('SKY\nDIGITAL'), self.sky)
+        self.assertIsNone(matcher.match('TESCO METRO'))
+
+    def test_multiple_matches(self):
+        for patterns in (['TESCO', 'STORES'], ['TESCO', '(STORES)']):
+            matcher = PatternMatcher([Pattern(regex=patterns[0], counterparty=self.tesco),
+                                      Pattern(regex=patterns[1], counterparty=self.sky)])
+
+            with self.assertRaises(Alias.MultipleObjectsReturned):
+                matcher.match('TESCO STORES')
+
+
+class AliasResolverTest(TestCase):
+    def setUp(self):
+        self.tesco = CounterParty.objects.create(name='Tesco')
+        self.alias = Alias.objects.create(alias='Tesco Stores 1234', counterparty=self.tesco)
+        Pattern.objects.create(regex='^TESCO ', counterparty=self.tesco)
+
+    def test_existing_alias(self):
+        resolver = AliasResolver()
+
+        self.assertEqual(resolver.get_or_create('TESCO STORES 1234'), self.alias)
+        self.assertEqual(resolver.new_aliases, [])
+
+    def test_flush(self):
+        resolver = AliasResolver()
+
+        for name in ('NEW SHOP', 'new shop', 'NEW SHOP', 'TESCO EXPRESS'):
+            resolver.get_or_create(name)
+
+        counterparties, trigrams = CounterParty.objects.count(), AliasTrigram.objects.count()
+        resolver.flush()
+
+        # the alias matched by a pattern belongs to the pattern's counterparty
+        self.assertEqual(CounterParty.objects.count(), counterparties + 1)
+        self.assertEqual(Alias.objects.get(pk='TESCO EXPRESS').counterparty, self.tesco)
+        self.assertEqual(Alias.objects.get(pk='NEW SHOP').counterparty_id, 'NEW SHOP')
+        self.assertEqual(Alias.objects.count(), 3)
+        self.assertEqual(AliasTrigram.objects.count(), trigrams + len(AliasTrigram.trigrams('NEW SHOP')) +
+                         len(AliasTrigram.trigrams('TESCO EXPRESS')))
+
+        # nothing is left to create again
+        resolver.flush()
+        self.assertEqual(Alias.objects.count(), 3)
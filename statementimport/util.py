@@ -1,7 +1,15 @@
 import decimal
+import hashlib
 import re
 
-from counterparty.models import Alias, CounterParty, Pattern
+from django.db import connections, router
+
+from counterparty.models import Alias, AliasTrigram, CounterParty, Pattern
+from transactions.models import Transaction
+
+
+# Rows fingerprinted per UPDATE by `backfill_fingerprints`, at three bound parameters each, under the limit of SQLite
+BACKFILL_CHUNK_SIZE = 300
 
 
 def parse_currency(amount):
@@ -16,25 +24,153 @@ def parse_currency(amount):
     return decimal.Decimal(amount)
 
 
-def get_or_create_alias(alias_name):
-    try:
-        return Alias.objects.get(pk__iexact=alias_name)
-    except Alias.DoesNotExist:
-        pass
+def fingerprint(cleared_date, amount, description, balance):
+    """
+    Returns a digest identifying a single statement line, used to recognise transactions that were already imported
+    from an overlapping statement. The running balance keeps otherwise identical lines on the same day distinct.
+    """
+    key = '|'.join((cleared_date.strftime('%Y-%m-%d'), str(amount), description, str(balance)))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def backfill_fingerprints():
+    """
+    Fingerprints the transactions stored without one (such as those saved before fingerprints were recorded) from
+    the statement line they were imported from, so that re-importing an overlapping statement skips them. Run once,
+    by the `rebuild` command. Returns the number of transactions fingerprinted.
+
+    Transactions without the description of their statement line cannot be fingerprinted, and are left as they are.
+    Each chunk of transactions is fingerprinted with a single UPDATE.
+    """
+    cent = decimal.Decimal('0.01')
+    using = router.db_for_write(Transaction)
+    connection = connections[using]
+    query = 'UPDATE {table} SET {fingerprint} = CASE {pk} {cases} END WHERE {pk} IN ({pks})'
+    count = 0
+
+    while True:
+        # each chunk is fingerprinted before the next is read, so it no longer matches
+        rows = list(Transaction.base_objects.using(using).filter(fingerprint='').exclude(description='').order_by(
+            'id').values_list('id', 'cleared_date', 'amount', 'description', 'balance')[:BACKFILL_CHUNK_SIZE])
+
+        if not rows:
+            return count
+
+        params = []
+
+        for pk, cleared_date, amount, description, balance in rows:
+            # amounts are read back without the trailing zeroes they were parsed with
+            if balance is not None:
+                balance = balance.quantize(cent)
+
+            params.extend((pk, fingerprint(cleared_date, amount.quantize(cent), description, balance)))
+
+        params.extend(row[0] for row in rows)
+
+        with connection.cursor() as cursor:
+            cursor.execute(query.format(
+                table=connection.ops.quote_name(Transaction._meta.db_table),
+                fingerprint=connection.ops.quote_name(Transaction._meta.get_field('fingerprint').column),
+                pk=connection.ops.quote_name(Transaction._meta.pk.column),
+                cases=' '.join(['WHEN %s THEN %s'] * len(rows)),
+                pks=', '.join(['%s'] * len(rows)),
+            ), params)
+
+        count += len(rows)
+
+
+class PatternMatcher:
+    """
+    Matches alias names against every counterparty `Pattern` at once.
+
+    All patterns are compiled up front. Those without groups or inline flags of their own are also joined into a
+    single alternation, which rejects the common case of an alias matching no pattern in one search. Only when that
+    search hits (or for patterns that could not be joined) is each pattern tried individually, so an alias matched
+    by more than one pattern is still detected.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [(re.compile(pattern.regex, re.IGNORECASE), pattern.counterparty) for pattern in patterns]
+
+        flags = re.compile('', re.IGNORECASE).flags
+        joinable = [regex.pattern for regex, counterparty in self.patterns if not regex.groups and regex.flags == flags]
+        self.always_check = [(regex, counterparty) for regex, counterparty in self.patterns
+                             if regex.groups or regex.flags != flags]
+
+        try:
+            self.combined = re.compile('|'.join('(?:{})'.format(pattern) for pattern in joinable), re.IGNORECASE)
+        except re.error:
+            self.combined = None
+            self.always_check = self.patterns
+
+        if not joinable:
+            self.combined = None
+
+    def match(self, alias_name):
+        """
+        Returns the counterparty whose pattern matches `alias_name`, or None if no pattern matches.
+        """
+        if self.combined is not None and self.combined.search(alias_name):
+            candidates = self.patterns
+        else:
+            candidates = self.always_check
+
+        counterparty = None
+
+        for regex, pattern_counterparty in candidates:
+            if not regex.search(alias_name):
+                continue
+
+            if counterparty:
+                raise Alias.MultipleObjectsReturned('alias matched by multiple patterns')
+
+            counterparty = pattern_counterparty
+
+        return counterparty
+
+
+class AliasResolver:
+    """
+    Resolves alias names to `Alias` objects for the duration of a single import.
+
+    Every existing alias is loaded once into a case-insensitive dict. Names that are not found are matched against
+    the counterparty patterns, and any new aliases and counterparties are held back until `flush` creates them in
+    bulk, so resolving an alias never costs a query of its own.
+    """
+
+    def __init__(self):
+        self.aliases = {
+            alias.pk.lower(): alias for alias in Alias.objects.select_related('counterparty__auto_categorise')
+        }
+        self.patterns = PatternMatcher(Pattern.objects.select_related('counterparty__auto_categorise'))
+        self.new_aliases = []
+        self.new_counterparties = []
 
-    counterparty = None
+    def get_or_create(self, alias_name):
+        try:
+            return self.aliases[alias_name.lower()]
+        except KeyError:
+            pass
 
-    # does this alias match a counterparty pattern?
-    for pattern in Pattern.objects.all():
-        if not re.search(pattern.regex, alias_name, re.IGNORECASE):
-            continue
+        # does this alias match a counterparty pattern?
+        counterparty = self.patterns.match(alias_name)
 
-        if counterparty:
-            raise Alias.MultipleObjectsReturned('alias matched by multiple patterns')
+        if not counterparty:
+            counterparty = CounterParty(pk=alias_name)
+            self.new_counterparties.append(counterparty)
 
-        counterparty = pattern.counterparty
+        alias = Alias(pk=alias_name, counterparty=counterparty)
+        self.aliases[alias_name.lower()] = alias
+        self.new_aliases.append(alias)
+        return alias
 
-    if not counterparty:
-        counterparty = CounterParty.objects.create(pk=alias_name)
+    def flush(self):
+        """
+        Creates the aliases and counterparties resolved since the last flush.
+        """
+        CounterParty.objects.bulk_create(self.new_counterparties)
+        Alias.objects.bulk_create(self.new_aliases)
+        AliasTrigram.index(self.new_aliases)
 
-    return Alias.objects.create(pk=alias_name, counterparty=counterparty)
+        self.new_counterparties = []
+        self.new_aliases = []
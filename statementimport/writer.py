@@ -0,0 +1,202 @@
+from django.db import connections, router
+
+from transactions.models import Transaction, DataVersion
+from transactions.rollups import RollupDeltas
+from transactions.categorisation import apply_deltas
+from transactions.rules import load_rules, categorise_new
+from transactions.balances import update_daily_balances
+from counterparty.stats import StatsDeltas
+from .profiling import NULL_PROFILER
+
+
+class TransactionWriter:
+    """
+    Writes imported transactions to the database in batches.
+
+    Saving a multi-table inherited model costs an INSERT for every table in its hierarchy, for every row. Instead,
+    each batch is grouped by concrete class and written with one multi-row INSERT per table in that class's hierarchy
+    (split only where the database limits the number of parameters in a statement).
+
+    Transactions whose `fingerprint` is already stored are skipped, so re-importing an overlapping statement only
+    writes its new rows. Existing fingerprints are looked up with one query per batch rather than one per row.
+
+    Primary keys are reserved up front from the database's own counter (see `reserve_ids`), so the parent and child
+    rows can be inserted without reading generated keys back. Reserved keys are never handed out again, even to
+    other connections or once their rows are deleted. Where keys cannot be reserved, the parent rows are inserted one
+    at a time to read their keys back.
+
+    Each transaction is categorised by the first `CategoryRule` it matches, if any, before it is written.
+
+    With `importer`, the aliases and counterparties its resolver has created since the last batch are flushed before
+    each batch is written, so that no transaction is inserted referring to an alias that does not exist yet.
+    """
+
+    def __init__(self, batch_size=500, using=None, profiler=NULL_PROFILER, importer=None):
+        self.batch_size = batch_size
+        self.using = using or router.db_for_write(Transaction)
+        self.profiler = profiler
+        self.importer = importer
+        self.rules = None
+        self.pending = []
+        self.written = 0
+        self.skipped = 0
+
+    def add(self, transaction):
+        self.pending.append(transaction)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def discard(self):
+        self.pending = []
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+
+        if self.importer is not None:
+            with self.profiler.stage('alias flush'):
+                self.importer.aliases.flush()
+
+        with self.profiler.stage('save'):
+            self.write(batch)
+
+    def existing_fingerprints(self, transactions):
+        fingerprints = [transaction.fingerprint for transaction in transactions if transaction.fingerprint]
+        existing = set()
+
+        # keep well under the bound parameter limit of SQLite
+        for i in range(0, len(fingerprints), 500):
+            existing.update(Transaction.base_objects.using(self.using).filter(
+                fingerprint__in=fingerprints[i:i + 500]
+            ).values_list('fingerprint', flat=True))
+
+        return existing
+
+    def skip_existing(self, transactions):
+        existing = self.existing_fingerprints(transactions)
+        new_transactions = []
+
+        for transaction in transactions:
+            if transaction.fingerprint:
+                if transaction.fingerprint in existing:
+                    continue
+
+                # the same line may also appear twice within a batch, when statements overlap
+                existing.add(transaction.fingerprint)
+
+            new_transactions.append(transaction)
+
+        self.skipped += len(transactions) - len(new_transactions)
+        return new_transactions
+
+    def write(self, transactions):
+        transactions = self.skip_existing(transactions)
+        if not transactions:
+            return
+
+        if self.rules is None:
+            self.rules = load_rules()
+
+        with self.profiler.stage('rules'):
+            categorise_new(self.rules, transactions)
+
+        ids = self.reserve_ids(len(transactions))
+        by_class = {}
+
+        for i, transaction in enumerate(transactions):
+            transaction.pre_save_polymorphic()
+            transaction.id = ids[i] if ids else None
+
+            by_class.setdefault(type(transaction), []).append(transaction)
+
+        for model, objs in by_class.items():
+            # every table in the hierarchy, from `Transaction` down to `model`
+            hierarchy = sorted(model._meta.get_parent_list(), key=lambda parent: len(parent._meta.get_parent_list()))
+            hierarchy.append(model)
+
+            if ids is None:
+                for obj in objs:
+                    obj.id = self.insert_returning_id(hierarchy[0], obj)
+
+                tables = hierarchy[1:]
+            else:
+                tables = hierarchy
+
+            for obj in objs:
+                for table_model in hierarchy:
+                    setattr(obj, table_model._meta.pk.attname, obj.id)
+
+            for table_model in tables:
+                self.insert(table_model, objs)
+
+            for obj in objs:
+                obj._state.adding = False
+                obj._state.db = self.using
+
+        # the monthly rollups, category usage counts, counterparty stats and data versions are adjusted once per
+        # batch
+        rollup_deltas = RollupDeltas()
+        rollup_deltas.add_transactions(transactions)
+        stats_deltas = StatsDeltas()
+        stats_deltas.add_transactions(transactions)
+
+        DataVersion.bump(months=rollup_deltas.months(), counterparties=stats_deltas.counterparties())
+        apply_deltas(rollup_deltas)
+        stats_deltas.apply()
+
+        # a day's balance may depend on transactions written in earlier batches, so its closing balance is
+        # recalculated from every transaction of the day
+        update_daily_balances({transaction.cleared_date for transaction in transactions
+                               if transaction.balance is not None})
+
+        self.written += len(transactions)
+
+    def insert(self, model, objs):
+        fields = model._meta.local_concrete_fields
+        batch_size = max(connections[self.using].ops.bulk_batch_size(fields, objs), 1)
+
+        for i in range(0, len(objs), batch_size):
+            model._base_manager._insert(objs[i:i + batch_size], fields=fields, using=self.using)
+
+    def insert_returning_id(self, model, obj):
+        fields = [field for field in model._meta.local_concrete_fields if field is not model._meta.pk]
+        return model._base_manager._insert([obj], fields=fields, return_id=True, using=self.using)
+
+    def reserve_ids(self, count):
+        """
+        Returns a list of `count` primary keys for new transactions, reserved from the database so that they are
+        never handed out again, or None if the database cannot reserve them.
+
+        On SQLite, the AUTOINCREMENT counter of the table in `sqlite_sequence` is advanced past the reserved keys,
+        which also takes the database's write lock until the import commits. On PostgreSQL, the keys are drawn from
+        the table's sequence.
+        """
+        connection = connections[self.using]
+        table = Transaction._meta.db_table
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                # the counter is never behind the largest key, unless the table was created without AUTOINCREMENT
+                max_id = 'SELECT COALESCE(MAX(id), 0) FROM {}'.format(connection.ops.quote_name(table))
+
+                cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ({})) + %s WHERE name = %s'.format(max_id),
+                               [count, table])
+
+                if not cursor.rowcount:
+                    # nothing has been inserted into the table yet
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) SELECT %s, ({}) + %s'.format(max_id),
+                                   [table, count])
+
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                last_id = cursor.fetchone()[0]
+                return list(range(last_id - count + 1, last_id + 1))
+
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                               [table, count])
+                return [row[0] for row in cursor.fetchall()]
+
+        return None
@@ -1,7 +1,8 @@
 (function () {
   'use strict';
 
-  $('.transaction td.expand').click(function () {
+  // rows are added by "load more", so handlers are delegated from the table
+  $(document).on('click', '.transaction td.expand', function () {
     var $this = $(this);
     var $icon = $this.find('span.glyphicon');
     var $info = $this.siblings('td.description');
@@ -16,7 +17,7 @@
     return false;
   });
 
-  $('.transaction-table td.category').click(function () {
+  $(document).on('click', '.transaction-table td.category', function () {
     var $this = $(this);
 
     var $row = $this.closest('tr');
@@ -49,4 +50,31 @@
 
     $select[0].selectize.open();
   });
+
+  $('.transaction-table-more').click(function () {
+    var $this = $(this);
+    var $table = $this.siblings('.transaction-table');
+
+    $this.prop('disabled', true);
+
+    $.getJSON($this.data('src'), function (data) {
+      // a header and a body for each week
+      var $sections = $($.parseHTML(data.html)).filter('thead, tbody');
+      var lastWeek = $table.find('tr.week-header').last().data('week');
+
+      // continue the last week shown, rather than repeating its header
+      if ($sections.first().find('tr.week-header').data('week') === lastWeek) {
+        $table.children('tbody').last().append($sections.eq(1).children());
+        $sections = $sections.slice(2);
+      }
+
+      $table.append($sections);
+
+      if (data.next) {
+        $this.data('src', data.next).prop('disabled', false);
+      } else {
+        $this.remove();
+      }
+    });
+  });
 })();
@@ -1,8 +1,14 @@
 from django.contrib import admin
 
-from .models import Category
+from .models import Category, CategoryRule
 
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(CategoryRule)
+class CategoryRuleAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'priority')
+    list_editable = ('priority',)
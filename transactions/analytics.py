@@ -0,0 +1,171 @@
+import datetime
+import threading
+
+import numpy as np
+
+from .models import Category, CategoryClosure, DataVersion
+from .snapshot import EPOCH_ORDINAL, Snapshot, get_snapshot_dir, refresh_snapshot
+
+
+INTERVALS = ('week', 'month')
+
+# Ways of breaking a time series down, mapped to the snapshot column grouped by
+BREAKDOWNS = {
+    'category': 'category',
+    'top_category': 'category',
+    'counterparty': 'counterparty',
+}
+
+# The snapshot last loaded by `get_snapshot`, with its path and the global data version it was refreshed at, and the
+# lock held by the thread checking or replacing it
+_loaded = None
+_loaded_lock = threading.Lock()
+
+
+def get_snapshot(path=None):
+    """
+    Returns the snapshot, reloaded if anything has been written since it was last loaded by this process. Unchanged
+    data costs a single query of the data versions. The snapshot is only refreshed from the database if it has not
+    already been brought up to this version, such as by an import in another process.
+    """
+    global _loaded
+
+    path = path or get_snapshot_dir()
+    version = DataVersion.get_versions([DataVersion.GLOBAL])[DataVersion.GLOBAL][0]
+
+    with _loaded_lock:
+        if _loaded is None or _loaded[:2] != (path, version):
+            snapshot = Snapshot.load(path)
+
+            if snapshot is None or snapshot.meta.get('data_version') != version:
+                refresh_snapshot(path)
+                snapshot = Snapshot.load(path)
+
+            _loaded = (path, version, snapshot)
+
+        return _loaded[2]
+
+
+def _month_index(date):
+    return (date.year - 1970) * 12 + date.month - 1
+
+
+def _week_start(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def get_buckets(start, end, interval):
+    """
+    Returns a list of the first day of each week (starting on Monday) or month overlapping `start` to `end`.
+    """
+    if interval == 'week':
+        first = _week_start(start)
+        return [first + datetime.timedelta(weeks=i) for i in range((_week_start(end) - first).days // 7 + 1)]
+
+    return [datetime.date(1970 + index // 12, index % 12 + 1, 1)
+            for index in range(_month_index(start), _month_index(end) + 1)]
+
+
+def _bucket_indices(ordinals, start, interval):
+    """
+    Returns the index into `get_buckets(start, ...)` of the bucket of each date in the array of `ordinals`.
+    """
+    if interval == 'week':
+        # ordinal 1 (1 January of year 1) was a Monday
+        return (ordinals - (ordinals - 1) % 7 - _week_start(start).toordinal()) // 7
+
+    months = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    return months - _month_index(start)
+
+
+def _top_categories(category_ids):
+    """
+    Returns the array of `category_ids` with each category replaced by its top-level category.
+    """
+    links = np.array(list(CategoryClosure.objects.filter(ancestor__parent=None).values_list('descendant', 'ancestor')),
+                     dtype=np.int64).reshape(-1, 2)
+
+    # -1 (uncategorised) is looked up from the last element
+    lookup = np.full(max(links[:, 0].max() if len(links) else 0, category_ids.max() if len(category_ids) else 0) + 2,
+                     -1, dtype=np.int64)
+    lookup[links[:, 0]] = links[:, 1]
+    return lookup[category_ids]
+
+
+def _totals(keys, amounts, size):
+    """
+    Returns arrays of the net, incoming and outgoing total of `amounts` for each of `size` integer `keys`, in pounds.
+    """
+    return [np.round(np.bincount(keys, weights=weights, minlength=size) / 100, 2) for weights in (
+        amounts,
+        np.where(amounts > 0, amounts, 0),
+        np.where(amounts < 0, amounts, 0),
+    )]
+
+
+def _rolling_mean(values, window):
+    """
+    Returns the mean of each element of `values` and the `window - 1` elements before it (or as many as there are),
+    along the last axis.
+    """
+    cumulative = np.cumsum(np.insert(values, 0, 0, axis=-1), axis=-1)
+    counts = np.minimum(np.arange(1, values.shape[-1] + 1), window)
+    previous = np.maximum(np.arange(1, values.shape[-1] + 1) - window, 0)
+    return np.round((cumulative[..., 1:] - cumulative[..., previous]) / counts, 2)
+
+
+def time_series(snapshot, start, end, interval='month', by=None, rolling=None):
+    """
+    Returns the net, incoming and outgoing totals of the transactions in `snapshot` between `start` and `end`
+    (inclusive) for each week or month, as a dict of lists ready to be serialised as JSON. With `by`, the totals are
+    also broken down into a series for each category, top-level category or counterparty, largest first. With
+    `rolling`, each series also has the mean of its net totals over that many buckets.
+
+    Every series is computed in one pass over the snapshot's columns, however many buckets and groups there are.
+    """
+    buckets = get_buckets(start, end, interval)
+
+    mask = (snapshot.date >= start.toordinal()) & (snapshot.date <= end.toordinal())
+    indices = _bucket_indices(snapshot.date[mask].astype(np.int64), start, interval)
+    amounts = snapshot.amount[mask].astype(np.float64)
+
+    def series(net, incoming, outgoing):
+        data = {'net': net.tolist(), 'incoming': incoming.tolist(), 'outgoing': outgoing.tolist()}
+        if rolling:
+            data['rolling_net'] = _rolling_mean(net, rolling).tolist()
+        return data
+
+    result = {'interval': interval, 'buckets': [bucket.isoformat() for bucket in buckets]}
+    result.update(series(*_totals(indices, amounts, len(buckets))))
+
+    if not by:
+        return result
+
+    keys = getattr(snapshot, BREAKDOWNS[by])[mask].astype(np.int64)
+    if by == 'top_category':
+        keys = _top_categories(keys)
+
+    groups, group_indices = np.unique(keys, return_inverse=True)
+    totals = [total.reshape(len(groups), len(buckets)) for total in _totals(
+        group_indices * len(buckets) + indices, amounts, len(groups) * len(buckets))]
+
+    if by != 'counterparty':
+        category_names = dict(Category.objects.filter(pk__in=groups.tolist()).values_list('pk', 'name'))
+
+    result['groups'] = []
+
+    for i, group in enumerate(groups.tolist()):
+        data = series(*[total[i] for total in totals])
+
+        # -1 is uncategorised, or without a counterparty
+        if group == -1:
+            data['id'] = data['name'] = None
+        elif by == 'counterparty':
+            data['id'] = data['name'] = snapshot.counterparties[group]
+        else:
+            data['id'], data['name'] = group, category_names.get(group)
+
+        result['groups'].append(data)
+
+    result['groups'].sort(key=lambda data: -abs(sum(data['net'])))
+    return result
@@ -0,0 +1,185 @@
+import datetime
+from collections import Counter, OrderedDict
+
+from django.db.models import Sum
+
+from .models import Transaction, DailyBalance
+
+
+# Keeps `date__in` lists under the bound parameter limit of SQLite
+CHUNK_SIZE = 500
+
+
+def closing_balance(rows):
+    """
+    Returns the balance at the end of a day from the (amount, balance) tuples of each of that day's transactions,
+    oldest first where known, or None if their balances do not form a single unbroken chain (such as when a line of
+    the statement was not imported).
+
+    The balance before each transaction (its balance less its amount) is the balance after the transaction before
+    it, so the chain runs from the only balance before a transaction that is not also the balance after another, to
+    the closing balance: the only balance after a transaction that is not also the balance before another. When the
+    day's transactions net to zero, the opening and closing balances are the same and the chain is a loop, so the
+    closing balance is that after the last transaction.
+    """
+    rows = list(rows)
+    if not rows:
+        return None
+
+    befores = Counter(balance - amount for amount, balance in rows)
+    afters = Counter(balance for amount, balance in rows)
+    opening, closing = befores - afters, afters - befores
+
+    if not opening and not closing:
+        closing = Counter([rows[-1][1]])
+    elif sum(opening.values()) != 1 or sum(closing.values()) != 1:
+        return None
+
+    # every transaction must be linked to the others by a balance, or the chain is broken
+    groups = {}
+
+    def group(balance):
+        while groups.setdefault(balance, balance) != balance:
+            balance = groups[balance]
+        return balance
+
+    for amount, balance in rows:
+        groups[group(balance - amount)] = group(balance)
+
+    if len({group(balance) for amount, balance in rows}) != 1:
+        return None
+
+    return next(iter(closing))
+
+
+def _rows_by_date(dates):
+    """
+    Returns an ordered dict mapping each of `dates` with transactions to a list of their (amount, balance) tuples,
+    oldest first. Transactions without a balance are included with a balance of None.
+    """
+    rows = OrderedDict((date, []) for date in sorted(dates))
+    dates = list(rows)
+
+    for i in range(0, len(dates), CHUNK_SIZE):
+        # statements list the newest transactions first, and are written in that order
+        transactions = Transaction.base_objects.filter(cleared_date__in=dates[i:i + CHUNK_SIZE]).order_by('-id')
+
+        for date, amount, balance in transactions.values_list('cleared_date', 'amount', 'balance'):
+            rows[date].append((amount, balance))
+
+    return OrderedDict((date, date_rows) for date, date_rows in rows.items() if date_rows)
+
+
+def update_daily_balances(dates):
+    """
+    Recalculates the closing balances of `dates` from their transactions. A date whose transactions' balances do
+    not form a single chain, or which has transactions without a balance, is left without a closing balance.
+    """
+    closing = {}
+
+    for date, rows in _rows_by_date(dates).items():
+        if all(balance is not None for amount, balance in rows):
+            closing[date] = closing_balance(rows)
+
+    dates = list(dates)
+
+    for i in range(0, len(dates), CHUNK_SIZE):
+        chunk = dates[i:i + CHUNK_SIZE]
+        existing = {daily.date: daily for daily in DailyBalance.objects.filter(date__in=chunk)}
+        new_balances = []
+
+        for date in chunk:
+            balance = closing.get(date)
+            daily = existing.get(date)
+
+            if balance is None:
+                if daily is not None:
+                    daily.delete()
+            elif daily is None:
+                new_balances.append(DailyBalance(date=date, balance=balance))
+            elif daily.balance != balance:
+                daily.balance = balance
+                daily.save()
+
+        DailyBalance.objects.bulk_create(new_balances)
+
+
+def rebuild_daily_balances():
+    """
+    Recalculates every closing balance from the transactions table.
+    """
+    DailyBalance.objects.all().delete()
+    update_daily_balances(set(Transaction.base_objects.exclude(balance=None).values_list('cleared_date', flat=True)))
+
+
+def check_balances():
+    """
+    Yields a (date, problem) tuple for each inconsistency between the statement balances and the transactions: days
+    whose transactions' balances do not form a single chain, and days whose closing balance differs from that of the
+    previous day with a balance by something other than the total of the transactions in between. Either usually
+    means a line of a statement was not imported.
+    """
+    totals = dict(Transaction.base_objects.order_by().values('cleared_date').annotate(
+        total=Sum('amount')).values_list('cleared_date', 'total'))
+    balanced_dates = set(Transaction.base_objects.exclude(balance=None).values_list('cleared_date', flat=True))
+    daily_balances = dict(DailyBalance.objects.values_list('date', 'balance'))
+
+    previous = None
+    moved = 0
+
+    for date in sorted(set(totals) | set(daily_balances)):
+        if date in balanced_dates and date not in daily_balances:
+            yield date, 'the balances of the transactions do not form a single chain'
+
+        moved += totals.get(date, 0)
+
+        if date not in daily_balances:
+            continue
+
+        balance = daily_balances[date]
+
+        if previous is not None and previous[1] + moved != balance:
+            yield date, 'balance is {} but expected {} from the {} balance of {} and the transactions since'.format(
+                balance, previous[1] + moved, previous[0].isoformat(), previous[1])
+
+        previous = (date, balance)
+        moved = 0
+
+
+def balance_at(date):
+    """
+    Returns a tuple of the balance at the end of `date` and the date it was last known on, or (None, None) if there
+    is no known balance on or before `date`.
+    """
+    daily = DailyBalance.objects.filter(date__lte=date).order_by('-date').first()
+
+    if daily is None:
+        return None, None
+
+    return daily.balance, daily.date
+
+
+def balance_series(start, end, points):
+    """
+    Returns a list of (date, balance) tuples for the balance from `start` to `end`, downsampled to at most `points`
+    by keeping the last balance of each of `points` equal periods. The balance carried into the range is included
+    at `start`.
+    """
+    rows = list(DailyBalance.objects.filter(date__gte=start, date__lte=end).order_by('date').values_list(
+        'date', 'balance'))
+
+    opening, opening_date = balance_at(start - datetime.timedelta(days=1))
+    if opening is not None and (not rows or rows[0][0] != start):
+        rows.insert(0, (start, opening))
+
+    if len(rows) <= points:
+        return rows
+
+    # the period of each row, by how far into the range its date is
+    days = (end - start).days + 1
+    sampled = OrderedDict()
+
+    for date, balance in rows:
+        sampled[(date - start).days * points // days] = (date, balance)
+
+    return list(sampled.values())
@@ -0,0 +1,127 @@
+from django import db
+from django.apps import apps
+from django.db.models import F
+
+from counterparty.stats import refresh_stats
+from .models import Transaction, Category, DataVersion
+from .rollups import RollupDeltas
+from .balances import update_daily_balances
+
+
+def set_category(transactions, category, delete_unused=False):
+    """
+    Moves every transaction in the queryset `transactions` to `category` (which may be None) with a single UPDATE,
+    keeping the monthly rollups and category usage counts up to date. With `delete_unused`, the categories the
+    transactions were moved out of are then deleted if nothing uses them any more. Returns the number of
+    transactions whose category changed.
+    """
+    transactions = transactions.exclude(category=category)
+
+    with db.transaction.atomic():
+        # the rollups are adjusted from the transactions' categories before they are overwritten
+        deltas = RollupDeltas()
+        deltas.move_queryset(transactions, category.pk if category else None)
+        vacated = [category_id for category_id, count in deltas.category_counts().items() if count < 0]
+        counterparties = list(transactions.exclude(counterparty_alias=None).order_by().values_list(
+            'counterparty_alias__counterparty', flat=True).distinct())
+
+        months = deltas.months()
+
+        updated = transactions.update(category=category, version=F('version') + 1)
+        apply_deltas(deltas)
+        DataVersion.bump(months=months, counterparties=counterparties)
+
+        if delete_unused:
+            delete_if_unused(vacated)
+
+    return updated
+
+
+def delete_transactions(transactions):
+    """
+    Deletes every transaction in the queryset `transactions`, keeping the monthly rollups, category usage counts,
+    counterparty stats and daily balances up to date. Returns the number of transactions deleted.
+    """
+    with db.transaction.atomic():
+        deltas = RollupDeltas()
+        deltas.add_queryset(transactions, sign=-1)
+        counterparties = list(transactions.exclude(counterparty_alias=None).order_by().values_list(
+            'counterparty_alias__counterparty', flat=True).distinct())
+        dates = set(transactions.exclude(balance=None).order_by().values_list('cleared_date', flat=True))
+        pks = list(transactions.values_list('pk', flat=True))
+
+        months = deltas.months()
+
+        # Django's cascade would collect the child rows through the polymorphic managers, which return them as
+        # instances of several subclasses at once, so the rows are deleted from each table in the hierarchy directly
+        # instead, the most derived first. Chunked to keep under the bound parameter limit of SQLite
+        models = sorted((model for model in apps.get_app_config('transactions').get_models()
+                         if issubclass(model, Transaction)),
+                        key=lambda model: len(model._meta.get_parent_list()), reverse=True)
+
+        using = db.router.db_for_write(Transaction)
+
+        for i in range(0, len(pks), 500):
+            for model in models:
+                model.base_objects.using(using).filter(pk__in=pks[i:i + 500])._raw_delete(using)
+
+        apply_deltas(deltas)
+        refresh_stats(counterparties)
+        update_daily_balances(dates)
+        DataVersion.bump(months=months, counterparties=counterparties)
+
+    return len(pks)
+
+
+def apply_deltas(deltas):
+    """
+    Applies `RollupDeltas` to the monthly rollups and to the transaction counts of their categories.
+    """
+    counts = deltas.category_counts()
+    deltas.apply()
+    adjust_usage('transaction_count', counts)
+
+
+def adjust_usage(field, counts):
+    """
+    Adds to the usage count `field` ('transaction_count' or 'counterparty_count') of each category in the dict
+    `counts`, which maps category primary keys (or None, which is ignored) to the change in their usage.
+    """
+    for category_id, count in counts.items():
+        if category_id is not None and count:
+            Category.objects.filter(pk=category_id).update(**{field: F(field) + count})
+
+
+def delete_if_unused(category_ids):
+    """
+    Deletes those of `category_ids` that no transaction, counterparty or rule uses any more, and that have no
+    subcategories. Returns a list of the primary keys of the categories deleted.
+
+    Only the given categories are checked. Their usage counts are confirmed against the transactions and
+    counterparties tables before deleting, as deleting a category that is still in use would delete its
+    transactions with it.
+    """
+    category_ids = [category_id for category_id in category_ids if category_id is not None]
+    unused_ids = []
+
+    # each chunk is bound twice, so keep well under the bound parameter limit of SQLite
+    for i in range(0, len(category_ids), 400):
+        chunk = category_ids[i:i + 400]
+
+        unused_ids.extend(Category.objects.filter(
+            pk__in=chunk, transaction_count=0, counterparty_count=0, children__isnull=True
+        ).exclude(
+            pk__in=Transaction.objects.filter(category__in=chunk).values('category')
+        ).exclude(
+            counterparty__isnull=False
+        ).exclude(
+            rules__isnull=False
+        ).values_list('pk', flat=True))
+
+    for i in range(0, len(unused_ids), 400):
+        Category.objects.filter(pk__in=unused_ids[i:i + 400]).delete()
+
+    if unused_ids:
+        DataVersion.bump(shared=True)
+
+    return unused_ids
@@ -0,0 +1,47 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib import messages
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .models import DataVersion
+
+
+class ConditionalMixin:
+    """
+    Adds an ETag and Last-Modified built from the data versions returned by `get_version_keys` to a view's
+    responses, and responds 304 Not Modified to requests revalidating a response whose versions are unchanged. Only
+    the data versions are read to decide, not the data itself.
+
+    The ETag also covers the CSRF cookie, as pages rendered with `{% csrf_token %}` embed its token: a page
+    revalidated without the cookie (once it has expired) or with another token is rendered again, setting the cookie.
+    """
+
+    def get_version_keys(self):
+        return [DataVersion.GLOBAL]
+
+    def get_etag_parts(self, versions):
+        """
+        Returns a list of the strings the ETag is built from, which by default are the versions themselves.
+        """
+        return [str(version) for key, (version, modified) in sorted(versions.items())]
+
+    def dispatch(self, request, *args, **kwargs):
+        # messages are only shown once, so a page with messages waiting to be shown is always rendered
+        if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+            return super().dispatch(request, *args, **kwargs)
+
+        versions = DataVersion.get_versions(self.get_version_keys())
+        csrf_token = request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+        etag = ';'.join(self.get_etag_parts(versions) + [hashlib.md5(csrf_token.encode()).hexdigest()[:8]])
+        last_modified = max((modified for version, modified in versions.values() if modified), default=None)
+
+        response = condition(
+            etag_func=lambda *args, **kwargs: etag,
+            last_modified_func=lambda *args, **kwargs: last_modified,
+        )(super().dispatch)(request, *args, **kwargs)
+
+        # stored by the browser, but revalidated before each use
+        patch_cache_control(response, no_cache=True)
+        return response
@@ -0,0 +1,121 @@
+import csv
+import json
+from collections import OrderedDict
+
+from django.apps import apps
+from django.db.models.fields import FieldDoesNotExist
+
+from .models import Transaction
+from .loading import load_page
+
+
+# Number of transactions loaded from the database at a time
+EXPORT_CHUNK_SIZE = 1000
+
+# Columns common to every transaction, before the fields of the transaction subclasses
+COMMON_COLUMNS = ('id', 'transaction_type', 'date', 'cleared_date', 'amount', 'category', 'counterparty', 'alias',
+                  'description')
+
+
+def get_subclass_fields():
+    """
+    Returns a list of the names of the fields of the transaction subclasses, in the order the subclasses are defined.
+    Fields of the same name on several subclasses (such as `ref`) share a column.
+    """
+    fields = []
+
+    for model in apps.get_app_config('transactions').get_models():
+        if not issubclass(model, Transaction) or model is Transaction:
+            continue
+
+        for field in model._meta.local_concrete_fields:
+            # skipping the links to the parent tables
+            if field.rel is None and field.name not in fields:
+                fields.append(field.name)
+
+    return fields
+
+
+def get_columns():
+    return list(COMMON_COLUMNS) + get_subclass_fields()
+
+
+def iter_transactions(queryset, after=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields every transaction in `queryset` following the cursor `after`, newest first, as an instance of its own
+    subclass. Only `chunk_size` transactions are held in memory at once.
+    """
+    while True:
+        transactions, after = load_page(queryset, chunk_size, after)
+        yield from transactions
+
+        if after is None:
+            break
+
+
+def transaction_row(transaction, subclass_fields):
+    """
+    Returns an ordered dict of the export columns of `transaction`. Fields from other subclasses are None, and
+    fields with choices are given as their display value.
+    """
+    alias = transaction.counterparty_alias
+
+    row = OrderedDict((
+        ('id', transaction.pk),
+        ('transaction_type', transaction._meta.model_name),
+        ('date', transaction.date.isoformat()),
+        ('cleared_date', transaction.cleared_date.isoformat()),
+        ('amount', str(transaction.amount)),
+        ('category', transaction.category.name if transaction.category else None),
+        ('counterparty', alias.counterparty_id if alias else None),
+        ('alias', alias.pk if alias else None),
+        ('description', transaction.description),
+    ))
+
+    for name in subclass_fields:
+        try:
+            field = transaction._meta.get_field(name)
+        except FieldDoesNotExist:
+            row[name] = None
+            continue
+
+        if field.choices:
+            row[name] = getattr(transaction, 'get_{}_display'.format(name))()
+        else:
+            value = getattr(transaction, field.attname)
+            row[name] = value if value is None or isinstance(value, (int, str)) else str(value)
+
+    return row
+
+
+class _Echo:
+    """
+    A file-like object returning what is written to it, so `csv.writer` can format lines without buffering them.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(transactions):
+    subclass_fields = get_subclass_fields()
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(get_columns())
+
+    for transaction in transactions:
+        yield writer.writerow(transaction_row(transaction, subclass_fields).values())
+
+
+def iter_ndjson(transactions):
+    subclass_fields = get_subclass_fields()
+
+    for transaction in transactions:
+        yield json.dumps(transaction_row(transaction, subclass_fields)) + '\n'
+
+
+# Maps the name of each export format to its (line generator, content type, file extension)
+FORMATS = OrderedDict((
+    ('csv', (iter_csv, 'text/csv', 'csv')),
+    ('ndjson', (iter_ndjson, 'application/x-ndjson', 'ndjson')),
+))
@@ -1,7 +1,13 @@
+import datetime
+
 from django import forms
+from django.apps import apps
 
 from finance.forms import LenientChoiceField
 from .models import Transaction, Category
+from .loading import parse_cursor
+from .export import FORMATS
+from .analytics import INTERVALS, BREAKDOWNS
 
 
 def get_category_choices():
@@ -19,3 +25,226 @@ class CategoryForm(forms.Form):
 class CategoriseForm(CategoryForm):
     transaction = forms.ModelChoiceField(queryset=Transaction.objects.all(), empty_label=None)
     create_category = forms.BooleanField(required=False)
+
+
+def get_type_choices():
+    return [(model._meta.model_name, model._meta.verbose_name)
+            for model in apps.get_app_config('transactions').get_models()
+            if issubclass(model, Transaction) and model is not Transaction]
+
+
+def filter_transactions(queryset, data):
+    """
+    Returns `queryset` filtered by the cleaned counterparty, type and start and end date fields of a form.
+    """
+    if data['counterparty']:
+        queryset = queryset.filter(counterparty_alias__counterparty=data['counterparty'])
+
+    if data['type']:
+        queryset = queryset.instance_of(apps.get_model('transactions', data['type']))
+
+    if data['start']:
+        queryset = queryset.filter(date__gte=data['start'])
+
+    if data['end']:
+        queryset = queryset.filter(date__lte=data['end'])
+
+    return queryset
+
+
+class TransactionFilterForm(forms.Form):
+    """
+    Filters and paging of the transactions data view, validated from the query string.
+    """
+    # a category primary key, or 'none' for uncategorised transactions
+    category = forms.CharField(required=False)
+    counterparty = forms.CharField(required=False)
+    type = forms.ChoiceField(required=False)
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    after = forms.CharField(required=False)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=500)
+    html = forms.BooleanField(required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['type'].choices = [('', '')] + get_type_choices()
+
+    def clean_category(self):
+        category = self.cleaned_data['category']
+
+        if category and category != 'none' and not category.isdigit():
+            raise forms.ValidationError('Expected a category id or `none`')
+
+        return category
+
+    def clean_after(self):
+        after = self.cleaned_data['after']
+
+        if after:
+            try:
+                parse_cursor(after)
+            except ValueError:
+                raise forms.ValidationError('Invalid cursor')
+
+        return after or None
+
+    def filter(self, queryset):
+        """
+        Returns `queryset` filtered by the form's cleaned data.
+        """
+        data = self.cleaned_data
+
+        if data['category'] == 'none':
+            queryset = queryset.filter(category=None)
+        elif data['category']:
+            queryset = queryset.filter(category=int(data['category']))
+
+        return filter_transactions(queryset, data)
+
+
+class ExportForm(TransactionFilterForm):
+    """
+    The format of an export of the transactions, and the filters applied to it. An export continues from the cursor
+    `after` when given, and `limit` is ignored.
+    """
+    format = forms.ChoiceField(choices=[(name, name) for name in FORMATS], required=False)
+
+    def clean_format(self):
+        return self.cleaned_data['format'] or 'csv'
+
+
+class TimeSeriesForm(forms.Form):
+    """
+    The range, interval and breakdown of a time series, validated from the query string. The range defaults to the
+    last year.
+    """
+    interval = forms.ChoiceField(choices=[(interval, interval) for interval in INTERVALS], required=False)
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    by = forms.ChoiceField(choices=[('', '')] + [(by, by) for by in sorted(BREAKDOWNS)], required=False)
+    rolling = forms.IntegerField(required=False, min_value=1, max_value=60)
+
+    # the most buckets returned in one series, to bound the size of responses
+    max_buckets = 1000
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        cleaned_data['interval'] = cleaned_data.get('interval') or 'month'
+        cleaned_data['end'] = cleaned_data.get('end') or datetime.date.today()
+        cleaned_data['start'] = cleaned_data.get('start') or cleaned_data['end'] - datetime.timedelta(days=365)
+
+        if cleaned_data['start'] > cleaned_data['end']:
+            raise forms.ValidationError('The start of the range must not be after its end')
+
+        days = (cleaned_data['end'] - cleaned_data['start']).days
+        if days // (7 if cleaned_data['interval'] == 'week' else 28) > self.max_buckets:
+            raise forms.ValidationError('The range must be at most {} {}s long'.format(
+                self.max_buckets, cleaned_data['interval']))
+
+        return cleaned_data
+
+
+class BalanceForm(forms.Form):
+    date = forms.DateField(required=False)
+
+    def clean_date(self):
+        return self.cleaned_data['date'] or datetime.date.today()
+
+
+class BalanceSeriesForm(forms.Form):
+    """
+    The range of a series of balances, by default the last year, and the most points to return.
+    """
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    points = forms.IntegerField(required=False, min_value=2, max_value=1000)
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        cleaned_data['end'] = cleaned_data.get('end') or datetime.date.today()
+        cleaned_data['start'] = cleaned_data.get('start') or cleaned_data['end'] - datetime.timedelta(days=365)
+        cleaned_data['points'] = cleaned_data.get('points') or 100
+
+        if cleaned_data['start'] > cleaned_data['end']:
+            raise forms.ValidationError('The start of the range must not be after its end')
+
+        return cleaned_data
+
+
+class ForecastForm(forms.Form):
+    """
+    The range of a cashflow forecast: `days` from `start`, by default the next 90 days from today.
+    """
+    start = forms.DateField(required=False)
+    days = forms.IntegerField(required=False, min_value=1, max_value=730)
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        cleaned_data['start'] = cleaned_data.get('start') or datetime.date.today()
+        cleaned_data['end'] = cleaned_data['start'] + datetime.timedelta(days=(cleaned_data.get('days') or 90) - 1)
+
+        return cleaned_data
+
+
+class BulkCategoriseForm(CategoryForm):
+    """
+    Selects the transactions to categorise either by a comma separated list of ids, or by any of the filters.
+    """
+    transactions = forms.CharField(required=False)
+    uncategorised = forms.BooleanField(required=False)
+    alias = forms.CharField(required=False)
+    counterparty = forms.CharField(required=False)
+    type = forms.ChoiceField(required=False)
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+
+    filter_fields = ('uncategorised', 'alias', 'counterparty', 'type', 'start', 'end')
+
+    # keeps the list of ids under the bound parameter limit of SQLite
+    max_transactions = 500
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['type'].choices = [('', '')] + get_type_choices()
+
+    def clean_transactions(self):
+        try:
+            pks = [int(pk) for pk in self.cleaned_data['transactions'].split(',') if pk.strip()]
+        except ValueError:
+            raise forms.ValidationError('Expected a comma separated list of transaction ids')
+
+        if len(pks) > self.max_transactions:
+            raise forms.ValidationError(
+                'At most {} transaction ids may be given, use a filter to categorise more'.format(self.max_transactions))
+
+        return pks
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        # never categorise every transaction by accident
+        if not cleaned_data.get('transactions') and not any(cleaned_data.get(field) for field in self.filter_fields):
+            raise forms.ValidationError('Specify the transactions to categorise, or at least one filter')
+
+        return cleaned_data
+
+    def filter(self, queryset):
+        """
+        Returns `queryset` filtered to the selected transactions.
+        """
+        data = self.cleaned_data
+
+        if data['transactions']:
+            queryset = queryset.filter(pk__in=data['transactions'])
+
+        if data['uncategorised']:
+            queryset = queryset.filter(category=None)
+
+        if data['alias']:
+            queryset = queryset.filter(counterparty_alias=data['alias'])
+
+        return filter_transactions(queryset, data)
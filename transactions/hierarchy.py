@@ -0,0 +1,70 @@
+from django.db.models import Sum
+
+from .models import Category, CategoryClosure, MonthlyCategoryRollup
+
+
+def month_subtree_totals(year, month):
+    """
+    Returns a dict mapping the primary key of each top-level category to the net amount of the month's transactions
+    in it or any of its subcategories, with the uncategorised total under None. Read from the monthly rollups with a
+    single join through the closure table.
+    """
+    totals = dict(CategoryClosure.objects.filter(
+        ancestor__parent=None,
+        descendant__monthlycategoryrollup__year=year,
+        descendant__monthlycategoryrollup__month=month,
+    ).values('ancestor').annotate(
+        total=Sum('descendant__monthlycategoryrollup__net')
+    ).values_list('ancestor', 'total'))
+
+    totals[None] = MonthlyCategoryRollup.objects.filter(
+        year=year, month=month, category=None
+    ).aggregate(total=Sum('net'))['total'] or 0
+
+    return totals
+
+
+def subtree_totals(transactions):
+    """
+    Returns a list of (category, total) tuples for each top-level category with transactions in the queryset
+    `transactions` in its subtree, largest total first, followed by (None, total) for uncategorised transactions.
+    """
+    # `parent=None` is joined with outer joins, which would otherwise also match uncategorised transactions (and
+    # categories missing from the closure table) under a None ancestor
+    totals = dict(transactions.filter(
+        category__isnull=False,
+        category__ancestor_links__ancestor__isnull=False,
+        category__ancestor_links__ancestor__parent=None,
+    ).order_by().values('category__ancestor_links__ancestor').annotate(
+        total=Sum('amount')
+    ).values_list('category__ancestor_links__ancestor', 'total'))
+
+    categories = Category.objects.in_bulk(list(totals))
+    result = sorted(((categories[pk], total) for pk, total in totals.items()), key=lambda item: abs(item[1]),
+                    reverse=True)
+
+    uncategorised = transactions.filter(category=None).aggregate(total=Sum('amount'))['total']
+    if uncategorised is not None:
+        result.append((None, uncategorised))
+
+    return result
+
+
+def rebuild_closure():
+    """
+    Recreates the closure table from each category's parent.
+    """
+    CategoryClosure.objects.all().delete()
+
+    parents = dict(Category.objects.values_list('pk', 'parent'))
+    links = []
+
+    for pk in parents:
+        ancestor_id, depth = pk, 0
+
+        # a category can only have as many ancestors as there are categories, unless its parents form a cycle
+        while ancestor_id is not None and depth < len(parents):
+            links.append(CategoryClosure(ancestor_id=ancestor_id, descendant_id=pk, depth=depth))
+            ancestor_id, depth = parents[ancestor_id], depth + 1
+
+    CategoryClosure.objects.bulk_create(links)
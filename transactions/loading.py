@@ -0,0 +1,76 @@
+import datetime
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+
+
+# Related objects rendered for every row of the transaction table
+LIST_SELECT_RELATED = ('category', 'counterparty_alias__counterparty')
+
+# Keeps `pk__in` lists under the bound parameter limit of SQLite
+CHUNK_SIZE = 500
+
+
+def load_transactions(queryset, select_related=LIST_SELECT_RELATED):
+    """
+    Returns a list of the transactions in `queryset`, in order, as instances of their own subclasses and with
+    `select_related` already loaded.
+
+    A polymorphic queryset fetches subclasses once per subclass for every 100 rows, and the related objects of each
+    row are then fetched lazily as they are rendered. Instead, this reads the primary keys and content types of the
+    whole queryset in one query, then fetches each subclass present (and its related objects) in one more, so the
+    number of queries depends only on the number of transaction subclasses.
+    """
+    rows = list(queryset.values_list('pk', 'polymorphic_ctype'))
+
+    pks_by_ctype = OrderedDict()
+    for pk, ctype_id in rows:
+        pks_by_ctype.setdefault(ctype_id, []).append(pk)
+
+    transactions = {}
+
+    for ctype_id, pks in pks_by_ctype.items():
+        # content types are cached by Django after they are first looked up
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+
+        for i in range(0, len(pks), CHUNK_SIZE):
+            for transaction in model.base_objects.filter(pk__in=pks[i:i + CHUNK_SIZE]).select_related(*select_related):
+                transactions[transaction.pk] = transaction
+
+    return [transactions[pk] for pk, ctype_id in rows if pk in transactions]
+
+
+def format_cursor(transaction):
+    return '{:%Y-%m-%d}:{}'.format(transaction.date, transaction.pk)
+
+
+def parse_cursor(cursor):
+    """
+    Returns the (date, id) tuple encoded in a cursor from `format_cursor`. Raises ValueError if it is malformed.
+    """
+    date, pk = cursor.split(':')
+    return datetime.datetime.strptime(date, '%Y-%m-%d').date(), int(pk)
+
+
+def load_page(queryset, limit, after=None):
+    """
+    Returns a tuple of (transactions, cursor) for the page of at most `limit` transactions in `queryset` following
+    the cursor `after`, newest first. The returned cursor continues from the end of the page, or is None if this is
+    the last page.
+
+    Pages are found by seeking to (date, id) on the index over those columns rather than by offset, so every page
+    costs the same however far into the history it is.
+    """
+    queryset = queryset.order_by('-date', '-id')
+
+    if after is not None:
+        date, pk = parse_cursor(after)
+        queryset = queryset.filter(date__lte=date).exclude(date=date, id__gte=pk)
+
+    transactions = load_transactions(queryset[:limit + 1])
+
+    if len(transactions) <= limit:
+        return transactions, None
+
+    transactions = transactions[:limit]
+    return transactions, format_cursor(transactions[-1])
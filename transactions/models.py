@@ -1,19 +1,88 @@
+import re
+import calendar
+
+from django.apps import apps
 from django.db import models
+from django.db.models import Q, F
+from django.utils import timezone
 from django.core.exceptions import ValidationError
+from django.contrib.contenttypes.models import ContentType
 from polymorphic import PolymorphicModel
-from counterparty.models import Alias
+from counterparty.models import Alias, CounterParty
 
 
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
     parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
 
+    # the number of transactions in, and counterparties automatically categorised as, this category
+    transaction_count = models.IntegerField(default=0, editable=False)
+    counterparty_count = models.IntegerField(default=0, editable=False)
+
     class Meta:
         verbose_name_plural = 'categories'
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        if self.pk is not None and self.parent_id is not None and CategoryClosure.objects.filter(
+                ancestor=self.pk, descendant=self.parent_id).exists():
+            raise ValidationError('a category cannot be moved under itself or one of its subcategories')
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            old_parent_id = None
+        else:
+            old_parent_id = Category.objects.filter(pk=self.pk).values_list('parent', flat=True).first()
+
+        created = self.pk is None
+        super().save(*args, **kwargs)
+
+        if created:
+            CategoryClosure.objects.create(ancestor=self, descendant=self, depth=0)
+
+        if created or old_parent_id != self.parent_id:
+            self.move_closure()
+
+        # category names and the category tree are shown on every page
+        DataVersion.bump(shared=True)
+
+    def move_closure(self):
+        """
+        Links this category and its subcategories to the ancestors of its current parent in the closure table,
+        replacing any links to its previous ancestors.
+        """
+        subtree = list(CategoryClosure.objects.filter(ancestor=self).values_list('descendant', 'depth'))
+        subtree_ids = [descendant_id for descendant_id, depth in subtree]
+
+        CategoryClosure.objects.filter(descendant__in=subtree_ids).exclude(ancestor__in=subtree_ids).delete()
+
+        if self.parent_id is None:
+            return
+
+        ancestors = CategoryClosure.objects.filter(descendant=self.parent_id).values_list('ancestor', 'depth')
+
+        CategoryClosure.objects.bulk_create([
+            CategoryClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth + 1)
+            for ancestor_id, ancestor_depth in ancestors
+            for descendant_id, depth in subtree
+        ])
+
+
+class CategoryClosure(models.Model):
+    """
+    A row for every (ancestor, descendant) pair of categories, including each category paired with itself at depth
+    0, so a category's whole subtree can be joined in one query. Kept up to date by `Category.save`, and rows are
+    deleted along with their categories.
+    """
+    ancestor = models.ForeignKey(Category, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, related_name='ancestor_links')
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
 
 class Transaction(PolymorphicModel):
     category = models.ForeignKey(Category, null=True, blank=True)
@@ -22,6 +91,25 @@ class Transaction(PolymorphicModel):
     date = models.DateField()
     week = models.IntegerField()  # automatically calculated from `date` on save
     counterparty_alias = models.ForeignKey(Alias, null=True, blank=True)
+    description = models.TextField(blank=True)  # the line of the statement the transaction was imported from
+    balance = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)  # on the statement, after it
+    fingerprint = models.CharField(max_length=40, blank=True, db_index=True, editable=False)
+    version = models.IntegerField(default=0, editable=False)  # incremented whenever the row is changed
+
+    class Meta:
+        # transaction lists are paged by seeking on (date, id), optionally within a category or alias
+        index_together = (
+            ('date', 'id'),
+            ('category', 'date', 'id'),
+            ('counterparty_alias', 'date', 'id'),
+            ('cleared_date', 'id'),
+        )
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            self.version += 1
+
+        super().save(*args, **kwargs)
 
     def __repr__(self):
         return '<{} amount={}, date={}, cleared={}>'.format(
@@ -187,7 +275,7 @@ class RegularTransferTransaction(Transaction):
         return '{}, sortcode={}, account={}, mandate={}>'.format(
             super().__repr__()[:-1],
             self.sortcode,
-            self.account,
+            self.account_number,
             self.mandate,
         )
 
@@ -222,3 +310,276 @@ class InterestTransaction(Transaction):
             super().__repr__()[:-1],
             self.tax,
         )
+
+
+class MonthlyCategoryRollup(models.Model):
+    """
+    Totals of the transactions in each category (or uncategorised, when `category` is null) in a month. Kept up to
+    date by `transactions.rollups` as transactions are imported and categorised.
+    """
+    year = models.IntegerField()
+    month = models.IntegerField()
+    category = models.ForeignKey(Category, null=True, blank=True)
+    net = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    incoming = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    outgoing = models.DecimalField(max_digits=12, decimal_places=2, default=0)  # negative, like the amounts it sums
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('year', 'month', 'category')
+
+    def __repr__(self):
+        return '<{} {}-{:02} category={} net={} count={}>'.format(
+            self.__class__.__name__,
+            self.year,
+            self.month,
+            self.category_id,
+            self.net,
+            self.count,
+        )
+
+
+class CategoryRule(models.Model):
+    """
+    Categorises the transactions matching every one of its criteria that are given. Rules are tried in order of
+    `priority`, and a transaction is categorised by the first rule it matches. Applied to transactions as they are
+    imported, and to those already imported by `transactions.rules.apply_rules`.
+    """
+    WEEKDAY_CHOICES = tuple(enumerate(calendar.day_name))
+
+    category = models.ForeignKey(Category, related_name='rules')
+    priority = models.IntegerField(default=0, help_text='Rules with a lower priority are tried first')
+    counterparty = models.ForeignKey(CounterParty, null=True, blank=True)
+    description_regex = models.CharField(max_length=200, blank=True,
+                                         help_text='Searched for in the statement line of the transaction')
+    min_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True,
+                                     help_text='Outgoing amounts are negative')
+    max_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    transaction_type = models.CharField(max_length=64, blank=True)
+    weekday = models.IntegerField(choices=WEEKDAY_CHOICES, null=True, blank=True)
+
+    class Meta:
+        ordering = ('priority', 'id')
+
+    def __str__(self):
+        criteria = []
+
+        if self.counterparty_id is not None:
+            criteria.append('counterparty {}'.format(self.counterparty_id))
+        if self.description_regex:
+            criteria.append('description ~ {!r}'.format(self.description_regex))
+        if self.min_amount is not None:
+            criteria.append('amount >= {}'.format(self.min_amount))
+        if self.max_amount is not None:
+            criteria.append('amount <= {}'.format(self.max_amount))
+        if self.transaction_type:
+            criteria.append('type {}'.format(self.transaction_type))
+        if self.weekday is not None:
+            criteria.append('on {}'.format(self.get_weekday_display()))
+
+        return '{} -> {}'.format(', '.join(criteria) or 'everything', self.category)
+
+    def clean(self):
+        if self.description_regex:
+            try:
+                re.compile(self.description_regex)
+            except re.error as e:
+                raise ValidationError({'description_regex': 'invalid regular expression: {}'.format(e)})
+
+        if self.transaction_type:
+            try:
+                self.get_transaction_model()
+            except LookupError:
+                raise ValidationError({'transaction_type': 'unknown transaction type'})
+
+    def get_transaction_model(self):
+        return apps.get_model('transactions', self.transaction_type)
+
+    def as_q(self):
+        """
+        Returns a Q object selecting the transactions this rule matches, for filtering querysets of `Transaction`.
+        """
+        q = Q()
+
+        if self.counterparty_id is not None:
+            q &= Q(counterparty_alias__counterparty=self.counterparty_id)
+        if self.description_regex:
+            q &= Q(description__regex=self.description_regex)
+        if self.min_amount is not None:
+            q &= Q(amount__gte=self.min_amount)
+        if self.max_amount is not None:
+            q &= Q(amount__lte=self.max_amount)
+        if self.transaction_type:
+            # like `instance_of`, subclasses of the type match too
+            model = self.get_transaction_model()
+            q &= Q(polymorphic_ctype__in=[
+                ContentType.objects.get_for_model(sub_model, for_concrete_model=False).pk
+                for sub_model in apps.get_models() if issubclass(sub_model, model)
+            ])
+        if self.weekday is not None:
+            # `week_day` counts from 1 on Sunday, where `weekday` counts from 0 on Monday
+            q &= Q(date__week_day=(self.weekday + 1) % 7 + 1)
+
+        return q
+
+    def matches(self, transaction):
+        """
+        Returns whether the unsaved `transaction` matches this rule, with the same meaning as `as_q`.
+        """
+        if self.counterparty_id is not None:
+            alias = transaction.counterparty_alias
+            if alias is None or alias.counterparty_id != self.counterparty_id:
+                return False
+
+        if self.description_regex:
+            if not hasattr(self, '_description_pattern'):
+                self._description_pattern = re.compile(self.description_regex)
+
+            if not self._description_pattern.search(transaction.description):
+                return False
+
+        if self.min_amount is not None and transaction.amount < self.min_amount:
+            return False
+        if self.max_amount is not None and transaction.amount > self.max_amount:
+            return False
+        if self.transaction_type and not isinstance(transaction, self.get_transaction_model()):
+            return False
+        if self.weekday is not None and transaction.date.weekday() != self.weekday:
+            return False
+
+        return True
+
+
+class DailyBalance(models.Model):
+    """
+    The balance of the account at the end of each day with cleared transactions, from the balances on the statements.
+    Kept up to date by `transactions.balances` as transactions are imported, so that the balance on any date is a
+    single indexed lookup rather than a sum over every earlier transaction.
+    """
+    date = models.DateField(unique=True)
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+
+    def __repr__(self):
+        return '<{} {} balance={}>'.format(self.__class__.__name__, self.date.strftime('%d/%m/%Y'), self.balance)
+
+
+class RecurringSeries(models.Model):
+    """
+    A schedule of payments detected by `transactions.recurring`: the payments of a direct debit or standing order
+    mandate, of a regular transfer mandate, or of the same amount to the same counterparty, made at a regular interval.
+    """
+    class Kind:
+        AMOUNT = 0
+        PAYMENT_MANDATE = 1
+        TRANSFER_MANDATE = 2
+
+        CHOICES = (
+            (AMOUNT, 'same amount'),
+            (PAYMENT_MANDATE, 'payment mandate'),
+            (TRANSFER_MANDATE, 'regular transfer mandate'),
+        )
+
+    class Interval:
+        WEEKLY = 'weekly'
+        FORTNIGHTLY = 'fortnightly'
+        MONTHLY = 'monthly'
+        QUARTERLY = 'quarterly'
+        YEARLY = 'yearly'
+
+        CHOICES = (
+            (WEEKLY, 'weekly'),
+            (FORTNIGHTLY, 'fortnightly'),
+            (MONTHLY, 'monthly'),
+            (QUARTERLY, 'quarterly'),
+            (YEARLY, 'yearly'),
+        )
+
+    key = models.CharField(max_length=140, unique=True)
+    kind = models.IntegerField(choices=Kind.CHOICES)
+    counterparty = models.ForeignKey(CounterParty, null=True, blank=True)
+    account = models.CharField(max_length=15, blank=True)  # sort code and account number of a regular transfer
+    mandate = models.IntegerField(null=True, blank=True)
+    interval = models.CharField(max_length=16, choices=Interval.CHOICES)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)  # of the latest payment
+    occurrences = models.IntegerField()
+    first_date = models.DateField()
+    last_date = models.DateField()
+    next_date = models.DateField()
+
+    class Meta:
+        verbose_name_plural = 'recurring series'
+
+    def __str__(self):
+        if self.counterparty_id is not None:
+            payee = self.counterparty_id
+        else:
+            payee = self.account
+
+        return '{} {} {}'.format(self.interval, payee, self.amount)
+
+    def __repr__(self):
+        return '<{} {!r} {} amount={} next={}>'.format(self.__class__.__name__, self.key, self.interval, self.amount,
+                                                      self.next_date.strftime('%d/%m/%Y'))
+
+
+class DataVersion(models.Model):
+    """
+    A counter incremented whenever the data it covers is written, so that pages built from that data can be
+    revalidated by comparing versions rather than by reading the transactions again.
+
+    The `GLOBAL` version covers every write, and the `SHARED` version writes that could change any page (such as a
+    category being renamed). Writes to the transactions of a month or a counterparty also bump their own versions.
+    """
+    GLOBAL = 'global'
+    SHARED = 'shared'
+
+    key = models.CharField(max_length=120, primary_key=True)
+    version = models.IntegerField(default=0)
+    modified = models.DateTimeField()
+
+    def __repr__(self):
+        return '<{} {}={}>'.format(self.__class__.__name__, self.key, self.version)
+
+    @staticmethod
+    def month_key(year, month):
+        return 'month:{}-{:02}'.format(year, month)
+
+    @staticmethod
+    def counterparty_key(counterparty_id):
+        return 'counterparty:{}'.format(counterparty_id)
+
+    @classmethod
+    def bump(cls, months=(), counterparties=(), shared=False):
+        """
+        Increments the global version, the versions of the (year, month) tuples in `months` and of the counterparty
+        primary keys in `counterparties`, and with `shared` the shared version.
+        """
+        keys = {cls.GLOBAL}
+        keys.update(cls.month_key(year, month) for year, month in months)
+        keys.update(cls.counterparty_key(counterparty_id) for counterparty_id in counterparties
+                    if counterparty_id is not None)
+
+        if shared:
+            keys.add(cls.SHARED)
+
+        keys = list(keys)
+        now = timezone.now()
+
+        # keep under the bound parameter limit of SQLite
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            existing = set(cls.objects.filter(key__in=chunk).values_list('key', flat=True))
+
+            cls.objects.filter(key__in=existing).update(version=F('version') + 1, modified=now)
+            cls.objects.bulk_create([cls(key=key, version=1, modified=now) for key in chunk if key not in existing])
+
+    @classmethod
+    def get_versions(cls, keys):
+        """
+        Returns a dict mapping each of `keys` to a (version, modified) tuple, which is (0, None) for data never
+        written.
+        """
+        versions = dict.fromkeys(keys, (0, None))
+        versions.update((key, (version, modified)) for key, version, modified in cls.objects.filter(
+            key__in=keys).values_list('key', 'version', 'modified'))
+        return versions
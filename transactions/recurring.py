@@ -0,0 +1,308 @@
+import decimal
+import calendar
+import datetime
+from collections import OrderedDict
+
+import numpy as np
+
+from django.db.models import Max
+
+from .models import Transaction, PaymentTransaction, RegularTransferTransaction, RecurringSeries, DataVersion
+from .balances import balance_at
+
+
+# The range of days between the payments of a series at each interval (payments due on a weekend or bank holiday
+# are taken early or late), and the (days, months) between the payments forecast
+INTERVALS = OrderedDict((
+    (RecurringSeries.Interval.WEEKLY, (5, 9, (7, 0))),
+    (RecurringSeries.Interval.FORTNIGHTLY, (11, 17, (14, 0))),
+    (RecurringSeries.Interval.MONTHLY, (25, 36, (0, 1))),
+    (RecurringSeries.Interval.QUARTERLY, (80, 100, (0, 3))),
+    (RecurringSeries.Interval.YEARLY, (350, 380, (0, 12))),
+))
+
+# The fewest payments of a series, and the smallest share of the gaps between them that must be at its interval
+MIN_OCCURRENCES = 3
+MIN_REGULARITY = 0.75
+
+# Keeps `key__in` lists under the bound parameter limit of SQLite
+CHUNK_SIZE = 500
+
+# Each row's candidate series is packed into one int64 key, so that grouping the rows is a single sort: the kind of
+# series, the payee (a counterparty code of the snapshot, or an index into the regular transfer accounts) and the
+# mandate or amount in pence
+_KIND_SHIFT = 60
+_PAYEE_SHIFT = 40
+_VALUE_OFFSET = 1 << 39
+
+
+def _interval_lookup():
+    """
+    Returns an array mapping a number of days between payments to the index of its interval in `INTERVALS`, or -1.
+    The last element covers every longer gap.
+    """
+    lookup = np.full(max(longest for shortest, longest, step in INTERVALS.values()) + 2, -1, dtype=np.int64)
+
+    for index, (shortest, longest, step) in enumerate(INTERVALS.values()):
+        lookup[shortest:longest + 1] = index
+
+    return lookup
+
+
+def _candidate_keys(snapshot):
+    """
+    Returns the packed key of the candidate series of each row of `snapshot` (or -1 for a row that cannot be part of
+    one), and the list of (sort code, account number) tuples of the regular transfers. The snapshot must be up to
+    date.
+    """
+    kinds = np.full(len(snapshot), RecurringSeries.Kind.AMOUNT, dtype=np.int64)
+    payees = snapshot.counterparty.astype(np.int64)
+    values = snapshot.amount.astype(np.int64)
+    max_id = snapshot.meta['max_id']
+
+    payments = np.array(list(PaymentTransaction.objects.filter(id__lte=max_id).exclude(mandate=0).values_list(
+        'id', 'mandate')), dtype=np.int64).reshape(-1, 2)
+    rows = np.searchsorted(snapshot.id, payments[:, 0])
+    kinds[rows] = RecurringSeries.Kind.PAYMENT_MANDATE
+    values[rows] = payments[:, 1]
+
+    transfers = list(RegularTransferTransaction.objects.filter(id__lte=max_id).values_list(
+        'id', 'mandate', 'sortcode', 'account_number'))
+    accounts = sorted({(sortcode, account_number) for pk, mandate, sortcode, account_number in transfers})
+    account_codes = {account: code for code, account in enumerate(accounts)}
+
+    rows = np.searchsorted(snapshot.id, np.array([transfer[0] for transfer in transfers], dtype=np.int64))
+    kinds[rows] = RecurringSeries.Kind.TRANSFER_MANDATE
+    payees[rows] = [account_codes[transfer[2:]] for transfer in transfers]
+    values[rows] = [transfer[1] for transfer in transfers]
+
+    keys = (kinds << _KIND_SHIFT) | (payees << _PAYEE_SHIFT) | (values + _VALUE_OFFSET)
+    keys[payees < 0] = -1
+    return keys, accounts
+
+
+def _describe(key, snapshot, accounts):
+    """
+    Returns a dict of the `RecurringSeries` fields identifying the candidate series of the packed `key`.
+    """
+    kind = key >> _KIND_SHIFT
+    payee = (key >> _PAYEE_SHIFT) & ((1 << (_KIND_SHIFT - _PAYEE_SHIFT)) - 1)
+    value = (key & ((1 << _PAYEE_SHIFT) - 1)) - _VALUE_OFFSET
+
+    if kind == RecurringSeries.Kind.TRANSFER_MANDATE:
+        account = '{}-{}'.format(*accounts[payee])
+        return {'key': 'transfer:{}:{}'.format(account, value), 'kind': kind, 'counterparty_id': None,
+                'account': account, 'mandate': value}
+
+    counterparty = snapshot.counterparties[payee]
+
+    if kind == RecurringSeries.Kind.PAYMENT_MANDATE:
+        return {'key': 'payment:{}:{}'.format(counterparty, value), 'kind': kind, 'counterparty_id': counterparty,
+                'account': '', 'mandate': value}
+
+    return {'key': 'amount:{}:{}'.format(counterparty, value), 'kind': kind, 'counterparty_id': counterparty,
+            'account': '', 'mandate': None}
+
+
+def step(date, interval, count=1):
+    """
+    Returns the date `count` intervals after `date`. Monthly intervals keep to the day of the month of `date` where
+    the month is long enough.
+    """
+    days, months = INTERVALS[interval][2]
+
+    if not months:
+        return date + datetime.timedelta(days=days * count)
+
+    index = date.month - 1 + months * count
+    year, month = date.year + index // 12, index % 12 + 1
+    return datetime.date(year, month, min(date.day, calendar.monthrange(year, month)[1]))
+
+
+def detect_series(snapshot, after_id=None):
+    """
+    Returns a tuple of the keys of the candidate series checked, and a list of the unsaved `RecurringSeries` found
+    among them. With `after_id`, only the series of the transactions with greater ids are checked, each still over
+    its full history.
+
+    The rows of every candidate series are grouped and their gaps classified in one pass over the snapshot's columns,
+    so only the series found are handled one at a time.
+    """
+    keys, accounts = _candidate_keys(snapshot)
+    mask = keys >= 0
+
+    if after_id is not None:
+        mask &= np.in1d(keys, keys[mask & (snapshot.id > after_id)])
+
+    keys, dates, amounts = keys[mask], snapshot.date[mask].astype(np.int64), snapshot.amount[mask]
+
+    if not len(keys):
+        return [], []
+
+    order = np.lexsort((dates, keys))
+    keys, dates, amounts = keys[order], dates[order], amounts[order]
+
+    boundaries = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(np.concatenate(([True], boundaries)))
+    ends = np.append(starts[1:], len(keys)) - 1
+    groups = np.cumsum(np.concatenate(([0], boundaries)))
+    occurrences = ends - starts + 1
+
+    # count the gaps of each series at each interval, ignoring those between the rows of different series
+    lookup = _interval_lookup()
+    gaps = lookup[np.clip(np.diff(dates), 0, len(lookup) - 1)]
+    within = ~boundaries & (gaps >= 0)
+    counts = np.bincount(groups[1:][within] * len(INTERVALS) + gaps[within],
+                         minlength=len(starts) * len(INTERVALS)).reshape(len(starts), len(INTERVALS))
+
+    best = counts.argmax(axis=1)
+    regular = (occurrences >= MIN_OCCURRENCES) & (
+        counts[np.arange(len(starts)), best] >= MIN_REGULARITY * (occurrences - 1))
+
+    checked = [_describe(key, snapshot, accounts)['key'] for key in keys[starts].tolist()]
+    intervals = list(INTERVALS)
+    detected = []
+
+    for group in np.flatnonzero(regular).tolist():
+        last_date = datetime.date.fromordinal(int(dates[ends[group]]))
+        interval = intervals[best[group]]
+
+        detected.append(RecurringSeries(
+            interval=interval,
+            amount=decimal.Decimal(int(amounts[ends[group]])).scaleb(-2),
+            occurrences=int(occurrences[group]),
+            first_date=datetime.date.fromordinal(int(dates[starts[group]])),
+            last_date=last_date,
+            next_date=step(last_date, interval),
+            **_describe(int(keys[starts[group]]), snapshot, accounts)
+        ))
+
+    return checked, detected
+
+
+def update_recurring(snapshot, after_id=None):
+    """
+    Stores the recurring series detected in `snapshot`, which must be up to date. With `after_id`, only the series of
+    the transactions with greater ids (such as those just imported) are re-checked, and the rest are left as they
+    are. Returns a tuple of the number of candidate series checked and the number of them found to be recurring.
+    """
+    checked, detected = detect_series(snapshot, after_id)
+    existing = {}
+
+    if after_id is None:
+        RecurringSeries.objects.all().delete()
+    else:
+        for i in range(0, len(checked), CHUNK_SIZE):
+            existing.update((series.key, series) for series in RecurringSeries.objects.filter(
+                key__in=checked[i:i + CHUNK_SIZE]))
+
+    new_series = []
+
+    for series in detected:
+        current = existing.pop(series.key, None)
+
+        if current is None:
+            new_series.append(series)
+        else:
+            series.pk = current.pk
+            series.save()
+
+    # series checked again that are no longer regular
+    stale = [series.pk for series in existing.values()]
+    for i in range(0, len(stale), CHUNK_SIZE):
+        RecurringSeries.objects.filter(pk__in=stale[i:i + CHUNK_SIZE]).delete()
+
+    RecurringSeries.objects.bulk_create(new_series)
+    DataVersion.bump()
+
+    return len(checked), len(detected)
+
+
+def active_series(as_of=None):
+    """
+    Returns a list of the recurring series that have not missed a payment as of `as_of`, by default the date of the
+    latest transaction imported (so that statements not yet imported do not make every series look lapsed).
+    """
+    if as_of is None:
+        as_of = Transaction.base_objects.aggregate(latest=Max('date'))['latest']
+
+        if as_of is None:
+            return []
+
+    active = []
+
+    for series in RecurringSeries.objects.all():
+        shortest, longest, interval_step = INTERVALS[series.interval]
+
+        if series.next_date + datetime.timedelta(days=longest - shortest) >= as_of:
+            active.append(series)
+
+    return active
+
+
+def expected_payments(series, start, end):
+    """
+    Returns a list of the dates of the payments of `series` expected from `start` to `end` (inclusive), after its
+    latest payment.
+    """
+    dates = []
+    count = 1
+
+    while True:
+        date = step(series.last_date, series.interval, count)
+        if date > end:
+            return dates
+
+        if date >= start:
+            dates.append(date)
+
+        count += 1
+
+
+def forecast(start, end):
+    """
+    Returns the payments of the active recurring series expected from `start` to `end` (inclusive), and the net
+    cashflow and balance of each day, as a dict ready to be serialised as JSON.
+
+    The balance is projected from the latest known balance on or before `start`, including the payments expected
+    between the two; it is None if no balance is known.
+    """
+    opening, as_of = balance_at(start)
+    first = as_of + datetime.timedelta(days=1) if as_of else start
+
+    payments = []
+    for series in active_series():
+        payments.extend((date, series) for date in expected_payments(series, first, end))
+
+    payments.sort(key=lambda payment: (payment[0], payment[1].pk))
+
+    net = OrderedDict((start + datetime.timedelta(days=i), 0) for i in range((end - start).days + 1))
+    balance = opening
+
+    for date, series in payments:
+        if date < start:
+            balance += series.amount
+        else:
+            net[date] += series.amount
+
+    days = []
+    for date, amount in net.items():
+        if balance is not None:
+            balance += amount
+
+        days.append([date.isoformat(), float(amount), None if balance is None else float(balance)])
+
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'opening': {'balance': None if opening is None else float(opening),
+                    'as_of': None if as_of is None else as_of.isoformat()},
+        'payments': [{
+            'date': date.isoformat(),
+            'amount': float(series.amount),
+            'series': series.pk,
+            'name': str(series),
+            'interval': series.interval,
+        } for date, series in payments],
+        'days': days,
+    }
@@ -0,0 +1,134 @@
+import decimal
+
+from django.db.models import Sum, Count
+
+from .models import Transaction, MonthlyCategoryRollup
+
+
+class RollupDeltas:
+    """
+    Changes to be made to `MonthlyCategoryRollup` rows, accumulated in memory and applied with `apply`.
+
+    Rows are read, adjusted in Python and written back rather than updated with arithmetic in SQL, as SQLite would
+    otherwise accumulate floating point error in the totals.
+    """
+
+    def __init__(self):
+        self.deltas = {}
+
+    def __bool__(self):
+        return bool(self.deltas)
+
+    def category_counts(self):
+        """
+        Returns a dict mapping category primary keys to the change in their number of transactions.
+        """
+        counts = {}
+
+        for (year, month, category_id), (net, incoming, outgoing, count) in self.deltas.items():
+            counts[category_id] = counts.get(category_id, 0) + count
+
+        return counts
+
+    def months(self):
+        """
+        Returns the set of (year, month) tuples with changes.
+        """
+        return {(year, month) for year, month, category_id in self.deltas}
+
+    def add(self, date, category_id, amount, count=1, sign=1):
+        """
+        Adds `count` transactions on `date` in `category_id` totalling `amount` to the rollups, or subtracts them
+        if `sign` is -1. Transactions added together must all be incoming or all outgoing.
+        """
+        delta = self.deltas.setdefault((date.year, date.month, category_id), [decimal.Decimal(0)] * 3 + [0])
+
+        delta[0] += sign * amount
+        delta[1 if amount > 0 else 2] += sign * amount
+        delta[3] += sign * count
+
+    def add_transactions(self, transactions, sign=1):
+        for transaction in transactions:
+            self.add(transaction.date, transaction.category_id, transaction.amount, sign=sign)
+
+    def add_queryset(self, queryset, sign=1):
+        """
+        Adds the transactions in `queryset` to the rollups, with two queries grouping them by day and category.
+        """
+        for date, category_id, total, count in self.group(queryset):
+            self.add(date, category_id, total, count=count, sign=sign)
+
+    def move_queryset(self, queryset, category_id):
+        """
+        Moves the transactions in `queryset` from their current category to `category_id` in the rollups.
+        """
+        for date, old_category_id, total, count in self.group(queryset):
+            self.add(date, old_category_id, total, count=count, sign=-1)
+            self.add(date, category_id, total, count=count)
+
+    @staticmethod
+    def group(queryset):
+        """
+        Yields a (date, category id, total, count) tuple for the incoming and for the outgoing transactions of each
+        day and category in `queryset`.
+        """
+        for amount_filter in ({'amount__gt': 0}, {'amount__lte': 0}):
+            rows = queryset.filter(**amount_filter).order_by().values('date', 'category').annotate(
+                total=Sum('amount'), count=Count('pk'))
+
+            for row in rows:
+                yield row['date'], row['category'], row['total'], row['count']
+
+    def apply(self):
+        if not self.deltas:
+            return
+
+        deltas, self.deltas = self.deltas, {}
+
+        existing = {
+            (rollup.year, rollup.month, rollup.category_id): rollup
+            for rollup in MonthlyCategoryRollup.objects.filter(
+                year__in={year for year, month, category_id in deltas},
+                month__in={month for year, month, category_id in deltas},
+            )
+        }
+        new_rollups = []
+        emptied = []
+
+        for key, (net, incoming, outgoing, count) in deltas.items():
+            rollup = existing.get(key)
+
+            if rollup is None:
+                if not count:
+                    continue
+
+                year, month, category_id = key
+                new_rollups.append(MonthlyCategoryRollup(
+                    year=year, month=month, category_id=category_id,
+                    net=net, incoming=incoming, outgoing=outgoing, count=count))
+                continue
+
+            rollup.net += net
+            rollup.incoming += incoming
+            rollup.outgoing += outgoing
+            rollup.count += count
+
+            # a month and category left without transactions has no rollup, as after a rebuild
+            if rollup.count:
+                rollup.save()
+            else:
+                emptied.append(rollup.pk)
+
+        MonthlyCategoryRollup.objects.filter(pk__in=emptied).delete()
+        MonthlyCategoryRollup.objects.bulk_create(new_rollups)
+
+
+def rebuild_rollups():
+    """
+    Recalculates every rollup from the transactions table.
+    """
+    MonthlyCategoryRollup.objects.all().delete()
+
+    deltas = RollupDeltas()
+    deltas.add_queryset(Transaction.objects.all())
+    deltas.apply()
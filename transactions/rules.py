@@ -0,0 +1,77 @@
+from django.db.models import Count
+
+from .models import CategoryRule
+from .categorisation import set_category
+
+
+def load_rules():
+    """
+    Returns a list of every rule, in the order they are tried.
+    """
+    return list(CategoryRule.objects.select_related('category'))
+
+
+def match_rule(rules, transaction):
+    """
+    Returns the first of `rules` matching the unsaved `transaction`, or None if none match.
+    """
+    for rule in rules:
+        if rule.matches(transaction):
+            return rule
+
+    return None
+
+
+def categorise_new(rules, transactions):
+    """
+    Categorises each of the unsaved `transactions` by the first of `rules` it matches, in memory, as they are
+    imported. Transactions matching no rule keep the category of their counterparty. Returns the number categorised.
+    """
+    categorised = 0
+
+    for transaction in transactions:
+        rule = match_rule(rules, transaction)
+
+        if rule is not None:
+            transaction.category = rule.category
+            categorised += 1
+
+    return categorised
+
+
+def apply_rules(transactions, rules=None):
+    """
+    Categorises the transactions in the queryset `transactions` by the first of `rules` (by default every rule) that
+    each matches. Returns a list with a (rule, changes) tuple for each rule, where `changes` maps the primary key of
+    each category (or None) transactions were moved out of to the number moved.
+
+    Rather than testing each transaction against each rule, each rule is run as a single UPDATE of every transaction
+    it matches that no earlier rule matches, so the cost grows with the number of rules rather than transactions.
+    """
+    if rules is None:
+        rules = load_rules()
+
+    results = []
+    earlier = []
+
+    for rule in rules:
+        queryset = transactions.filter(rule.as_q()).exclude(category=rule.category)
+
+        for q in earlier:
+            queryset = queryset.exclude(q)
+
+        changes = dict(queryset.order_by().values('category').annotate(count=Count('pk')).values_list(
+            'category', 'count'))
+
+        if changes:
+            set_category(queryset, rule.category)
+
+        results.append((rule, changes))
+
+        if not rule.as_q():
+            # a rule without criteria matches everything, leaving nothing for the rules after it
+            break
+
+        earlier.append(rule.as_q())
+
+    return results
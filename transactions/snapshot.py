@@ -0,0 +1,262 @@
+import os
+import json
+import shutil
+import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where concurrent refreshes are left unguarded
+    fcntl = None
+
+import numpy as np
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Sum
+
+from .models import Transaction, DataVersion
+
+
+# The dtype of each column of the snapshot, stored one file per column
+COLUMNS = OrderedDict((
+    ('id', np.int64),
+    ('date', np.int32),  # proleptic Gregorian ordinal, as from `date.toordinal`
+    ('amount', np.int64),  # in pence
+    ('category', np.int32),  # -1 when uncategorised
+    ('counterparty', np.int32),  # index into `Snapshot.counterparties`, or -1 without a counterparty
+    ('ctype', np.int32),  # content type of the transaction subclass
+))
+
+# Number of rows read from the database at a time while writing the snapshot
+CHUNK_SIZE = 10000
+
+# Ordinal of 1970-01-01, for converting the date column to datetime64
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def get_snapshot_dir():
+    return getattr(settings, 'SNAPSHOT_DIR', os.path.join(settings.BASE_DIR, 'snapshot'))
+
+
+class Snapshot:
+    """
+    A read-only columnar copy of the transactions table, as NumPy arrays memory-mapped from one file per column, for
+    analytics that would otherwise aggregate the multi-table transaction hierarchy with SQL. Rows are in order of id.
+
+    Loading a snapshot only maps its files, so columns are read from disk (or the page cache) as they are used.
+    `refresh_snapshot` brings the files up to date with the database.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.counterparties = meta['counterparties']
+
+        for name, dtype in COLUMNS.items():
+            if meta['count']:
+                column = np.memmap(_column_path(path, meta, name), dtype=dtype, mode='r', shape=(meta['count'],))
+            else:
+                # empty files cannot be mapped
+                column = np.zeros(0, dtype=dtype)
+
+            setattr(self, name, column)
+
+    def __len__(self):
+        return self.meta['count']
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Returns the snapshot stored in `path` (by default `settings.SNAPSHOT_DIR`), or None if there is none.
+        """
+        path = path or get_snapshot_dir()
+        meta = _read_meta(path)
+
+        if meta is None:
+            return None
+
+        return cls(path, meta)
+
+    def datetimes(self):
+        """
+        Returns the date column as an array of datetime64[D].
+        """
+        return (self.date - EPOCH_ORDINAL).astype('datetime64[D]')
+
+    def models(self):
+        """
+        Returns a dict mapping each value of the ctype column to the transaction subclass.
+        """
+        return {ctype_id: ContentType.objects.get_for_id(ctype_id).model_class() for ctype_id in np.unique(self.ctype)}
+
+
+def _column_path(path, meta, name):
+    return os.path.join(path, str(meta['build']), name + '.bin')
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_meta(path, meta):
+    # replaced in one step, so readers never see the row count of a partly written snapshot
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+
+@contextmanager
+def _locked(path):
+    """
+    Holds an exclusive lock on the snapshot in `path`, so that only one process or thread at a time writes its files.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # released when the file is closed
+    with open(os.path.join(path, 'lock'), 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+        yield
+
+
+def _data_version():
+    return DataVersion.get_versions([DataVersion.GLOBAL])[DataVersion.GLOBAL][0]
+
+
+def _database_state(max_id):
+    """
+    Returns the values recorded with a snapshot to tell whether the transactions up to `max_id` have since changed.
+    """
+    totals = Transaction.base_objects.filter(id__lte=max_id).aggregate(count=Count('id'), versions=Sum('version'))
+
+    return {
+        'count': totals['count'],
+        'versions': totals['versions'] or 0,
+        'shared_version': DataVersion.get_versions([DataVersion.SHARED])[DataVersion.SHARED][0],
+    }
+
+
+def _append_rows(path, meta):
+    """
+    Appends the transactions with ids above `meta['max_id']` to the column files, in chunks, and updates `meta`.
+    Returns the number of rows appended.
+    """
+    counterparty_codes = {name: code for code, name in enumerate(meta['counterparties'])}
+    files = {}
+
+    for name, dtype in COLUMNS.items():
+        # discard anything written after the row count was last recorded, such as by an interrupted refresh
+        files[name] = open(_column_path(path, meta, name), 'r+b')
+        files[name].truncate(meta['count'] * np.dtype(dtype).itemsize)
+        files[name].seek(0, os.SEEK_END)
+
+    appended = 0
+
+    try:
+        while True:
+            rows = list(Transaction.base_objects.filter(id__gt=meta['max_id']).order_by('id').values_list(
+                'id', 'date', 'amount', 'category', 'counterparty_alias__counterparty', 'polymorphic_ctype'
+            )[:CHUNK_SIZE])
+
+            if not rows:
+                break
+
+            for row in rows:
+                if row[4] is not None and row[4] not in counterparty_codes:
+                    counterparty_codes[row[4]] = len(meta['counterparties'])
+                    meta['counterparties'].append(row[4])
+
+            columns = (
+                [row[0] for row in rows],
+                [row[1].toordinal() for row in rows],
+                [round(row[2] * 100) for row in rows],
+                [-1 if row[3] is None else row[3] for row in rows],
+                [-1 if row[4] is None else counterparty_codes[row[4]] for row in rows],
+                [row[5] for row in rows],
+            )
+
+            for (name, dtype), values in zip(COLUMNS.items(), columns):
+                files[name].write(np.array(values, dtype=dtype).tobytes())
+
+            meta['max_id'] = rows[-1][0]
+            meta['count'] += len(rows)
+            appended += len(rows)
+    finally:
+        for f in files.values():
+            f.close()
+
+    return appended
+
+
+def rebuild_snapshot(path=None):
+    """
+    Writes a new snapshot of every transaction to `path` (by default `settings.SNAPSHOT_DIR`). Returns the number of
+    rows.
+
+    Each build is written to its own subdirectory, and only replaces the previous build once complete, so snapshots
+    already loaded from the previous build can still be read.
+    """
+    path = path or get_snapshot_dir()
+
+    with _locked(path):
+        return _rebuild_snapshot(path, _data_version())
+
+
+def _rebuild_snapshot(path, data_version):
+    previous = _read_meta(path)
+
+    meta = {'build': previous['build'] + 1 if previous else 1, 'count': 0, 'max_id': 0, 'counterparties': []}
+    os.makedirs(os.path.join(path, str(meta['build'])), exist_ok=True)
+
+    for name in COLUMNS:
+        open(_column_path(path, meta, name), 'wb').close()
+
+    _append_rows(path, meta)
+    meta.update(_database_state(meta['max_id']), data_version=data_version)
+    _write_meta(path, meta)
+
+    for name in os.listdir(path):
+        if name.isdigit() and int(name) != meta['build']:
+            # files still mapped cannot be removed on Windows, and are left for the next rebuild
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    return meta['count']
+
+
+def refresh_snapshot(path=None):
+    """
+    Brings the snapshot in `path` (by default `settings.SNAPSHOT_DIR`) up to date with the database. Transactions
+    imported since it was written are appended to it, but if transactions already in it have changed since (such as
+    by being recategorised or deleted, or their alias moving to another counterparty) it is rebuilt. Returns a tuple
+    of (whether the snapshot was rebuilt, the number of rows written).
+
+    The snapshot records the global data version read before refreshing, so that processes loading it can tell
+    whether it is already up to date without checking the transactions table.
+    """
+    path = path or get_snapshot_dir()
+
+    with _locked(path):
+        # read again under the lock, as another process may have just refreshed the snapshot
+        meta = _read_meta(path)
+        data_version = _data_version()
+
+        if meta is None or _database_state(meta['max_id']) != {key: meta[key] for key in ('count', 'versions',
+                                                                                           'shared_version')}:
+            return True, _rebuild_snapshot(path, data_version)
+
+        appended = _append_rows(path, meta)
+
+        if appended or meta.get('data_version') != data_version:
+            meta.update(_database_state(meta['max_id']), data_version=data_version)
+            _write_meta(path, meta)
+
+    return False, appended
@@ -1,3 +1,676 @@
+import io
+import os
+import csv
+import shutil
+import tempfile
+import json
+import datetime
+import decimal
+import unittest
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.template.loader import render_to_string
+
+from counterparty.models import Alias, CounterParty
+from statementimport.santander import SantanderImporter
+from statementimport.synthetic import write_statement
+from statementimport.writer import TransactionWriter
+from .categorisation import set_category, delete_transactions, delete_if_unused
+from .rollups import rebuild_rollups
+from .hierarchy import rebuild_closure, subtree_totals
+from .loading import load_transactions
+from .export import iter_transactions
+from .snapshot import Snapshot, refresh_snapshot, fcntl
+from .analytics import get_snapshot
+from .rules import load_rules, match_rule, apply_rules
+from .balances import closing_balance, update_daily_balances, check_balances, balance_at
+from .recurring import update_recurring
+from .models import *
+
+
+class TransactionFixtureTestCase(TestCase):
+    date = datetime.date(2014, 6, 2)
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Groceries')
+        counterparty = CounterParty.objects.create(name='Tesco')
+        self.alias = Alias.objects.create(alias='TESCO STORES 1234', counterparty=counterparty)
+
+    def create_transactions(self, count):
+        """
+        Creates `count` transactions of each of several subclasses, with and without related objects.
+        """
+        common = {'date': self.date, 'cleared_date': self.date, 'week': self.date.isocalendar()[1]}
+        amount = decimal.Decimal('-1.00')
+
+        for i in range(count):
+            PaymentTransaction.objects.create(amount=amount, counterparty_alias=self.alias, category=self.category,
+                                              ref='REF', type=PaymentTransaction.PaymentType.DIRECT_DEBIT, **common)
+            CardPaymentTransaction.objects.create(amount=amount, counterparty_alias=self.alias, requested_amount=1,
+                                                  currency='GBP', rate=0, **common)
+            CreditTransaction.objects.create(amount=-amount, counterparty_alias=self.alias, category=self.category,
+                                             type=CreditTransaction.CreditType.GIRO, **common)
+            CashWithdrawalTransaction.objects.create(amount=amount, atm='ATM', area='AREA', requested_amount=1,
+                                                     currency='GBP', **common)
+            InterestTransaction.objects.create(amount=-amount, tax=0, **common)
+
+    def count_queries(self, func):
+        # run once first, so that anything cached on first use (such as content types) is not counted
+        func()
+
+        with CaptureQueriesContext(connection) as context:
+            func()
+
+        return len(context.captured_queries)
+
+
+class SnapshotDirMixin:
+    """
+    Points SNAPSHOT_DIR at a temporary directory for each test, so that snapshots are never shared between tests.
+    """
+
+    def setUp(self):
+        super().setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        settings_override = self.settings(SNAPSHOT_DIR=path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class LoadTransactionsTest(TransactionFixtureTestCase):
+    def test_subclasses_in_order(self):
+        self.create_transactions(2)
+        queryset = Transaction.objects.order_by('-id')
+
+        self.assertEqual(
+            [(type(transaction), transaction.pk) for transaction in load_transactions(queryset)],
+            [(type(transaction), transaction.pk) for transaction in queryset]
+        )
+
+    def test_related_objects_loaded(self):
+        self.create_transactions(2)
+        transactions = load_transactions(Transaction.objects.all())
+
+        with self.assertNumQueries(0):
+            for transaction in transactions:
+                str(transaction.category)
+
+                if transaction.counterparty_alias:
+                    transaction.counterparty_alias.counterparty.get_absolute_url()
+
+    def test_query_count_independent_of_rows(self):
+        self.create_transactions(1)
+        few = self.count_queries(lambda: load_transactions(Transaction.objects.all()))
+
+        self.create_transactions(120)
+        many = self.count_queries(lambda: load_transactions(Transaction.objects.all()))
+
+        # one query for the page, and one per subclass
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 1 + 5)
+
+    def test_transaction_table_query_count(self):
+        url = reverse('home') + '?year={}&month={}'.format(self.date.year, self.date.month)
+        detail_url = self.alias.counterparty.get_absolute_url()
+
+        self.create_transactions(1)
+        few = self.count_queries(lambda: self.client.get(url))
+        few_detail = self.count_queries(lambda: self.client.get(detail_url))
+
+        self.create_transactions(50)
+        many = self.count_queries(lambda: self.client.get(url))
+        many_detail = self.count_queries(lambda: self.client.get(detail_url))
+
+        self.assertEqual(few, many)
+        self.assertEqual(few_detail, many_detail)
+
+
+class TransactionDataViewTest(TransactionFixtureTestCase):
+    def test_pages_cover_every_transaction_in_order(self):
+        self.create_transactions(12)
+        expected = list(Transaction.objects.order_by('-date', '-id').values_list('pk', flat=True))
+
+        pks = []
+        url = reverse('transactions:data') + '?limit=7'
+
+        while url:
+            data = json.loads(self.client.get(url).content.decode())
+            pks.extend(transaction['id'] for transaction in data['transactions'])
+            url = data['next']
+
+        self.assertEqual(pks, expected)
+
+    def test_filters(self):
+        self.create_transactions(3)
+        url = reverse('transactions:data')
+
+        def ids(**params):
+            response = self.client.get(url, params)
+            return {transaction['id'] for transaction in json.loads(response.content.decode())['transactions']}
+
+        self.assertEqual(ids(category='none'),
+                         set(Transaction.objects.filter(category=None).values_list('pk', flat=True)))
+        self.assertEqual(ids(type='paymenttransaction'),
+                         set(PaymentTransaction.objects.values_list('pk', flat=True)))
+        self.assertEqual(ids(counterparty=self.alias.counterparty.pk),
+                         set(Transaction.objects.exclude(counterparty_alias=None).values_list('pk', flat=True)))
+        self.assertEqual(ids(end=(self.date - datetime.timedelta(days=1)).isoformat()), set())
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('transactions:data'), {'after': 'nonsense'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CategoryClosureTest(TestCase):
+    def closure(self):
+        return set(CategoryClosure.objects.values_list('ancestor__name', 'descendant__name', 'depth'))
+
+    def test_maintained_on_save_and_delete(self):
+        food = Category.objects.create(name='Food')
+        groceries = Category.objects.create(name='Groceries', parent=food)
+        fruit = Category.objects.create(name='Fruit', parent=groceries)
+        household = Category.objects.create(name='Household')
+
+        self.assertEqual(self.closure(), {
+            ('Food', 'Food', 0), ('Groceries', 'Groceries', 0), ('Fruit', 'Fruit', 0),
+            ('Household', 'Household', 0), ('Food', 'Groceries', 1), ('Food', 'Fruit', 2), ('Groceries', 'Fruit', 1),
+        })
+
+        # moving a category takes its subcategories with it
+        groceries.parent = household
+        groceries.save()
+
+        self.assertEqual(self.closure(), {
+            ('Food', 'Food', 0), ('Groceries', 'Groceries', 0), ('Fruit', 'Fruit', 0),
+            ('Household', 'Household', 0), ('Household', 'Groceries', 1), ('Household', 'Fruit', 2),
+            ('Groceries', 'Fruit', 1),
+        })
+
+        expected = self.closure()
+        rebuild_closure()
+        self.assertEqual(self.closure(), expected)
+
+        fruit.delete()
+        self.assertNotIn('Fruit', {descendant for ancestor, descendant, depth in self.closure()})
+
+    def test_subtree_totals(self):
+        food = Category.objects.create(name='Food')
+        groceries = Category.objects.create(name='Groceries', parent=food)
+        date = datetime.date(2014, 6, 2)
+
+        for category, amount in ((food, '-1.00'), (groceries, '-2.50'), (None, '-4.00')):
+            InterestTransaction.objects.create(amount=decimal.Decimal(amount), tax=0, category=category, date=date,
+                                               cleared_date=date, week=date.isocalendar()[1])
+
+        self.assertEqual(subtree_totals(Transaction.objects.all()),
+                         [(food, decimal.Decimal('-3.50')), (None, decimal.Decimal('-4.00'))])
+
+    def test_subtree_totals_uncategorised(self):
+        date = datetime.date(2014, 6, 2)
+        alias = Alias.objects.create(alias='TESCO', counterparty=CounterParty.objects.create(name='Tesco'))
+        InterestTransaction.objects.create(amount=decimal.Decimal('-4.00'), tax=0, counterparty_alias=alias,
+                                           date=date, cleared_date=date, week=date.isocalendar()[1])
+
+        self.assertEqual(subtree_totals(Transaction.objects.all()), [(None, decimal.Decimal('-4.00'))])
+        self.assertEqual(self.client.get(alias.counterparty.get_absolute_url()).status_code, 200)
+
+
+class CategoryUsageTest(TestCase):
+    def test_vacated_category_deleted(self):
+        old = Category.objects.create(name='Old')
+        kept = Category.objects.create(name='Kept')
+        new = Category.objects.create(name='New')
+        date = datetime.date(2014, 6, 2)
+
+        transactions = [
+            InterestTransaction.objects.create(amount=1, tax=0, date=date, cleared_date=date, week=1)
+            for i in range(3)
+        ]
+
+        set_category(Transaction.objects.filter(pk__in=[transactions[0].pk, transactions[1].pk]), old)
+        set_category(Transaction.objects.filter(pk=transactions[2].pk), kept)
+        self.assertEqual(Category.objects.get(pk=old.pk).transaction_count, 2)
+
+        set_category(Transaction.objects.filter(pk=transactions[0].pk), new)
+        self.assertEqual(delete_if_unused([old.pk]), [])
+
+        set_category(Transaction.objects.filter(pk=transactions[1].pk), new)
+        self.assertEqual(Category.objects.get(pk=new.pk).transaction_count, 2)
+        self.assertEqual(delete_if_unused([old.pk, kept.pk]), [old.pk])
+        self.assertTrue(Category.objects.filter(pk=kept.pk).exists())
+
+
+class RollupMaintenanceTest(TransactionFixtureTestCase):
+    def rollups(self):
+        return set(MonthlyCategoryRollup.objects.values_list(
+            'year', 'month', 'category', 'net', 'incoming', 'outgoing', 'count'))
+
+    def import_statement(self, count):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, 'statement.txt')
+
+        with open(path, 'w', encoding='cp1252') as f:
+            write_statement(f, count, end_date=self.date)
+
+        importer = SantanderImporter()
+        writer = TransactionWriter(batch_size=50, importer=importer)
+
+        for record in importer.parse(path):
+            writer.add(importer.build(record))
+
+        writer.flush()
+
+    def test_matches_rebuild(self):
+        self.import_statement(150)
+        pks = list(Transaction.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(len({(rollup[0], rollup[1]) for rollup in self.rollups()}), 3)
+
+        set_category(Transaction.objects.filter(pk__in=pks[::3]), self.category)
+        set_category(Transaction.objects.filter(pk__in=pks[::6]), Category.objects.create(name='Fees'))
+        delete_transactions(Transaction.objects.filter(pk__in=pks[1::4]))
+
+        # leave a month without any transactions
+        deleted = delete_transactions(Transaction.objects.filter(date__year=2014, date__month=5))
+        self.assertTrue(deleted)
+
+        incremental = self.rollups()
+        self.assertFalse([rollup for rollup in incremental if rollup[:2] == (2014, 5)])
+
+        # no row of a subclass table is left behind
+        for model in (CounterPartyTransaction, PaymentTransaction, CardPaymentTransaction, CreditTransaction,
+                      InterestTransaction):
+            self.assertFalse(model.base_objects.exclude(pk__in=Transaction.base_objects.values('pk')).exists())
+
+        rebuild_rollups()
+        self.assertEqual(incremental, self.rollups())
+        self.assertEqual(Category.objects.get(pk=self.category.pk).transaction_count,
+                         Transaction.objects.filter(category=self.category).count())
+
+
+class BulkCategoriseViewTest(TransactionFixtureTestCase):
+    def test_categorise_by_filter(self):
+        self.create_transactions(3)
+        uncategorised = set(Transaction.objects.filter(category=None, counterparty_alias=self.alias)
+                            .values_list('pk', flat=True))
+
+        response = self.client.post(reverse('transactions:categorise_bulk'), {
+            'category': 'Shopping', 'uncategorised': 'on', 'alias': self.alias.pk,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['updated'], len(uncategorised))
+
+        shopping = Category.objects.get(name='Shopping')
+        self.assertEqual(set(Transaction.objects.filter(category=shopping).values_list('pk', flat=True)),
+                         uncategorised)
+        self.assertEqual(shopping.transaction_count, len(uncategorised))
+
+    def test_requires_selection(self):
+        response = self.client.post(reverse('transactions:categorise_bulk'), {'category': self.category.pk})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.exclude(category=self.category).filter(category__isnull=False).exists())
+
+
+class CategoryRuleTest(TestCase):
+    def setUp(self):
+        self.coffee = Category.objects.create(name='Coffee')
+        self.weekend = Category.objects.create(name='Weekend')
+        self.monday = datetime.date(2014, 6, 2)
+
+    def create(self, description, amount, date):
+        return InterestTransaction.objects.create(amount=decimal.Decimal(amount), tax=0, description=description,
+                                                  date=date, cleared_date=date, week=date.isocalendar()[1])
+
+    def test_rules_in_priority_order(self):
+        CategoryRule.objects.create(category=self.weekend, priority=2, weekday=5)
+        CategoryRule.objects.create(category=self.coffee, priority=1, description_regex='COFFEE',
+                                    min_amount=decimal.Decimal('-5.00'), transaction_type='interesttransaction')
+
+        coffee = self.create('CARD PAYMENT TO COFFEE SHOP', '-2.50', self.monday)
+        expensive = self.create('CARD PAYMENT TO COFFEE SHOP', '-25.00', self.monday)
+        saturday_coffee = self.create('CARD PAYMENT TO COFFEE SHOP', '-2.50', self.monday + datetime.timedelta(days=5))
+        saturday = self.create('CARD PAYMENT TO SHOP', '-25.00', self.monday + datetime.timedelta(days=5))
+
+        # the rules give the same result whether applied to unsaved transactions or with queries
+        rules = load_rules()
+        self.assertEqual([getattr(match_rule(rules, transaction), 'category', None)
+                          for transaction in (coffee, expensive, saturday_coffee, saturday)],
+                         [self.coffee, None, self.coffee, self.weekend])
+
+        results = apply_rules(Transaction.objects.filter(category=None), rules)
+        self.assertEqual([changes for rule, changes in results], [{None: 2}, {None: 1}])
+
+        self.assertEqual(dict(Transaction.objects.values_list('pk', 'category')), {
+            coffee.pk: self.coffee.pk, expensive.pk: None, saturday_coffee.pk: self.coffee.pk,
+            saturday.pk: self.weekend.pk,
+        })
+        self.assertEqual(Category.objects.get(pk=self.coffee.pk).transaction_count, 2)
+
+
+class ConditionalResponseTest(TransactionFixtureTestCase):
+    def test_not_modified_until_written(self):
+        self.create_transactions(1)
+        url = reverse('transactions:in_out_data', args=[self.date.year, self.date.month])
+
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # categorising a transaction in another month leaves this month's chart unchanged
+        other_month = InterestTransaction.objects.create(amount=1, tax=0, date=datetime.date(2014, 1, 1),
+                                                         cleared_date=datetime.date(2014, 1, 1), week=1)
+        set_category(Transaction.objects.filter(pk=other_month.pk), self.category)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        set_category(Transaction.objects.filter(date=self.date, category=None), self.category)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_expired_csrf_cookie(self):
+        url = reverse('home')
+
+        # the first response sets the CSRF cookie used by the page's forms
+        self.assertIn(settings.CSRF_COOKIE_NAME, self.client.get(url).cookies)
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        del self.client.cookies[settings.CSRF_COOKIE_NAME]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+
+
+class TransactionRowCacheTest(TransactionFixtureTestCase):
+    def setUp(self):
+        super().setUp()
+        caches['template_fragments'].clear()
+
+    def render(self):
+        return render_to_string('transaction_rows.html', {
+            'transactions': load_transactions(Transaction.objects.order_by('-date', '-id'))
+        })
+
+    def test_rows_rerendered_when_changed(self):
+        self.create_transactions(1)
+        html = self.render()
+        self.assertEqual(self.render(), html)
+
+        set_category(Transaction.objects.filter(category=None), Category.objects.create(name='Sundries'))
+        self.assertIn('Sundries', self.render())
+
+        category = Category.objects.get(name='Sundries')
+        category.name = 'Miscellaneous'
+        category.save()
+        html = self.render()
+        self.assertIn('Miscellaneous', html)
+        self.assertNotIn('Sundries', html)
+
+
+class ExportTest(TransactionFixtureTestCase):
+    def export(self, **params):
+        response = self.client.get(reverse('transactions:export'), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        self.create_transactions(2)
+        rows = list(csv.DictReader(io.StringIO(self.export())))
+
+        self.assertEqual([int(row['id']) for row in rows],
+                         list(Transaction.objects.order_by('-date', '-id').values_list('pk', flat=True)))
+
+        payment = next(row for row in rows if row['transaction_type'] == 'paymenttransaction')
+        self.assertEqual((payment['ref'], payment['type'], payment['category'], payment['counterparty']),
+                         ('REF', 'direct debit', 'Groceries', 'Tesco'))
+
+        interest = next(row for row in rows if row['transaction_type'] == 'interesttransaction')
+        self.assertEqual((decimal.Decimal(interest['tax']), interest['ref'], interest['counterparty']), (0, '', ''))
+
+    def test_ndjson_in_chunks(self):
+        self.create_transactions(3)
+        expected = list(Transaction.objects.order_by('-date', '-id').values_list('pk', flat=True))
+
+        rows = [json.loads(line) for line in self.export(format='ndjson').splitlines()]
+        self.assertEqual([row['id'] for row in rows], expected)
+
+        transactions = iter_transactions(Transaction.objects.all(), chunk_size=4)
+        self.assertEqual([transaction.pk for transaction in transactions], expected)
+
+
+class SnapshotTest(TransactionFixtureTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def assertSnapshotMatches(self, snapshot):
+        rows = list(Transaction.base_objects.order_by('id').values_list('id', 'amount', 'category'))
+
+        self.assertEqual(snapshot.id.tolist(), [pk for pk, amount, category_id in rows])
+        self.assertEqual(snapshot.amount.tolist(), [int(amount * 100) for pk, amount, category_id in rows])
+        self.assertEqual(snapshot.category.tolist(), [-1 if category_id is None else category_id
+                                                      for pk, amount, category_id in rows])
+
+    def test_appended_then_rebuilt(self):
+        self.create_transactions(2)
+        self.assertEqual(refresh_snapshot(self.path), (True, 10))
+        self.assertSnapshotMatches(Snapshot.load(self.path))
+
+        self.create_transactions(1)
+        self.assertEqual(refresh_snapshot(self.path), (False, 5))
+        self.assertEqual(refresh_snapshot(self.path), (False, 0))
+        self.assertSnapshotMatches(Snapshot.load(self.path))
+
+        # recategorising transactions already in the snapshot rebuilds it
+        set_category(Transaction.objects.filter(category=None), self.category)
+        self.assertEqual(refresh_snapshot(self.path), (True, 15))
+        self.assertSnapshotMatches(Snapshot.load(self.path))
+
+    def test_loaded_without_refresh_at_same_version(self):
+        self.create_transactions(1)
+
+        # as refreshed by an import in another process
+        refresh_snapshot(self.path)
+
+        with mock.patch('transactions.analytics.refresh_snapshot') as refresh:
+            self.assertSnapshotMatches(get_snapshot(self.path))
+        self.assertFalse(refresh.called)
+
+        set_category(Transaction.objects.filter(category=None), self.category)
+        self.assertSnapshotMatches(get_snapshot(self.path))
+
+    @unittest.skipIf(fcntl is None, 'snapshots are only locked where fcntl is available')
+    def test_locked_while_refreshing(self):
+        self.create_transactions(1)
+        lock_path = os.path.join(self.path, 'lock')
+        attempts = []
+
+        def append_rows(path, meta):
+            # another process or thread trying to take the lock meanwhile
+            with open(lock_path) as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            attempts.append(path)
+            return 0
+
+        with mock.patch('transactions.snapshot._append_rows', side_effect=append_rows):
+            refresh_snapshot(self.path)
+        self.assertEqual(attempts, [self.path])
+
+        # and released afterwards
+        with open(lock_path) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+class TimeSeriesViewTest(SnapshotDirMixin, TransactionFixtureTestCase):
+    def get(self, **params):
+        response = self.client.get(reverse('transactions:time_series'), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_weekly_by_category(self):
+        self.create_transactions(2)
+        next_week = self.date + datetime.timedelta(days=7)
+        InterestTransaction.objects.create(amount=decimal.Decimal('2.50'), tax=0, date=next_week,
+                                           cleared_date=next_week, week=next_week.isocalendar()[1])
+
+        data = self.get(start='2014-06-01', end='2014-06-14', interval='week', by='category', rolling=2)
+
+        # 2014-06-01 was a Sunday
+        self.assertEqual(data['buckets'], ['2014-05-26', '2014-06-02', '2014-06-09'])
+        self.assertEqual(data['net'], [0, -2, 2.5])
+        self.assertEqual(data['incoming'], [0, 4, 2.5])
+        self.assertEqual(data['rolling_net'], [0, -1, 0.25])
+
+        groceries = next(group for group in data['groups'] if group['name'] == 'Groceries')
+        self.assertEqual((groceries['id'], groceries['net']), (self.category.pk, [0, 0, 0]))
+
+        uncategorised = next(group for group in data['groups'] if group['id'] is None)
+        self.assertEqual(uncategorised['net'], [0, -2, 2.5])
+
+    def test_refreshed_after_writes(self):
+        self.create_transactions(1)
+        self.assertEqual(self.get(start='2014-06-01', end='2014-06-30')['net'], [-1])
+
+        set_category(Transaction.objects.filter(category=None), self.category)
+        self.create_transactions(1)
+        data = self.get(start='2014-06-01', end='2014-06-30', by='category')
+        self.assertEqual(data['net'], [-2])
+        self.assertEqual({group['name']: group['net'] for group in data['groups']}, {'Groceries': [-1], None: [-1]})
+
+
+class BalanceTest(TestCase):
+    date = datetime.date(2014, 6, 2)
+
+    def create(self, date, amount, balance):
+        return InterestTransaction.objects.create(amount=decimal.Decimal(amount), balance=decimal.Decimal(balance),
+                                                  tax=0, date=date, cleared_date=date, week=date.isocalendar()[1])
+
+    def test_closing_balance(self):
+        rows = [(decimal.Decimal(amount), decimal.Decimal(balance)) for amount, balance in (
+            ('-5.00', '95.00'), ('10.00', '105.00'), ('-4.00', '101.00'))]
+
+        # statements may list a day's transactions in either order
+        self.assertEqual(closing_balance(rows), decimal.Decimal('101.00'))
+        self.assertEqual(closing_balance(reversed(rows)), decimal.Decimal('101.00'))
+
+        # the 95.00 to 105.00 line is missing
+        self.assertIsNone(closing_balance([rows[0], rows[2]]))
+        self.assertIsNone(closing_balance([]))
+
+    def test_closing_balance_net_zero(self):
+        rows = [(decimal.Decimal(amount), decimal.Decimal(balance)) for amount, balance in (
+            ('-5.00', '95.00'), ('10.00', '105.00'), ('-5.00', '100.00'), ('5.00', '105.00'), ('-5.00', '100.00'))]
+
+        self.assertEqual(closing_balance(rows[:3]), decimal.Decimal('100.00'))
+        self.assertEqual(closing_balance(iter(rows[:3])), decimal.Decimal('100.00'))
+        self.assertEqual(closing_balance(rows[3:]), decimal.Decimal('100.00'))
+        self.assertEqual(closing_balance(rows), decimal.Decimal('100.00'))
+        self.assertEqual(closing_balance(reversed(rows[3:])), decimal.Decimal('105.00'))
+
+        # the closing balance is stored, and agrees with the days around it
+        self.create(self.date - datetime.timedelta(days=1), '10.00', '100.00')
+        for amount, balance in reversed(rows[:3]):
+            self.create(self.date, amount, balance)
+        self.create(self.date + datetime.timedelta(days=1), '1.00', '101.00')
+        update_daily_balances({self.date + datetime.timedelta(days=days) for days in (-1, 0, 1)})
+
+        self.assertEqual(DailyBalance.objects.get(date=self.date).balance, decimal.Decimal('100.00'))
+        self.assertEqual(list(check_balances()), [])
+
+    def test_balance_at(self):
+        next_day = self.date + datetime.timedelta(days=1)
+        self.create(self.date, '-5.00', '95.00')
+        self.create(self.date, '10.00', '105.00')
+        self.create(next_day, '-5.00', '100.00')
+        update_daily_balances({self.date, next_day})
+
+        self.assertEqual(balance_at(self.date - datetime.timedelta(days=1)), (None, None))
+        self.assertEqual(balance_at(self.date), (decimal.Decimal('105.00'), self.date))
+        self.assertEqual(balance_at(self.date + datetime.timedelta(days=7)), (decimal.Decimal('100.00'), next_day))
+        self.assertEqual(list(check_balances()), [])
+
+    def test_check_balances(self):
+        next_day = self.date + datetime.timedelta(days=1)
+        self.create(self.date, '-5.00', '95.00')
+        # a line of the statement between these was not imported
+        self.create(next_day, '-5.00', '80.00')
+        update_daily_balances({self.date, next_day})
+
+        self.assertEqual([date for date, problem in check_balances()], [next_day])
+
+    def test_series_view(self):
+        for day in range(10):
+            self.create(self.date + datetime.timedelta(days=day), '1.00', '{}.00'.format(day + 1))
+        update_daily_balances({self.date + datetime.timedelta(days=day) for day in range(10)})
+
+        def get(**params):
+            response = self.client.get(reverse('transactions:balance_series'), params)
+            return json.loads(response.content.decode())['points']
+
+        # the last balance of each two day period
+        self.assertEqual(get(start='2014-06-03', end='2014-06-12', points=5), [
+            ['2014-06-04', 3], ['2014-06-06', 5], ['2014-06-08', 7], ['2014-06-10', 9], ['2014-06-11', 10]])
+
+        # the balance carried into a range without any balances of its own
+        self.assertEqual(get(start='2014-06-20', end='2014-06-30'), [['2014-06-20', 10]])
+
+
+class RecurringTest(SnapshotDirMixin, TransactionFixtureTestCase):
+    def pay(self, date, amount='-10.00', mandate=7):
+        return PaymentTransaction.objects.create(amount=decimal.Decimal(amount), counterparty_alias=self.alias,
+                                                 ref='REF', mandate=mandate, date=date, cleared_date=date,
+                                                 week=date.isocalendar()[1],
+                                                 type=PaymentTransaction.PaymentType.DIRECT_DEBIT)
+
+    def detect(self, after_id=None):
+        refresh_snapshot()
+        return update_recurring(Snapshot.load(), after_id)
+
+    def test_detect(self):
+        # taken a few days late when due on a weekend
+        for date in ('2014-01-01', '2014-02-03', '2014-03-03', '2014-04-01'):
+            self.pay(datetime.datetime.strptime(date, '%Y-%m-%d').date())
+
+        # the same amount, but at no regular interval
+        for day in (1, 2, 20):
+            self.pay(datetime.date(2014, 1, day), '-3.00', mandate=0)
+
+        self.assertEqual(self.detect(), (2, 1))
+
+        series = RecurringSeries.objects.get()
+        self.assertEqual((series.key, series.interval, series.occurrences), ('payment:Tesco:7', 'monthly', 4))
+        self.assertEqual((series.amount, series.next_date), (decimal.Decimal('-10.00'), datetime.date(2014, 5, 1)))
+
+        # only the series of the new payment is checked again
+        after_id = Transaction.objects.latest('id').pk
+        self.pay(datetime.date(2014, 5, 1), '-12.00')
+        self.assertEqual(self.detect(after_id), (1, 1))
+
+        updated = RecurringSeries.objects.get()
+        self.assertEqual(updated.pk, series.pk)
+        self.assertEqual((updated.amount, updated.last_date), (decimal.Decimal('-12.00'), datetime.date(2014, 5, 1)))
+
+    def test_forecast_view(self):
+        for month in range(1, 5):
+            self.pay(datetime.date(2014, month, 1))
+
+        DailyBalance.objects.create(date=datetime.date(2014, 4, 1), balance=100)
+        self.detect()
+
+        response = self.client.get(reverse('transactions:forecast'), {'start': '2014-04-10', 'days': 60})
+        data = json.loads(response.content.decode())
 
-# Create your tests here.
+        self.assertEqual([payment['date'] for payment in data['payments']], ['2014-05-01', '2014-06-01'])
+        self.assertEqual(data['opening'], {'balance': 100, 'as_of': '2014-04-01'})
+        self.assertEqual(data['days'][0], ['2014-04-10', 0, 100])
+        self.assertEqual(data['days'][-1], ['2014-06-08', 0, 80])
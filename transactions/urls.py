@@ -4,5 +4,12 @@ from transactions import views
 
 urlpatterns = [
     url(r'in_out_data/(?P<year>\d+)/(?P<month>\d+)/$', views.IncomingOutgoingDataView.as_view(), name='in_out_data'),
-    url(r'categorise/$', views.CategoriseView.as_view(), name='categorise')
+    url(r'categorise/$', views.CategoriseView.as_view(), name='categorise'),
+    url(r'categorise/bulk/$', views.BulkCategoriseView.as_view(), name='categorise_bulk'),
+    url(r'data/$', views.TransactionDataView.as_view(), name='data'),
+    url(r'export/$', views.ExportView.as_view(), name='export'),
+    url(r'timeseries/$', views.TimeSeriesView.as_view(), name='time_series'),
+    url(r'balance/$', views.BalanceView.as_view(), name='balance'),
+    url(r'balance/series/$', views.BalanceSeriesView.as_view(), name='balance_series'),
+    url(r'forecast/$', views.ForecastView.as_view(), name='forecast'),
 ]
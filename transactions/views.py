@@ -1,42 +1,101 @@
 import datetime
 
 from django.core.urlresolvers import reverse
-from django.http import JsonResponse
+from django.http import JsonResponse, QueryDict, StreamingHttpResponse
+from django.template.loader import render_to_string
 from django.views.generic import View, ListView, FormView
-from django.db.models import Sum, Count
 from django.contrib import messages
 from django.shortcuts import redirect
 
-from .models import Transaction, Category
-from .forms import CategoriseForm
+from .models import Transaction, Category, DataVersion
+from .categorisation import set_category
+from .loading import load_page
+from .hierarchy import month_subtree_totals
+from .forms import (CategoriseForm, BulkCategoriseForm, TransactionFilterForm, ExportForm, TimeSeriesForm,
+                    BalanceForm, BalanceSeriesForm, ForecastForm)
+from .export import FORMATS, iter_transactions
+from .analytics import get_snapshot, time_series
+from .balances import balance_at, balance_series
+from .recurring import forecast
+from .conditional import ConditionalMixin
 
 
-def get_month_transaction_queryset(year, month):
+# Number of transactions rendered in each page of a transaction table
+TRANSACTION_PAGE_SIZE = 50
+
+
+def get_month_range(year, month):
     start = datetime.date(year, month, 1)
     if month == 12:
         end = datetime.date(year + 1, 1, 1)
     else:
         end = datetime.date(year, month + 1, 1)
 
+    return start, end
+
+
+def get_month_transaction_queryset(year, month):
+    start, end = get_month_range(year, month)
     return Transaction.objects.filter(date__gte=start, date__lt=end)
 
 
-class HomeView(ListView):
+def get_transaction_data_url(cursor, **filters):
+    """
+    Returns the URL of the rendered page of transactions following `cursor`, or None if there is no such page.
+    """
+    if cursor is None:
+        return None
+
+    params = QueryDict('', mutable=True)
+    params.update(filters)
+    params.update({'after': cursor, 'html': 1})
+    return reverse('transactions:data') + '?' + params.urlencode()
+
+
+def transaction_json(transaction):
+    category = transaction.category
+    alias = transaction.counterparty_alias
+
+    return {
+        'id': transaction.pk,
+        'type': transaction._meta.model_name,
+        'date': transaction.date.isoformat(),
+        'cleared_date': transaction.cleared_date.isoformat(),
+        'amount': str(transaction.amount),
+        'category': {'id': category.pk, 'name': category.name} if category else None,
+        'counterparty': {
+            'name': alias.counterparty.name,
+            'alias': alias.pk,
+            'url': alias.counterparty.get_absolute_url(),
+        } if alias else None,
+    }
+
+
+class HomeView(ConditionalMixin, ListView):
     model = Transaction
     template_name = 'home.html'
     context_object_name = 'transactions'
 
-    def get_queryset(self):
+    def get_year_month(self):
         today = datetime.date.today()
-        month = int(self.request.GET.get('month', today.month))
-        year = int(self.request.GET.get('year', today.year))
-        return get_month_transaction_queryset(year, month).order_by('-date')
+        return int(self.request.GET.get('year', today.year)), int(self.request.GET.get('month', today.month))
+
+    def get_version_keys(self):
+        return [DataVersion.SHARED, DataVersion.month_key(*self.get_year_month())]
+
+    def get_etag_parts(self, versions):
+        # the timeline greys out months in the future, and the current month is shown by default
+        return super().get_etag_parts(versions) + [datetime.date.today().isoformat()]
+
+    def get_queryset(self):
+        year, month = self.get_year_month()
+        transactions, self.next_cursor = load_page(get_month_transaction_queryset(year, month), TRANSACTION_PAGE_SIZE)
+        return transactions
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         today = datetime.date.today()
-        month = int(self.request.GET.get('month', today.month))
-        year = int(self.request.GET.get('year', today.year))
+        year, month = self.get_year_month()
         last_year_start = datetime.date(year - 1, 1, 1)
         next_year_start = datetime.date(year + 1, 1, 1)
 
@@ -54,27 +113,33 @@ class HomeView(ListView):
 
         context['in_out_data_url'] = reverse('transactions:in_out_data', args=[year, month])
 
+        start, end = get_month_range(year, month)
+        context['transactions_next_url'] = get_transaction_data_url(
+            self.next_cursor, start=start.isoformat(), end=(end - datetime.timedelta(days=1)).isoformat())
+
         return context
 
 
-class IncomingOutgoingDataView(View):
-    def get(self, request, year, month):
-        transaction_qs = get_month_transaction_queryset(int(year), int(month))
+class IncomingOutgoingDataView(ConditionalMixin, View):
+    def get_version_keys(self):
+        return [DataVersion.SHARED, DataVersion.month_key(int(self.kwargs['year']), int(self.kwargs['month']))]
 
-        category_netamt_map = dict(transaction_qs.values('category__name').annotate(total=Sum('amount')).values_list('category__name', 'total'))
+    def get(self, request, year, month):
+        # subcategories are included in the totals of their top-level categories
+        category_netamt_map = month_subtree_totals(int(year), int(month))
 
-        categories = list(Category.objects.values_list('name', flat=True))
+        categories = list(Category.objects.filter(parent=None).values_list('pk', 'name'))
 
         net_data = ['Net']
 
-        for category in [None] + categories:
+        for category in [None] + [pk for pk, name in categories]:
             net_data.append(float(category_netamt_map.get(category, 0)))
 
-        net_data.append(float(transaction_qs.aggregate(total=Sum('amount'))['total']))
+        net_data.append(float(sum(category_netamt_map.values())))
 
         return JsonResponse({
             'data': [
-                ['Category', 'Uncategorised'] + categories + [{'role': 'annotation'}],
+                ['Category', 'Uncategorised'] + [name for pk, name in categories] + [{'role': 'annotation'}],
                 net_data
             ],
             'options': {
@@ -95,25 +160,15 @@ class CategoriseView(FormView):
         transaction = form.cleaned_data['transaction']
 
         category = form.cleaned_data['category']
-        old_category = transaction.category
 
         # If we cannot find the category, assume it's not a PK but the name of the new category to create
         try:
-            transaction.category = Category.objects.get(pk=category)
+            category = Category.objects.get(pk=category)
         except ValueError:
-            transaction.category = Category.objects.create(name=category)
+            category = Category.objects.create(name=category)
 
-        transaction.save()
-
-        # delete any orphaned categories
-        if old_category:
-            Category.objects.annotate(
-                num_transactions=Count('transaction'),
-                num_counterparties=Count('counterparty')
-            ).filter(
-                num_transactions=0,
-                num_counterparties=0
-            ).delete()
+        # the previous category is deleted if this was the last use of it
+        set_category(Transaction.objects.filter(pk=transaction.pk), category, delete_unused=True)
 
         messages.success(self.request, 'Updated category successfully')
         return redirect(self.request.META['HTTP_REFERER'])
@@ -121,3 +176,167 @@ class CategoriseView(FormView):
     def form_invalid(self, form):
         messages.error(self.request, 'Unable to categorise transaction')
         return redirect(self.request.META['HTTP_REFERER'])
+
+
+class BulkCategoriseView(FormView):
+    """
+    Categorises many transactions at once, selected by id or by filters, and responds with the number changed as
+    JSON. The transactions are updated with a single UPDATE, and the rollups, usage counts and vacated categories
+    are updated once for the whole batch.
+    """
+    form_class = BulkCategoriseForm
+
+    def form_valid(self, form):
+        category = form.cleaned_data['category']
+
+        # If we cannot find the category, assume it's not a PK but the name of the new category to create
+        try:
+            category = Category.objects.get(pk=category)
+        except ValueError:
+            category = Category.objects.create(name=category)
+
+        updated = set_category(form.filter(Transaction.objects.all()), category, delete_unused=True)
+
+        return JsonResponse({'updated': updated, 'category': {'id': category.pk, 'name': category.name}})
+
+    def form_invalid(self, form):
+        return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+
+class TransactionDataView(View):
+    """
+    Pages of transactions as JSON, newest first, optionally filtered by category, counterparty, type and date range.
+    Each page includes the URL of the next page, and with `html` set, the rows rendered for the transaction table.
+    """
+
+    def get(self, request):
+        form = TransactionFilterForm(request.GET)
+
+        if not form.is_valid():
+            return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+        transactions, cursor = load_page(form.filter(Transaction.objects.all()),
+                                         form.cleaned_data['limit'] or TRANSACTION_PAGE_SIZE,
+                                         form.cleaned_data['after'])
+
+        data = {
+            'transactions': [transaction_json(transaction) for transaction in transactions],
+            'next': None,
+        }
+
+        if cursor is not None:
+            params = request.GET.copy()
+            params['after'] = cursor
+            data['next'] = request.path + '?' + params.urlencode()
+
+        if form.cleaned_data['html']:
+            data['html'] = render_to_string('transaction_rows.html', {'transactions': transactions})
+
+        return JsonResponse(data)
+
+
+class ExportView(View):
+    """
+    Streams the transactions as a CSV or NDJSON download, optionally filtered like the transactions data view. Rows
+    are sent as each chunk of transactions is loaded, rather than once the whole history has been read.
+    """
+
+    def get(self, request):
+        form = ExportForm(request.GET)
+
+        if not form.is_valid():
+            return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+        iter_lines, content_type, extension = FORMATS[form.cleaned_data['format']]
+        transactions = iter_transactions(form.filter(Transaction.objects.all()), form.cleaned_data['after'])
+
+        response = StreamingHttpResponse(iter_lines(transactions), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="transactions.{}"'.format(extension)
+        return response
+
+
+class TimeSeriesView(ConditionalMixin, View):
+    """
+    Net, incoming and outgoing totals for each week or month of a date range as JSON, optionally broken down by
+    category, top-level category or counterparty and with rolling averages. Computed from the analytics snapshot
+    rather than the transactions tables.
+    """
+
+    def get_etag_parts(self, versions):
+        # the range ends today by default
+        return super().get_etag_parts(versions) + [datetime.date.today().isoformat()]
+
+    def get(self, request):
+        form = TimeSeriesForm(request.GET)
+
+        if not form.is_valid():
+            return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+        data = form.cleaned_data
+        return JsonResponse(time_series(get_snapshot(), data['start'], data['end'], data['interval'],
+                                        data['by'] or None, data['rolling']))
+
+
+class BalanceView(ConditionalMixin, View):
+    """
+    The balance at the end of a date (by default today) as JSON, from the last statement balance on or before it.
+    """
+
+    def get_etag_parts(self, versions):
+        return super().get_etag_parts(versions) + [datetime.date.today().isoformat()]
+
+    def get(self, request):
+        form = BalanceForm(request.GET)
+
+        if not form.is_valid():
+            return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+        balance, as_of = balance_at(form.cleaned_data['date'])
+
+        return JsonResponse({
+            'date': form.cleaned_data['date'].isoformat(),
+            'balance': str(balance) if balance is not None else None,
+            'as_of': as_of.isoformat() if as_of else None,
+        })
+
+
+class BalanceSeriesView(ConditionalMixin, View):
+    """
+    The balance over a date range as JSON [date, balance] pairs, downsampled for drawing as a sparkline.
+    """
+
+    def get_etag_parts(self, versions):
+        return super().get_etag_parts(versions) + [datetime.date.today().isoformat()]
+
+    def get(self, request):
+        form = BalanceSeriesForm(request.GET)
+
+        if not form.is_valid():
+            return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+        data = form.cleaned_data
+
+        return JsonResponse({
+            'start': data['start'].isoformat(),
+            'end': data['end'].isoformat(),
+            'points': [[date.isoformat(), float(balance)]
+                       for date, balance in balance_series(data['start'], data['end'], data['points'])],
+        })
+
+
+class ForecastView(ConditionalMixin, View):
+    """
+    The payments of the recurring series expected over a date range as JSON, with the net cashflow and projected
+    balance of each day.
+    """
+
+    def get_etag_parts(self, versions):
+        return super().get_etag_parts(versions) + [datetime.date.today().isoformat()]
+
+    def get(self, request):
+        form = ForecastForm(request.GET)
+
+        if not form.is_valid():
+            return JsonResponse({'errors': {field: list(errors) for field, errors in form.errors.items()}}, status=400)
+
+        return JsonResponse(forecast(form.cleaned_data['start'], form.cleaned_data['end']))